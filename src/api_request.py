@@ -0,0 +1,364 @@
+"""
+Модуль api_request.py
+=====================
+
+Выполнение нод api_request на стороне бота.
+
+Нода описывает HTTP-запрос (method, url, headers, body) и список извлекаемых
+из JSON-ответа переменных extractVars: [{"field": "items[0].name", "var": "first_item"}].
+ApiRequestSpec разбирает ноду один раз при компиляции flow: заголовки и тело
+становятся шаблонами, а пути extractVars - цепочками шагов (ключ словаря или
+индекс списка), которые применяются к ответу без повторного разбора строки пути.
+
+Нода может включить кэширование ответа (cacheTtl, секунды): успешный результат
+хранится в общем LRU-кэше по ключу из метода, URL, тела и заголовков запроса
+(всех или только перечисленных в cacheKeyHeaders). Одинаковые запросы, пришедшие
+одновременно, объединяются: к внешнему API уходит один запрос, остальные ждут его результат.
+
+Запросы к каждому хосту проходят через bulkhead и circuit breaker (модуль upstreams).
+
+Настройки через переменные окружения:
+    API_REQUEST_TIMEOUT     - таймаут запроса в секундах (по умолчанию 15)
+    API_CACHE_MAX_ENTRIES   - максимальное число закэшированных ответов (по умолчанию 1000)
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+import requests
+
+from flow_variables import VARIABLE_PATTERN, render_template
+from upstreams import UpstreamUnavailable, is_failure_status, upstreams
+
+API_REQUEST_TIMEOUT = float(os.environ.get('API_REQUEST_TIMEOUT', 15))
+API_CACHE_MAX_ENTRIES = int(os.environ.get('API_CACHE_MAX_ENTRIES', 1000))
+
+_PATH_TOKEN = re.compile(r'([^.\[\]]+)|\[(-?\d+)\]')
+
+_MISSING = object()
+
+
+@lru_cache(maxsize=1024)
+def compile_path(path):
+    """
+    Разбирает путь вида data.items[0].name в кортеж шагов ('data', 'items', 0, 'name').
+
+    Raises:
+        ValueError: Путь пустой или содержит недопустимые символы
+    """
+    steps = []
+    position = 0
+    path = path.strip()
+    while position < len(path):
+        if path[position] == '.':
+            position += 1
+            continue
+        match = _PATH_TOKEN.match(path, position)
+        if not match:
+            raise ValueError(f"Некорректный путь: {path}")
+        key, index = match.groups()
+        steps.append(int(index) if index is not None else key)
+        position = match.end()
+    if not steps:
+        raise ValueError(f"Пустой путь: {path!r}")
+    return tuple(steps)
+
+
+def extract_path(data, steps, default=None):
+    """Возвращает значение по скомпилированному пути или default, если его нет в данных."""
+    for step in steps:
+        if isinstance(data, dict):
+            data = data.get(step if not isinstance(step, int) else str(step), _MISSING)
+        elif isinstance(data, list) and isinstance(step, int):
+            data = data[step] if -len(data) <= step < len(data) else _MISSING
+        else:
+            return default
+        if data is _MISSING:
+            return default
+    return data
+
+
+def load_json_field(value, default):
+    """
+    Разбирает поле ноды, которое редактор хранит JSON-строкой (headers, body, extractVars, requests).
+
+    Уже разобранное значение возвращается как есть, пустое - default. Для
+    некорректного JSON возвращается объект-маркер, не являющийся ни dict, ни list.
+    """
+    if isinstance(value, str):
+        try:
+            return json.loads(value) if value.strip() else default
+        except ValueError:
+            return _MISSING
+    return default if value is None else value
+
+
+def _render_json(template, variables):
+    """Подставляет переменные в строки внутри разобранного JSON-тела.
+
+    Строка, состоящая из одной ссылки {{var}}, заменяется значением переменной
+    в исходном типе (число, bool, список), остальные строки - текстом.
+    """
+    if isinstance(template, str):
+        match = VARIABLE_PATTERN.fullmatch(template)
+        if match and match.group(1) in variables:
+            return variables[match.group(1)]
+        return render_template(template, variables)
+    if isinstance(template, dict):
+        return {key: _render_json(value, variables) for key, value in template.items()}
+    if isinstance(template, list):
+        return [_render_json(value, variables) for value in template]
+    return template
+
+
+class _Flight:
+    """Запрос, который уже выполняется; остальные вызовы с тем же ключом ждут его результат."""
+
+    __slots__ = ('event', 'result')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+class ResponseCache:
+    """
+    LRU-кэш результатов api_request с TTL и объединением одинаковых запросов (single-flight).
+
+    Хранится не тело ответа, а уже извлечённые переменные, поэтому размер записи
+    ограничен тем, что нода берёт из ответа.
+
+    Attributes:
+        max_entries (int): Максимальное число записей
+    """
+
+    def __init__(self, max_entries: int = API_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        # key -> (момент истечения, результат); порядок - от давних обращений к недавним
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def fetch(self, key, ttl, loader):
+        """
+        Возвращает результат из кэша или выполняет loader() (один раз на ключ одновременно).
+
+        В кэш попадают только успешные результаты (result[0] истинно).
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+                self.expirations += 1
+
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._inflight[key] = flight
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.event.wait()
+            return flight.result
+
+        result = (False, None, 'Запрос не выполнен', {})
+        try:
+            result = loader()
+        except Exception as e:
+            result = (False, None, str(e), {})
+        finally:
+            with self._lock:
+                del self._inflight[key]
+                if result[0]:
+                    self._entries[key] = (time.monotonic() + ttl, result)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                        self.evictions += 1
+            flight.result = result
+            flight.event.set()
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Возвращает размер кэша и счётчики попаданий, промахов, объединённых запросов и вытеснений."""
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'inflight': len(self._inflight),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'hit_rate': round((self.hits + self.coalesced) / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+
+response_cache = ResponseCache()
+
+
+class ApiRequestSpec:
+    """
+    Скомпилированная нода api_request.
+
+    Attributes:
+        method (str): HTTP-метод
+        url (str): Шаблон URL
+        headers (tuple): Пары (шаблон имени, шаблон значения)
+        body: Разобранный JSON-шаблон тела, строковый шаблон или None
+        body_is_json (bool): Отправлять тело как JSON
+        extractors (tuple): Пары (имя переменной, скомпилированный путь)
+        ignore_error (bool): При ошибке идти по соединению success
+        cache_ttl (float): Время жизни закэшированного ответа в секундах (0 - без кэша)
+        cache_key_headers (Optional[frozenset]): Заголовки (в нижнем регистре), входящие
+            в ключ кэша; None - все заголовки
+    """
+
+    __slots__ = ('method', 'url', 'headers', 'body', 'body_is_json', 'extractors', 'ignore_error',
+                 'cache_ttl', 'cache_key_headers')
+
+    def __init__(self, node):
+        self.method = (node.get('method') or 'GET').upper()
+        self.url = node.get('url') or ''
+        self.ignore_error = bool(node.get('ignoreError'))
+
+        try:
+            self.cache_ttl = max(float(node.get('cacheTtl') or 0), 0.0)
+        except (TypeError, ValueError):
+            raise ValueError(f"Некорректное время кэширования: {node.get('cacheTtl')!r}")
+        key_headers = [name.strip().lower() for name in str(node.get('cacheKeyHeaders') or '').split(',')
+                       if name.strip()]
+        self.cache_key_headers = frozenset(key_headers) if key_headers else None
+
+        headers = load_json_field(node.get('headers'), {})
+        if isinstance(headers, dict):
+            headers = [{'key': key, 'value': value} for key, value in headers.items()]
+        elif not isinstance(headers, list):
+            headers = [{'key': 'Content-Type', 'value': 'application/json'}]
+        self.headers = tuple(
+            (str(header['key']), str(header.get('value', '')))
+            for header in headers if isinstance(header, dict) and header.get('key')
+        )
+
+        body = node.get('body')
+        parsed_body = load_json_field(body, None)
+        if self.method in ('GET', 'HEAD'):
+            self.body, self.body_is_json = None, False
+        elif parsed_body is _MISSING:
+            self.body, self.body_is_json = body, False
+        else:
+            self.body, self.body_is_json = parsed_body, parsed_body is not None
+
+        extractors = []
+        extract_vars = load_json_field(node.get('extractVars'), [])
+        for item in extract_vars if isinstance(extract_vars, list) else []:
+            field = (item.get('field') or '').strip() if isinstance(item, dict) else ''
+            var = (item.get('var') or '').strip() if isinstance(item, dict) else ''
+            if field and var:
+                extractors.append((var, compile_path(field)))
+        self.extractors = tuple(extractors)
+
+    def build_request(self, variables):
+        """Подставляет переменные чата и возвращает аргументы для requests.request."""
+        kwargs = {
+            'method': self.method,
+            'url': render_template(self.url, variables),
+            'headers': {render_template(key, variables): render_template(value, variables)
+                        for key, value in self.headers},
+        }
+        if self.body_is_json:
+            kwargs['json'] = _render_json(self.body, variables)
+        elif self.body:
+            kwargs['data'] = render_template(self.body, variables).encode('utf-8')
+        return kwargs
+
+    def extract(self, payload):
+        """Возвращает все извлекаемые значения за один проход по списку путей."""
+        return {var: extract_path(payload, steps, '') for var, steps in self.extractors}
+
+    def cache_key(self, request):
+        """Ключ кэша: метод, URL, тело и выбранные заголовки подготовленного запроса."""
+        headers = tuple(sorted(
+            (name.lower(), value) for name, value in request['headers'].items()
+            if self.cache_key_headers is None or name.lower() in self.cache_key_headers
+        ))
+        if 'json' in request:
+            body = json.dumps(request['json'], sort_keys=True, ensure_ascii=False)
+        else:
+            body = request.get('data')
+        return (request['method'], request['url'], body, headers, self.extractors)
+
+    def _fetch(self, request, timeout):
+        """
+        Выполняет подготовленный запрос.
+
+        Тело ответа живёт только внутри вызова: после извлечения переменных
+        на него не остаётся ссылок, и большие ответы не попадают в состояние чата.
+        """
+        try:
+            with upstreams.get(urlsplit(request['url']).netloc).call() as call:
+                with requests.request(timeout=timeout, **request) as response:
+                    status = response.status_code
+                    if not response.ok:
+                        if is_failure_status(status):
+                            call.failed()
+                        return False, status, f'HTTP {status}', {}
+                    values = {}
+                    if self.extractors:
+                        try:
+                            values = self.extract(response.json())
+                        except ValueError:
+                            return False, status, 'Ответ не является JSON', {}
+                    return True, status, None, values
+        except (requests.RequestException, UpstreamUnavailable) as e:
+            return False, None, str(e), {}
+
+    def run(self, variables, timeout=API_REQUEST_TIMEOUT):
+        """
+        Выполняет запрос (или берёт результат из кэша), не изменяя переменные чата.
+
+        Returns:
+            tuple: (успех, HTTP-статус или None, текст ошибки или None, извлечённые значения)
+        """
+        request = self.build_request(variables)
+        if self.cache_ttl:
+            return response_cache.fetch(
+                self.cache_key(request), self.cache_ttl, lambda: self._fetch(request, timeout)
+            )
+        return self._fetch(request, timeout)
+
+    def execute(self, variables, timeout=API_REQUEST_TIMEOUT):
+        """
+        Выполняет запрос и записывает извлечённые переменные.
+
+        Returns:
+            tuple: (успех, HTTP-статус или None, текст ошибки или None)
+        """
+        ok, status, error, values = self.run(variables, timeout)
+        variables.update(values)
+        return ok, status, error
@@ -1,12 +1,13 @@
 import os
 from flask import Flask, render_template, request, jsonify
-from database import (add_bot, get_bot, get_all_bots, update_bot, delete_bot,
-                     get_bot_logs, clear_bot_logs,
+from database import (init_db, add_bot, get_bot, update_bot, delete_bot,
+                     get_bot_summaries, BOT_SUMMARY_FIELDS,
+                     get_bot_logs, clear_bot_logs, search_bot_logs,
                      add_custom_command, get_custom_commands, get_custom_command,
                      get_custom_command_by_id, update_custom_command,
                      delete_custom_command, save_custom_command_flow,
                      get_custom_command_flow)
-from bot_manager import bot_manager
+from http_cache import cached_json_response
 
 # Try to load from .env file if python-dotenv is available
 try:
@@ -19,6 +20,19 @@ except ImportError:
 # This allows the app to work both at root and under /manage prefix
 APPLICATION_ROOT = os.environ.get('APPLICATION_ROOT', '')
 
+# Если задан сокет раннера (runner.py), боты работают в отдельном процессе,
+# а приложение управляет ими через канал управления; иначе - в этом процессе
+BOT_RUNNER_SOCKET = os.environ.get('BOT_RUNNER_SOCKET', '')
+if BOT_RUNNER_SOCKET:
+    from runner_ipc import RemoteBotManager, RunnerUnavailable
+    bot_manager = RemoteBotManager(BOT_RUNNER_SOCKET)
+else:
+    from runner_ipc import RunnerUnavailable
+    from bot_manager import bot_manager
+    from log_archive import log_archive
+    # Без раннера старые логи из SQLite удаляет веб-приложение
+    log_archive.enable_pruning()
+
 # Debug output
 print(f"=== APPLICATION_ROOT = '{APPLICATION_ROOT}' ===")
 if APPLICATION_ROOT:
@@ -27,6 +41,9 @@ else:
     print(f"App will be available at: http://localhost:5000/")
 print("=" * 50)
 
+# Создаём БД и применяем миграции схемы один раз при старте сервиса
+init_db()
+
 app = Flask(__name__,
             template_folder='../templates',
             static_folder='../static',
@@ -58,12 +75,35 @@ def flow_editor(bot_id):
 
 @route('/api/bots', methods=['GET'])
 def list_bots():
-    bots = get_all_bots()
-    for bot in bots:
-        status = bot_manager.get_bot_status(bot['id'])
-        if status:
-            bot['status'] = status
-    return jsonify(bots)
+    """Сводки ботов для дашборда; ?fields=id,name,status ограничивает набор полей.
+
+    Полная запись бота (токен, настройки) - GET /api/bots/<id>.
+    """
+    fields = BOT_SUMMARY_FIELDS
+    if request.args.get('fields'):
+        fields = tuple(dict.fromkeys(field.strip() for field in request.args['fields'].split(',') if field.strip()))
+        unknown = [field for field in fields if field not in BOT_SUMMARY_FIELDS]
+        if unknown:
+            return jsonify({'error': f'Unknown fields: {", ".join(unknown)}',
+                            'fields': list(BOT_SUMMARY_FIELDS)}), 400
+
+    summaries = get_bot_summaries()
+    statuses = {}
+    if 'status' in fields:
+        stored_statuses = {bot['id']: bot['status'] for bot in summaries}
+        try:
+            statuses = bot_manager.get_bot_statuses(stored_statuses)
+        except RunnerUnavailable:
+            # Дашборд остаётся доступным и без раннера - со статусами из БД
+            statuses = stored_statuses
+    bots = []
+    for summary in summaries:
+        bot = {field: summary[field] for field in fields}
+        if statuses:
+            bot['status'] = statuses[summary['id']]
+        bots.append(bot)
+    # ETag - хеш тела: статусы запущенных ботов живут в памяти, а не в БД
+    return cached_json_response(app.json.dumps(bots))
 
 @route('/api/bots', methods=['POST'])
 def create_bot():
@@ -99,7 +139,7 @@ def create_bot():
     
     bot = get_bot(bot_id)
     
-    return jsonify(bot), 201
+    return jsonify(bot.to_dict()), 201
 
 @route('/api/bots/<int:bot_id>', methods=['GET'])
 def get_bot_by_id(bot_id):
@@ -107,7 +147,11 @@ def get_bot_by_id(bot_id):
     if not bot:
         return jsonify({'error': 'Bot not found'}), 404
 
-    status = bot_manager.get_bot_status(bot_id)
+    bot = bot.to_dict()
+    try:
+        status = bot_manager.get_bot_status(bot_id)
+    except RunnerUnavailable:
+        status = None
     if status:
         bot['status'] = status
 
@@ -129,7 +173,7 @@ def update_bot_by_id(bot_id):
     if not bot:
         return jsonify({'error': 'Bot not found'}), 404
 
-    return jsonify(bot)
+    return jsonify(bot.to_dict())
 
 @route('/api/bots/<int:bot_id>', methods=['DELETE'])
 def delete_bot_by_id(bot_id):
@@ -162,12 +206,12 @@ def restart_bot(bot_id):
 def reload_bot_restriction(bot_id):
     """Перезагружает настройки ограничения текстовых сообщений без перезапуска бота."""
     try:
-        if bot_id in bot_manager.bots:
-            bot_instance = bot_manager.bots[bot_id]
-            bot_instance.reload_restriction_settings()
+        if bot_manager.reload_restriction(bot_id):
             return jsonify({'message': 'Restriction settings reloaded successfully'})
         else:
             return jsonify({'error': 'Bot is not running'}), 400
+    except RunnerUnavailable:
+        raise
     except Exception as e:
         return jsonify({'error': f'Failed to reload restriction settings: {str(e)}'}), 500
 
@@ -177,24 +221,143 @@ def get_bot_flow(bot_id):
     if not bot:
         return jsonify({'error': 'Bot not found'}), 404
 
-    from database import get_bot_flow
-    flow_data = get_bot_flow(bot_id)
-    return jsonify(flow_data or {'nodes': [], 'connections': []})
+    from database import get_bot_flow_snapshot
+    # Тело, ETag и ревизия - из одной версии flow: иначе сохранение между чтениями
+    # дало бы редактору тело ревизии N с номером N+1, и его патч лёг бы не на ту основу
+    flow_json, etag, revision = get_bot_flow_snapshot(bot_id)
+    if etag is None:
+        return jsonify({'nodes': [], 'connections': []})
+    # ETag берётся из кеша flow: на повторную загрузку неизменившегося flow отвечаем 304,
+    # а тело отдаём в том виде, в каком оно хранится, без разбора и повторной сериализации
+    response = cached_json_response(lambda: flow_json, etag)
+    # Ревизия нужна редактору как base_revision для сохранения патчем
+    response.headers['X-Flow-Revision'] = str(revision)
+    return response
+
+def _flow_conflict(error):
+    return jsonify({'error': 'Flow was modified by someone else', 'revision': error.revision}), 409
 
 @route('/api/bots/<int:bot_id>/flow', methods=['POST'])
 def save_bot_flow(bot_id):
+    """Сохраняет flow целиком.
+
+    Необязательный параметр запроса base_revision включает проверку: если flow
+    изменён после этой ревизии, возвращается 409 с текущей ревизией.
+    """
     bot = get_bot(bot_id)
     if not bot:
         return jsonify({'error': 'Bot not found'}), 404
 
     flow_data = request.json
-    from database import save_bot_flow
+    base_revision = request.args.get('base_revision', type=int)
+    from database import save_bot_flow, FlowConflictError
     try:
-        save_bot_flow(bot_id, flow_data)
-        return jsonify({'message': 'Flow saved successfully'})
+        revision = save_bot_flow(bot_id, flow_data, base_revision)
+        return jsonify({'message': 'Flow saved successfully', 'revision': revision})
+    except FlowConflictError as e:
+        return _flow_conflict(e)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@route('/api/bots/<int:bot_id>/flow', methods=['PATCH'])
+def patch_bot_flow(bot_id):
+    """Сохраняет изменения flow патчем JSON Patch (RFC 6902).
+
+    Тело: {"base_revision": N, "patch": [{"op": "replace", "path": "/nodes/3/text", "value": "..."}]}.
+    Патч применяется к ревизии N; если flow уже изменён, возвращается 409 с текущей ревизией.
+    """
+    bot = get_bot(bot_id)
+    if not bot:
+        return jsonify({'error': 'Bot not found'}), 404
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('base_revision'), int) or 'patch' not in data:
+        return jsonify({'error': 'base_revision and patch are required'}), 400
+
+    from database import patch_bot_flow, FlowConflictError
+    try:
+        revision = patch_bot_flow(bot_id, data['patch'], data['base_revision'])
+        return jsonify({'message': 'Flow saved successfully', 'revision': revision})
+    except FlowConflictError as e:
+        return _flow_conflict(e)
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@route('/api/bots/<int:bot_id>/flow/revisions', methods=['GET'])
+def list_flow_revisions(bot_id):
+    """История ревизий flow от новых к старым.
+
+    Параметры запроса:
+    - limit: число ревизий (по умолчанию 50, не больше 500)
+    - before: только ревизии с номером меньше указанного (пагинация)
+    """
+    bot = get_bot(bot_id)
+    if not bot:
+        return jsonify({'error': 'Bot not found'}), 404
+
+    from database import get_flow_revisions, get_bot_flow_revision
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+    revisions = get_flow_revisions(bot_id, limit, request.args.get('before', type=int))
+    return jsonify({'current': get_bot_flow_revision(bot_id), 'revisions': revisions})
+
+@route('/api/bots/<int:bot_id>/flow/revisions/<int:revision>', methods=['GET'])
+def get_flow_revision_endpoint(bot_id, revision):
+    """Flow в указанной ревизии."""
+    bot = get_bot(bot_id)
+    if not bot:
+        return jsonify({'error': 'Bot not found'}), 404
+
+    from database import get_flow_revision
+    flow_data = get_flow_revision(bot_id, revision)
+    if flow_data is None:
+        return jsonify({'error': 'Revision not found'}), 404
+    response = jsonify(flow_data)
+    response.headers['X-Flow-Revision'] = str(revision)
+    return response
+
+@route('/api/bots/<int:bot_id>/flow/diff', methods=['GET'])
+def diff_flow_revisions_endpoint(bot_id):
+    """JSON Patch между двумя ревизиями flow (параметры from и to; to по умолчанию - текущая)."""
+    bot = get_bot(bot_id)
+    if not bot:
+        return jsonify({'error': 'Bot not found'}), 404
+
+    from database import diff_flow_revisions, get_bot_flow_revision
+    from_revision = request.args.get('from', type=int)
+    to_revision = request.args.get('to', type=int) or get_bot_flow_revision(bot_id)
+    if from_revision is None or to_revision is None:
+        return jsonify({'error': 'from revision is required'}), 400
+    try:
+        patch = diff_flow_revisions(bot_id, from_revision, to_revision)
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    return jsonify({'from': from_revision, 'to': to_revision, 'patch': patch})
+
+@route('/api/bots/<int:bot_id>/flow/revisions/<int:revision>/rollback', methods=['POST'])
+def rollback_flow_revision(bot_id, revision):
+    """Откатывает flow к указанной ревизии (новой ревизией) и применяет его в запущенном боте."""
+    bot = get_bot(bot_id)
+    if not bot:
+        return jsonify({'error': 'Bot not found'}), 404
+
+    from database import rollback_bot_flow
+    try:
+        new_revision = rollback_bot_flow(bot_id, revision)
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
 
+    try:
+        reloaded = bot_manager.reload_flow(bot_id)
+    except Exception as e:
+        return jsonify({'error': f'Flow rolled back but the running bot was not reloaded: {e}',
+                        'revision': new_revision}), 500
+    return jsonify({'message': 'Flow rolled back successfully', 'revision': new_revision,
+                    'bot_reloaded': reloaded})
+
 @route('/api/bots/<int:bot_id>/logs', methods=['GET'])
 def get_bot_logs_endpoint(bot_id):
     try:
@@ -203,7 +366,17 @@ def get_bot_logs_endpoint(bot_id):
             return jsonify({'error': 'Bot not found'}), 404
 
         limit = request.args.get('limit', 100, type=int)
-        logs = get_bot_logs(bot_id, limit)
+        # Для запущенного бота последние логи отдаются из памяти,
+        # из SQLite дочитываются только записи старше самой старой в буфере
+        try:
+            logs = bot_manager.get_recent_logs(bot_id, limit)
+        except RunnerUnavailable:
+            logs = None
+        if logs is None:
+            logs = get_bot_logs(bot_id, limit)
+        elif len(logs) < limit:
+            before = logs[-1]['timestamp'] if logs else None
+            logs += get_bot_logs(bot_id, limit - len(logs), before=before)
         response = jsonify(logs)
         response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
         response.headers['Pragma'] = 'no-cache'
@@ -213,15 +386,95 @@ def get_bot_logs_endpoint(bot_id):
         print(f"Error getting logs for bot {bot_id}: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
+@route('/api/bots/<int:bot_id>/logs/search', methods=['GET'])
+def search_bot_logs_endpoint(bot_id):
+    """Полнотекстовый поиск по логам бота.
+    
+    Параметры запроса:
+    - q: строка поиска (обязательный)
+    - level: уровень лога, можно указать несколько через запятую
+    - from, to: интервал времени в формате ISO
+    - limit, offset: пагинация
+    """
+    bot = get_bot(bot_id)
+    if not bot:
+        return jsonify({'error': 'Bot not found'}), 404
+
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Search query is required'}), 400
+
+    level = request.args.get('level')
+    levels = [l.strip().upper() for l in level.split(',') if l.strip()] if level else None
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+
+    result = search_bot_logs(
+        bot_id,
+        query,
+        level=levels,
+        since=request.args.get('from'),
+        until=request.args.get('to'),
+        limit=limit,
+        offset=offset
+    )
+    result['limit'] = limit
+    result['offset'] = offset
+    return jsonify(result)
+
 @route('/api/bots/<int:bot_id>/logs', methods=['DELETE'])
 def clear_bot_logs_endpoint(bot_id):
     bot = get_bot(bot_id)
     if not bot:
         return jsonify({'error': 'Bot not found'}), 404
 
+    # Сначала буфер раннера: если раннер недоступен, в нём нет и буфера логов
+    try:
+        bot_manager.clear_recent_logs(bot_id)
+    except RunnerUnavailable as e:
+        print(f"Runner unavailable while clearing logs of bot {bot_id}: {e}")
     clear_bot_logs(bot_id)
     return jsonify({'message': 'Logs cleared successfully'})
 
+@route('/api/bots/<int:bot_id>/sessions/stats', methods=['GET'])
+def get_session_stats_endpoint(bot_id):
+    """Статистика состояний чатов запущенного бота: размер, попадания, вытеснения."""
+    bot = get_bot(bot_id)
+    if not bot:
+        return jsonify({'error': 'Bot not found'}), 404
+
+    stats = bot_manager.get_session_stats(bot_id)
+    if stats is None:
+        return jsonify({'error': 'Bot is not running'}), 409
+    return jsonify(stats)
+
+@route('/api/bots/<int:bot_id>/health', methods=['GET'])
+def get_bot_health_endpoint(bot_id):
+    """Самовосстановление запущенного бота: перезапуски, сбои подряд, цикл падений, время с последнего опроса."""
+    bot = get_bot(bot_id)
+    if not bot:
+        return jsonify({'error': 'Bot not found'}), 404
+
+    health = bot_manager.get_bot_health(bot_id)
+    if health is None:
+        return jsonify({'error': 'Bot is not running'}), 409
+    return jsonify(health)
+
+@route('/api/metrics/api-cache', methods=['GET'])
+def get_api_cache_metrics():
+    """Статистика кэша ответов нод api_request процесса с ботами (в режиме пула - сумма по рабочим процессам)."""
+    return jsonify(bot_manager.api_cache_stats())
+
+@route('/api/metrics/upstreams', methods=['GET'])
+def get_upstream_metrics():
+    """Метрики внешних API по хостам в процессе с ботами: состояние circuit breaker, ошибки, отказы и задержки."""
+    return jsonify(bot_manager.upstream_stats())
+
+@route('/api/runner/status', methods=['GET'])
+def get_runner_status():
+    """Состояние процесса с ботами: PID и число ботов, в режиме пула - по каждому рабочему процессу."""
+    return jsonify(bot_manager.ping())
+
 # ==========================================================================
 # API endpoints для пользовательских команд
 # ==========================================================================
@@ -281,8 +534,7 @@ def create_custom_command(bot_id):
         command_id = add_custom_command(bot_id, command, description, flow_data)
         
         # Перезагружаем команды в запущенном боте
-        if bot_id in bot_manager.bots:
-            bot_manager.bots[bot_id].reload_custom_commands()
+        bot_manager.reload_custom_commands(bot_id)
         
         cmd = get_custom_command_by_id(command_id)
         return jsonify(cmd), 201
@@ -323,8 +575,7 @@ def update_custom_command_endpoint(bot_id, command_id):
     )
     
     # Перезагружаем команды в запущенном боте
-    if bot_id in bot_manager.bots:
-        bot_manager.bots[bot_id].reload_custom_commands()
+    bot_manager.reload_custom_commands(bot_id)
     
     cmd = get_custom_command_by_id(command_id)
     return jsonify(cmd)
@@ -343,8 +594,7 @@ def delete_custom_command_endpoint(bot_id, command_id):
     delete_custom_command(command_id)
     
     # Перезагружаем команды в запущенном боте
-    if bot_id in bot_manager.bots:
-        bot_manager.bots[bot_id].reload_custom_commands()
+    bot_manager.reload_custom_commands(bot_id)
     
     return jsonify({'message': 'Command deleted successfully'})
 
@@ -378,24 +628,25 @@ def save_custom_command_flow_endpoint(bot_id, command_id):
         save_custom_command_flow(command_id, flow_data)
         
         # Перезагружаем команды в запущенном боте
-        if bot_id in bot_manager.bots:
-            bot_manager.bots[bot_id].reload_custom_commands()
+        bot_manager.reload_custom_commands(bot_id)
         
         return jsonify({'message': 'Flow saved successfully'})
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
 
+@app.errorhandler(RunnerUnavailable)
+def runner_unavailable(error):
+    return jsonify({'error': str(error)}), 503
+
 started = False
 
 @app.before_request
 def startup():
+    """Без отдельного раннера боты со статусом running запускаются при первом запросе."""
     global started
-    if not started:
+    if not started and not BOT_RUNNER_SOCKET:
         try:
-            bots = get_all_bots()
-            for bot in bots:
-                if bot['status'] == 'running':
-                    bot_manager.start_bot(bot['id'])
+            bot_manager.start_saved_bots()
             started = True
         except Exception as e:
             print(f"Error starting bots on startup: {e}")
@@ -1,12 +1,21 @@
+import os
 import threading
 import time
 import logging
 import requests
 import re
 import sys
-import operator
-from database import get_bot, update_bot_status, get_bot_flow, add_bot_log, get_custom_command, get_custom_commands
+from collections import deque
+from itertools import islice
+from datetime import datetime
+from database import get_bot, get_bot_summaries, update_bot_status, get_bot_lease_expiry, get_bot_flow, add_bot_log, get_custom_command, get_custom_commands
 from text_message_restrictions import TextMessageRestriction
+from log_archive import log_archive
+from session_store import SessionStore, ChatSession
+from compiled_flow import CompiledFlow
+from api_request import response_cache
+from upstreams import upstreams
+import flow_variables
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -16,25 +25,62 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# Ёмкость кольцевого буфера последних логов для каждого запущенного бота
+RECENT_LOGS_CAPACITY = 1000
+
+# Самовосстановление ботов (BotManager._supervise): период проверки и время без
+# успешного опроса обновлений, после которого бот считается зависшим (секунды)
+BOT_SUPERVISOR_INTERVAL = float(os.environ.get('BOT_SUPERVISOR_INTERVAL', 1))
+BOT_STALL_TIMEOUT = float(os.environ.get('BOT_STALL_TIMEOUT', 180))
+# Задержка перед n-м перезапуском подряд: BASE * 2^(n-1), но не больше MAX (секунды)
+BOT_RESTART_BACKOFF_BASE = float(os.environ.get('BOT_RESTART_BACKOFF_BASE', 1))
+BOT_RESTART_BACKOFF_MAX = float(os.environ.get('BOT_RESTART_BACKOFF_MAX', 300))
+# Столько секунд стабильной работы обнуляют счётчик сбоев подряд
+BOT_RESTART_RESET_AFTER = float(os.environ.get('BOT_RESTART_RESET_AFTER', 60))
+
+# Бот с арендой (модуль leases) отправляет сообщения и запросы к API, только пока до
+# конца аренды остаётся больше запаса (секунды): узел, аренда которого истекает
+# посреди обработки обновлений, замолкает раньше, чем её сможет взять другой узел
+BOT_LEASE_FENCE_MARGIN = float(os.environ.get('BOT_LEASE_FENCE_MARGIN', 1))
+# THRESHOLD сбоев за WINDOW секунд считаются циклом падений
+BOT_CRASH_LOOP_THRESHOLD = int(os.environ.get('BOT_CRASH_LOOP_THRESHOLD', 5))
+BOT_CRASH_LOOP_WINDOW = float(os.environ.get('BOT_CRASH_LOOP_WINDOW', 300))
+
 class BotInstance:
     def __init__(self, bot_id):
         self.bot_id = bot_id
+        # Кольцевой буфер последних логов: чтение не обращается к SQLite
+        self.recent_logs = deque(maxlen=RECENT_LOGS_CAPACITY)
+        self.recent_logs_lock = threading.Lock()
         self.bot_config = get_bot(bot_id)
         self.flow_data = get_bot_flow(bot_id)
-        self.custom_commands = {}  # Хранение пользовательских команд {command: flow_data}
+        self.custom_commands = {}  # Скомпилированные flow пользовательских команд {command: CompiledFlow}
         
         # Проверка на случай отсутствия БД
         if not self.bot_config:
             raise ValueError(f"Bot configuration not found for ID: {bot_id}")
         if not self.flow_data:
             raise ValueError(f"Bot flow not found for ID: {bot_id}")
+        self.flow = CompiledFlow(self.flow_data)
         
         # Загружаем пользовательские команды
         self.load_custom_commands()
         
-        self.user_states = {}
+        # Состояния чатов с ленивой загрузкой и отложенным сохранением в SQLite
+        self.user_states = SessionStore(bot_id, self._restore_session)
         self.running = False
         self.thread = None
+        # False при остановке вместе с процессом-раннером: в БД остаётся статус running,
+        # и бот снова запустится при следующем старте раннера
+        self.persist_stop = True
+        # fencing-токен аренды (модуль leases); None - бот запущен без аренды
+        self.lease_token = None
+        # Последний прочитанный из БД срок аренды (time.time()): пока до него больше
+        # BOT_LEASE_FENCE_MARGIN, проверка аренды не обращается к БД
+        self.lease_expires_at = 0.0
+        # Для супервизора: момент последнего успешного опроса (monotonic) и исключение, завершившее поток
+        self.last_poll_at = None
+        self.crash_error = None
         self.base_url = self.bot_config.get('base_url', 'https://platform-api.max.ru')
         self.bot_name = self.bot_config.get('name', f'Bot_{bot_id}')
         self.bot_token = self.bot_config.get('token', '')
@@ -58,6 +104,8 @@ class BotInstance:
         self.log('INFO', f'Инициализация бота ID: {self.bot_id}, имя: "{self.bot_name}"')
         self.log('INFO', f'Ограничение текстовых сообщений: {"включено" if text_restriction_enabled else "выключено"}')
         self.log('INFO', f'Загружено {len(self.custom_commands)} пользовательских команд')
+        for node_id, error in self.flow.errors.items():
+            self.log('WARNING', f'Нода {node_id} не будет выполнена: {error}', node_id=node_id)
 
     def _get_enabled_commands(self):
         """Получает список включённых команд для ограничения текстовых сообщений.
@@ -82,7 +130,7 @@ class BotInstance:
             self.custom_commands = {}
             for cmd in commands:
                 if cmd['enabled']:
-                    self.custom_commands[cmd['command']] = cmd['flow_data']
+                    self.custom_commands[cmd['command']] = CompiledFlow(cmd['flow_data'])
                     self.log('DEBUG', f'Загружена команда: {cmd["command"]}')
         except Exception as e:
             self.log('ERROR', f'Ошибка загрузки пользовательских команд: {e}')
@@ -103,53 +151,121 @@ class BotInstance:
             return False
         return text in self.custom_commands
 
-    def execute_custom_command_flow(self, chat_id, command, flow_data):
+    def _restore_session(self, data):
+        """Восстанавливает состояние чата, загруженное из БД, на основном flow или flow команды."""
+        command = data.get('command_mode')
+        flow = self.custom_commands.get(command) if command else None
+        if flow is None:
+            return ChatSession.from_dict(data, self.flow)
+        return ChatSession.from_dict(data, flow, command)
+
+    def _current_session(self, chat_id):
+        """
+        Возвращает состояние чата или None.
+
+        Чат, оставшийся на прежней версии основного flow (после reload_flow),
+        переводится на текущую при первом обращении - в потоке бота, а не в потоке,
+        вызвавшем перезагрузку.
+        """
+        session = self.user_states.get(chat_id)
+        if session is not None and session.command is None and session.flow is not self.flow:
+            session.rebind(self.flow)
+        return session
+
+    def _session(self, chat_id):
+        """Возвращает состояние чата, создавая его на основном flow при первом обращении."""
+        session = self._current_session(chat_id)
+        if session is None:
+            session = ChatSession(self.flow)
+            self.user_states[chat_id] = session
+        return session
+
+    def _variables(self, chat_id):
+        session = self._current_session(chat_id)
+        return session.variables if session else {}
+
+    def execute_custom_command_flow(self, chat_id, command, flow):
         """Выполняет flow пользовательской команды."""
         try:
-            if not flow_data or not flow_data.get('nodes'):
+            if not flow:
                 self.log('WARNING', f'Flow для команды {command} пуст или некорректен')
                 return
             
-            # Находим стартовую ноду в flow команды (первая нода)
-            nodes = flow_data.get('nodes', [])
-            if not nodes:
-                self.log('WARNING', f'Нет нод в flow для команды {command}')
-                return
+            # Переключаем на flow команды только этот чат: основной flow бота
+            # и состояния других чатов не меняются
+            session = self._session(chat_id)
+            session.enter_flow(flow, command)
             
             # Используем первую ноду как стартовую
-            start_node = nodes[0]
-            
-            # Сохраняем текущий flow бота и заменяем на flow команды
-            original_flow = self.flow_data
-            self.flow_data = flow_data
-            
-            # Сбрасываем состояние пользователя для команды
-            if chat_id not in self.user_states:
-                self.user_states[chat_id] = {}
-            self.user_states[chat_id]['command_mode'] = command
-            self.user_states[chat_id]['original_flow'] = original_flow
-            
-            # Показываем первую ноду
-            self.show_node(chat_id, start_node['id'])
+            self.show_node(chat_id, flow.ids[0])
             
             self.log('INFO', f'Выполнена команда {command} для чата {chat_id}')
         except Exception as e:
             self.log('ERROR', f'Ошибка выполнения команды {command}: {e}')
-            # Восстанавливаем оригинальный flow
-            if chat_id in self.user_states and 'original_flow' in self.user_states[chat_id]:
-                self.flow_data = self.user_states[chat_id]['original_flow']
 
-    def log(self, level, message):
+    def log(self, level, message, chat_id=None, node_id=None, event=None, latency_ms=None):
+        """Пишет лог бота: в консоль, в буфер последних логов, в архив data/logs и в SQLite.
+
+        Необязательные поля chat_id, node_id, event и latency_ms сохраняются
+        в структурированной записи и используются для офлайн-анализа архива.
+        """
         import sys
         bot_info = f"[ID:{self.bot_id}]"
         log_message = f"{time.strftime('%Y-%m-%d %H:%M:%S')} - {level} - Bot {bot_info} {message}"
         print(log_message, flush=True)
+        now = datetime.now().isoformat()
+        # В буфере запись хранится в виде строки get_bot_logs; id появляется после записи в SQLite
+        entry = {
+            'id': None,
+            'bot_id': self.bot_id,
+            'level': level,
+            'message': message,
+            'timestamp': now
+        }
+        with self.recent_logs_lock:
+            self.recent_logs.append(entry)
         try:
-            add_bot_log(self.bot_id, level, message)
+            log_archive.write({
+                'timestamp': now,
+                'level': level,
+                'bot_id': self.bot_id,
+                'chat_id': chat_id,
+                'node_id': node_id,
+                'event': event,
+                'latency_ms': latency_ms,
+                'message': message
+            })
+        except Exception as e:
+            logging.error(f"Error writing log archive for bot {bot_info}: {e}")
+        try:
+            future = add_bot_log(self.bot_id, level, message, timestamp=now)
+            if future is not None:
+                future.add_done_callback(lambda done: self._set_log_id(entry, done))
             logging.info(f"Bot {bot_info}: {level} - {message}")
         except Exception as e:
             logging.error(f"Error logging to database for bot {bot_info}: {e}")
+
+    def _set_log_id(self, entry, future):
+        """Проставляет записи буфера id строки bot_logs после фиксации записи."""
+        if future.exception() is None:
+            with self.recent_logs_lock:
+                entry['id'] = future.result().lastrowid
         
+    def get_recent_logs(self, limit=100):
+        """Возвращает до limit последних логов бота из памяти (новые первыми).
+
+        Записи имеют тот же вид, что и строки get_bot_logs. Если в буфере меньше
+        записей, чем запрошено, более старую историю дочитывают из SQLite
+        (get_bot_logs с before = время самой старой записи буфера).
+        """
+        with self.recent_logs_lock:
+            return [dict(entry) for entry in islice(reversed(self.recent_logs), limit)]
+
+    def clear_recent_logs(self):
+        """Очищает буфер последних логов."""
+        with self.recent_logs_lock:
+            self.recent_logs.clear()
+
     def get_updates(self, marker=None):
         try:
             url = f"{self.base_url}/updates"
@@ -159,22 +275,27 @@ class BotInstance:
             headers = {"Authorization": self.bot_token}
             # Увеличиваем таймаут до 90 секунд для long polling
             self.log('DEBUG', f'Запрос обновлений с параметрами: marker={marker}')
+            started = time.monotonic()
             response = requests.get(url, params=params, headers=headers, timeout=90)
             response.raise_for_status()
             result = response.json()
+            self.last_poll_at = time.monotonic()
             updates_count = len(result.get('updates', []))
             if updates_count > 0:
-                self.log('DEBUG', f'Получено {updates_count} обновлений')
+                self.log('DEBUG', f'Получено {updates_count} обновлений',
+                         event='poll', latency_ms=round((time.monotonic() - started) * 1000, 1))
             return result
         except requests.exceptions.Timeout as e:
             # При таймауте сохраняем текущий marker, чтобы не потерять позицию
-            self.log('WARNING', f'Таймаут при получении обновлений (marker={marker}): {e}')
+            self.log('WARNING', f'Таймаут при получении обновлений (marker={marker}): {e}', event='poll_timeout')
             return {"updates": [], "marker": marker}
         except Exception as e:
-            self.log('ERROR', f'Ошибка при получении обновлений: {e}')
+            self.log('ERROR', f'Ошибка при получении обновлений: {e}', event='poll_error')
             return {"updates": [], "marker": marker}
 
     def send_message(self, chat_id, text, attachments=None, format_type="html"):
+        if not self.check_lease():
+            return {}
         try:
             # Подставляем переменные в текст сообщения
             processed_text = self.replace_variables(chat_id, text)
@@ -200,14 +321,18 @@ class BotInstance:
             self.log('DEBUG', f'Отправка сообщения в чат {chat_id}: "{processed_text[:30]}..." (формат: {format_type})')
             
             # Уменьшаем таймаут для более быстрой отправки
+            started = time.monotonic()
             response = requests.post(url, headers=headers, json=data, timeout=15)
+            latency_ms = round((time.monotonic() - started) * 1000, 1)
             self.log('DEBUG', f'Статус ответа: {response.status_code}')
             self.log('DEBUG', f'Тело ответа: {response.text[:500] if response.text else "пусто"}')
             response.raise_for_status()
-            self.log('INFO', f'Сообщение отправлено в чат {chat_id}')
+            self.log('INFO', f'Сообщение отправлено в чат {chat_id}',
+                     chat_id=chat_id, event='message_sent', latency_ms=latency_ms)
             return response.json()
         except Exception as e:
-            self.log('ERROR', f'Ошибка при отправке сообщения в чат {chat_id}: {e}')
+            self.log('ERROR', f'Ошибка при отправке сообщения в чат {chat_id}: {e}',
+                     chat_id=chat_id, event='send_error')
             return {}
     
     def extract_chat_id(self, update):
@@ -275,14 +400,12 @@ class BotInstance:
                             
                             self.log('INFO', f'Получен контакт от чата {chat_id}: {full_name} ({phone_number})')
                             
-                            # Сохраняем контакт в состояние пользователя
-                            if chat_id not in self.user_states:
-                                self.user_states[chat_id] = {}
-                            
-                            self.user_states[chat_id]['contact_first_name'] = first_name
-                            self.user_states[chat_id]['contact_last_name'] = last_name
-                            self.user_states[chat_id]['contact_phone'] = phone_number
-                            self.user_states[chat_id]['contact_name'] = full_name
+                            # Сохраняем контакт в переменные чата
+                            variables = self._session(chat_id).variables
+                            variables['contact_first_name'] = first_name
+                            variables['contact_last_name'] = last_name
+                            variables['contact_phone'] = phone_number
+                            variables['contact_name'] = full_name
                             
                             # После получения контакта переходим к следующей ноде
                             self.process_node_after_input(chat_id)
@@ -295,12 +418,10 @@ class BotInstance:
                             
                             self.log('INFO', f'Получена геолокация от чата {chat_id}: {latitude}, {longitude}')
                             
-                            # Сохраняем геолокацию в состояние пользователя
-                            if chat_id not in self.user_states:
-                                self.user_states[chat_id] = {}
-                            
-                            self.user_states[chat_id]['geo_latitude'] = latitude
-                            self.user_states[chat_id]['geo_longitude'] = longitude
+                            # Сохраняем геолокацию в переменные чата
+                            variables = self._session(chat_id).variables
+                            variables['geo_latitude'] = latitude
+                            variables['geo_longitude'] = longitude
                             
                             # После получения геолокации переходим к следующей ноде
                             self.process_node_after_input(chat_id)
@@ -309,7 +430,7 @@ class BotInstance:
             # Обработка текстовых сообщений
             if text == "/start":
                 self.log('INFO', f'Команда /start от чата {chat_id}')
-                self.user_states[chat_id] = {'current_node': None, 'history': []}
+                self.user_states[chat_id] = ChatSession(self.flow)
                 self.show_node(chat_id, 'start')
                 return
             
@@ -321,14 +442,13 @@ class BotInstance:
                 return
 
             # Проверяем, ожидается ли текстовый ввод от пользователя
-            current_state = self.user_states.get(chat_id, {})
-            current_node_id = current_state.get('current_node')
+            session = self._current_session(chat_id)
+            current_node = session.current_node() if session else None
             
-            if current_node_id:
-                current_node = next((n for n in self.flow_data.get('nodes', []) if n['id'] == current_node_id), None)
-                if current_node and current_node.get('collectInput', False):
+            if current_node:
+                if current_node.get('collectInput', False):
                     self.log('INFO', f'Текст от пользователя {chat_id}: {text[:30]}...')
-                    self.user_states[chat_id]['user_text'] = text
+                    session.variables['user_text'] = text
                     self.process_node_after_input(chat_id)
                     return
             
@@ -344,9 +464,11 @@ class BotInstance:
                 self.log('DEBUG', f'Текстовое сообщение от чата {chat_id}: {text[:30]}...')
         
         except Exception as e:
-            self.log('ERROR', f'Ошибка обработки сообщения: {e}')
+            self.log('ERROR', f'Ошибка обработки сообщения: {e}', event='message_error')
 
     def answer_callback(self, callback_id, text=None):
+        if not self.check_lease():
+            return {}
         try:
             url = f"{self.base_url}/answers"
             headers = {
@@ -376,7 +498,7 @@ class BotInstance:
             self.log('WARNING', f'Не удалось извлечь chat_id из callback')
             return
 
-        self.log('INFO', f'Нажатие кнопки от чата {chat_id}: {payload}')
+        self.log('INFO', f'Нажатие кнопки от чата {chat_id}: {payload}', chat_id=chat_id, event='button_press')
         
         # Отвечаем на callback только для кнопок типа callback
         if payload.startswith('btn:'):
@@ -386,22 +508,29 @@ class BotInstance:
     
     def show_node(self, chat_id, node_id):
         try:
-            if not self.flow_data:
+            session = self._session(chat_id)
+            if not session.flow:
                 self.log('WARNING', 'Данные flow не загружены')
                 return
 
-            node = next((n for n in self.flow_data.get('nodes', []) if n['id'] == node_id), None)
+            node = session.move_to(node_id)
             if not node:
                 self.log('WARNING', f'Нода {node_id} не найдена')
                 return
 
-            if chat_id not in self.user_states:
-                self.user_states[chat_id] = {}
-            
-            self.user_states[chat_id]['current_node'] = node_id
             node_text = node.get('text', '')
             node_text_preview = node_text[:50]
 
+            # Запрос к внешнему API
+            if node['type'] == 'api_request':
+                self.execute_api_request(chat_id, session, node_id)
+                return
+
+            # Параллельные запросы к внешним API
+            if node['type'] == 'fan_out':
+                self.execute_fan_out(chat_id, session, node_id)
+                return
+
             # Обработка трансформаций
             if node['type'] == 'transform':
                 transformations = node.get('transformations', [])
@@ -415,7 +544,7 @@ class BotInstance:
                         try:
                             # Заменяем переменные в выражении
                             result = self.evaluate_expression(chat_id, expression)
-                            self.user_states[chat_id][var_name] = result
+                            session.variables[var_name] = result
                             self.log('DEBUG', f'Трансформация {var_name} = {result}')
                         except Exception as e:
                             self.log('ERROR', f'Ошибка трансформации {var_name}: {e}')
@@ -426,7 +555,8 @@ class BotInstance:
 
             if node['type'] in ['menu', 'universal'] and node.get('buttons'):
                 buttons_count = len(node['buttons'])
-                self.log('DEBUG', f'Отображение ноды "{node_text_preview}" с {buttons_count} кнопками для чата {chat_id}')
+                self.log('DEBUG', f'Отображение ноды "{node_text_preview}" с {buttons_count} кнопками для чата {chat_id}',
+                         chat_id=chat_id, node_id=node_id, event='node_shown')
 
                 buttons = []
                 for btn in node['buttons']:
@@ -467,7 +597,8 @@ class BotInstance:
                 self.log('DEBUG', f'Формат текста для ноды {node_id}: {format_type}')
                 self.send_message(chat_id, node['text'], [keyboard], format_type=format_type)
             else:
-                self.log('DEBUG', f'Отображение ноды "{node_text_preview}" (без кнопок) для чата {chat_id}')
+                self.log('DEBUG', f'Отображение ноды "{node_text_preview}" (без кнопок) для чата {chat_id}',
+                         chat_id=chat_id, node_id=node_id, event='node_shown')
                 # Используем формат из свойств узла (по умолчанию html)
                 format_type = node.get('format', 'html')
                 self.log('DEBUG', f'Формат текста для ноды {node_id}: {format_type}')
@@ -475,42 +606,97 @@ class BotInstance:
                 
                 # Для нод без кнопок проверяем авто-переход
                 self.log('DEBUG', f'Проверка авто-перехода для ноды {node_id}')
-                connection = next((c for c in self.flow_data.get('connections', []) 
-                                  if c['from'] == node_id and not c.get('buttonId')), None)
-                self.log('DEBUG', f'Найдено соединение: {connection}')
-                if connection and connection.get('to'):
-                    history = self.user_states.get(chat_id, {}).get('history', [])
-                    history.append(node_id)
-                    self.user_states[chat_id]['history'] = history
+                target_node_id = session.flow.auto_targets.get(node_id)
+                self.log('DEBUG', f'Цель авто-перехода: {target_node_id}')
+                if target_node_id:
+                    session.push_history()
                     
-                    target_node_id = connection['to']
                     self.log('DEBUG', f'Авто-переход: {node_id} -> {target_node_id}')
                     self.show_node(chat_id, target_node_id)
         except Exception as e:
-            self.log('ERROR', f'Ошибка отображения ноды {node_id}: {e}')
+            self.log('ERROR', f'Ошибка отображения ноды {node_id}: {e}',
+                     chat_id=chat_id, node_id=node_id, event='node_error')
     
+    def execute_api_request(self, chat_id, session, node_id):
+        """Выполняет ноду api_request и переходит по соединению success или error."""
+        spec = session.flow.api_requests.get(session.node)
+        if spec is None:
+            error = session.flow.errors.get(node_id, 'нода не скомпилирована')
+            self.log('ERROR', f'Некорректный API запрос в ноде {node_id}: {error}',
+                     chat_id=chat_id, node_id=node_id, event='api_error')
+            return
+        if not self.check_lease():
+            return
+
+        started = time.monotonic()
+        ok, status, error = spec.execute(session.variables)
+        latency_ms = round((time.monotonic() - started) * 1000, 1)
+        if ok:
+            self.log('DEBUG', f'API запрос {spec.method} выполнен для чата {chat_id}: HTTP {status}',
+                     chat_id=chat_id, node_id=node_id, event='api_request', latency_ms=latency_ms)
+            branch = 'success'
+        else:
+            self.log('WARNING', f'Ошибка API запроса {spec.method} для чата {chat_id}: {error}',
+                     chat_id=chat_id, node_id=node_id, event='api_error', latency_ms=latency_ms)
+            branch = 'success' if spec.ignore_error else 'error'
+
+        self._follow_typed_target(chat_id, session, node_id, branch)
+
+    def execute_fan_out(self, chat_id, session, node_id):
+        """Выполняет запросы ноды fan_out одновременно и переходит по соединению success или error."""
+        spec = session.flow.fan_outs.get(session.node)
+        if spec is None:
+            error = session.flow.errors.get(node_id, 'нода не скомпилирована')
+            self.log('ERROR', f'Некорректная нода fan_out {node_id}: {error}',
+                     chat_id=chat_id, node_id=node_id, event='api_error')
+            return
+        if not self.check_lease():
+            return
+
+        started = time.monotonic()
+        result = spec.execute(session.variables)
+        latency_ms = round((time.monotonic() - started) * 1000, 1)
+        summary = f'успешно {result.succeeded} из {result.total}, нужно {spec.required}'
+        if result.ok:
+            self.log('DEBUG', f'Параллельные запросы выполнены для чата {chat_id}: {summary}',
+                     chat_id=chat_id, node_id=node_id, event='api_request', latency_ms=latency_ms)
+            branch = 'success'
+        else:
+            errors = '; '.join(f'#{position + 1}: {error}' for position, error in result.errors)
+            self.log('WARNING', f'Параллельные запросы для чата {chat_id} не выполнены ({summary}): {errors}',
+                     chat_id=chat_id, node_id=node_id, event='api_error', latency_ms=latency_ms)
+            branch = 'success' if spec.ignore_error else 'error'
+
+        self._follow_typed_target(chat_id, session, node_id, branch)
+
+    def _follow_typed_target(self, chat_id, session, node_id, branch):
+        """Переходит по соединению success/error ноды запроса."""
+        target_node_id = session.flow.typed_targets.get((node_id, branch))
+        if target_node_id:
+            session.push_history()
+            self.log('DEBUG', f'Переход после API запроса ({branch}): {node_id} -> {target_node_id}')
+            self.show_node(chat_id, target_node_id)
+        else:
+            self.log('DEBUG', f'Нет соединения {branch} от ноды {node_id}')
+
     def handle_button_press(self, chat_id, payload):
         # Обработка только для кнопок типа callback (с префиксом btn:)
         if not payload.startswith('btn:'):
             return
 
         button_id = payload[4:]
-        current_state = self.user_states.get(chat_id, {})
-        current_node_id = current_state.get('current_node')
-        history = current_state.get('history', [])
+        session = self._current_session(chat_id)
 
-        if not current_node_id:
+        if not session or session.node < 0:
             self.log('WARNING', f'Нет текущей ноды для чата {chat_id}')
             return
 
-        if not self.flow_data:
+        if not session.flow:
             self.log('WARNING', 'Данные flow не загружены')
             return
 
-        current_node = next((n for n in self.flow_data.get('nodes', []) if n['id'] == current_node_id), None)
-        if not current_node:
-            self.log('WARNING', f'Текущая нода {current_node_id} не найдена')
-            return
+        current_node_id = session.current_node_id
+        current_node = session.current_node()
 
         # Проверяем тип кнопки и обрабатываем её
         if current_node.get('buttons'):
@@ -524,9 +710,8 @@ class BotInstance:
                 
                 # Кнопка Назад
                 if button.get('isBack'):
-                    if history:
-                        prev_node_id = history.pop()
-                        self.user_states[chat_id]['history'] = history
+                    prev_node_id = session.pop_history()
+                    if prev_node_id:
                         self.log('DEBUG', f'Переад на предыдущую ноду {prev_node_id} (кнопка "Назад")')
                         self.show_node(chat_id, prev_node_id)
                     else:
@@ -535,11 +720,9 @@ class BotInstance:
                     return
 
         # Переход к следующей ноде по соединению
-        connection = next((c for c in self.flow_data.get('connections', []) if c.get('buttonId') == button_id), None)
-        if connection and connection.get('to'):
-            history.append(current_node_id)
-            self.user_states[chat_id]['history'] = history
-            target_node_id = connection['to']
+        target_node_id = session.flow.button_targets.get(button_id)
+        if target_node_id:
+            session.push_history()
             self.log('DEBUG', f'Переад по кнопке {button_id}: {current_node_id} -> {target_node_id}')
             self.show_node(chat_id, target_node_id)
         else:
@@ -550,43 +733,29 @@ class BotInstance:
     
     def process_node_after_input(self, chat_id):
         """Переход к следующей ноде после получения ввода от пользователя"""
-        current_state = self.user_states.get(chat_id, {})
-        current_node_id = current_state.get('current_node')
-        
-        if not current_node_id:
-            return
+        session = self._current_session(chat_id)
+        current_node = session.current_node() if session else None
         
-        current_node = next((n for n in self.flow_data.get('nodes', []) if n['id'] == current_node_id), None)
         if not current_node:
-            self.log('WARNING', f'Текущая нода {current_node_id} не найдена')
             return
+        current_node_id = session.current_node_id
         
         # Сначала проверяем, есть ли кнопки в ноде
         if current_node.get('buttons'):
             # Ищем соединение по кнопке (для request_contact, request_location и т.д.)
             for btn in current_node['buttons']:
-                connection = next((c for c in self.flow_data.get('connections', [])
-                                  if c.get('buttonId') == btn['id']), None)
-                if connection and connection.get('to'):
-                    history = current_state.get('history', [])
-                    history.append(current_node_id)
-                    self.user_states[chat_id]['history'] = history
-                    
-                    target_node_id = connection['to']
+                target_node_id = session.flow.button_targets.get(btn['id'])
+                if target_node_id:
+                    session.push_history()
                     self.log('DEBUG', f'Переход после ввода по кнопке {btn["id"]}: {current_node_id} -> {target_node_id}')
                     self.show_node(chat_id, target_node_id)
                     return
         
         # Иначе ищем обычное соединение от ноды
-        connection = next((c for c in self.flow_data.get('connections', [])
-                          if c.get('from') == current_node_id and not c.get('buttonId')), None)
+        target_node_id = session.flow.auto_targets.get(current_node_id)
         
-        if connection and connection.get('to'):
-            history = current_state.get('history', [])
-            history.append(current_node_id)
-            self.user_states[chat_id]['history'] = history
-            
-            target_node_id = connection['to']
+        if target_node_id:
+            session.push_history()
             self.log('DEBUG', f'Переход после ввода: {current_node_id} -> {target_node_id}')
             self.show_node(chat_id, target_node_id)
         else:
@@ -598,161 +767,21 @@ class BotInstance:
         Поддерживаемые операции:
         - Арифметические: +, -, *, /, //, %, **
         - Сравнения: ==, !=, <, >, <=, >=
-        - Логические: and, or, not
+        - Логические: and, or
         - Строковые операции (только сравнение)
-        """
-        state = self.user_states.get(chat_id, {})
-        
-        # Получаем значения переменных
-        def get_var(var_name):
-            return str(state.get(var_name, ''))
-        
-        # Заменяем переменные в выражении
-        pattern = r'\{\{(\w+)\}\}'
-        
-        def replace_var(match):
-            var_name = match.group(1)
-            value = get_var(var_name)
-            # Экранируем строку для безопасного использования
-            return repr(value)
-        
-        safe_expression = re.sub(pattern, replace_var, expression)
         
+        Возвращает результат в исходном типе (int, float, bool, str),
+        при ошибке - пустую строку.
+        """
         try:
-            # Безопасное вычисление выражения
-            result = self._safe_eval(safe_expression)
-            return str(result)
+            return flow_variables.evaluate(expression, self._variables(chat_id))
         except Exception as e:
             self.log('ERROR', f'Ошибка вычисления выражения "{expression}": {e}')
             return ''
     
-    def _safe_eval(self, expr):
-        """Безопасно вычисляет арифметическое и логическое выражение.
-        
-        Использует ограниченный набор операторов и не позволяет
-        выполнение произвольного кода.
-        """
-        # Определяем безопасные операторы
-        operators = {
-            # Арифметические
-            '+': operator.add,
-            '-': operator.sub,
-            '*': operator.mul,
-            '/': operator.truediv,
-            '//': operator.floordiv,
-            '%': operator.mod,
-            '**': operator.pow,
-            # Сравнения
-            '==': operator.eq,
-            '!=': operator.ne,
-            '<': operator.lt,
-            '>': operator.gt,
-            '<=': operator.le,
-            '>=': operator.ge,
-            # Логические (возвращают строки для совместимости)
-            'and': lambda a, b: 'True' if a and b else 'False',
-            'or': lambda a, b: 'True' if a or b else 'False',
-            'not': lambda a: 'True' if not a else 'False',
-        }
-        
-        # Токенизируем выражение
-        # Разбиваем на: строки (в кавычках), числа, операторы, переменные
-        tokens = []
-        i = 0
-        while i < len(expr):
-            # Пробелы пропускаем
-            if expr[i].isspace():
-                i += 1
-                continue
-            
-            # Строки в кавычках
-            if expr[i] in '"\'':
-                quote = expr[i]
-                i += 1
-                start = i
-                while i < len(expr) and expr[i] != quote:
-                    if expr[i] == '\\' and i + 1 < len(expr):
-                        i += 2
-                    else:
-                        i += 1
-                tokens.append(expr[start:i])
-                i += 1
-                continue
-            
-            # Числа (целые и дробные)
-            if expr[i].isdigit() or expr[i] == '.':
-                start = i
-                while i < len(expr) and (expr[i].isdigit() or expr[i] == '.'):
-                    i += 1
-                tokens.append(expr[start:i])
-                continue
-            
-            # Операторы (двухсимвольные сначала)
-            if i + 1 < len(expr) and expr[i:i+2] in operators:
-                tokens.append(expr[i:i+2])
-                i += 2
-                continue
-            
-            # Односимвольные операторы
-            if expr[i] in operators:
-                tokens.append(expr[i])
-                i += 1
-                continue
-            
-            # Неизвестные символы - ошибка
-            raise ValueError(f"Недопустимый символ: {expr[i]}")
-        
-        # Вычисляем в простом порядке (без учёта приоритета)
-        # Для сложных выражений нужен полноценный парсер
-        if not tokens:
-            return ''
-        
-        result = tokens[0]
-        
-        # Конвертируем первый токен
-        if result.isdigit():
-            result = int(result)
-        elif '.' in result and result.replace('.', '').isdigit():
-            result = float(result)
-        
-        # Обрабатываем пары токен-оператор-значение
-        i = 1
-        while i + 1 < len(tokens):
-            op = tokens[i]
-            val = tokens[i + 1]
-            
-            # Конвертируем значение
-            if val.isdigit():
-                val = int(val)
-            elif '.' in val and val.replace('.', '').isdigit():
-                val = float(val)
-            
-            # Применяем оператор
-            if op in operators:
-                result = operators[op](result, val)
-            else:
-                raise ValueError(f"Неизвестный оператор: {op}")
-            
-            i += 2
-        
-        return result
-    
     def replace_variables(self, chat_id, text):
         """Заменяет переменные в тексте на их значения"""
-        state = self.user_states.get(chat_id, {})
-        
-        import re
-        pattern = r'\{\{(\w+)\}\}'
-        
-        def replace_var(match):
-            var_name = match.group(1)
-            value = state.get(var_name, '')
-            # Если значение не найдено, оставляем переменную без изменений
-            if value == '' and var_name not in state:
-                return match.group(0)
-            return str(value)
-        
-        return re.sub(pattern, replace_var, text)
+        return flow_variables.render_template(text, self._variables(chat_id))
     
     # ==========================================================================
     # Методы для управления ограничением текстовых сообщений
@@ -820,8 +849,17 @@ class BotInstance:
         if not chat_id:
             return update.get("marker", marker)
 
+        try:
+            self._dispatch_update(update_type, update, chat_id)
+        finally:
+            # Состояние чата могло измениться: сохраняем его при следующем сбросе
+            self.user_states.mark_dirty(chat_id)
+
+        return update.get("marker", marker)
+
+    def _dispatch_update(self, update_type, update, chat_id):
         if update_type == "bot_started":
-            self.log('DEBUG', f'Событие: bot_started, чат {chat_id}')
+            self.log('DEBUG', f'Событие: bot_started, чат {chat_id}', chat_id=chat_id, event=update_type)
             self.handle_message({"chat": {"id": chat_id}, "text": "/start"})
 
         elif update_type == "message_created":
@@ -837,7 +875,8 @@ class BotInstance:
             }
 
             if text:
-                self.log('DEBUG', f'Событие: message_created, чат {chat_id}, текст: "{text[:20]}"')
+                self.log('DEBUG', f'Событие: message_created, чат {chat_id}, текст: "{text[:20]}"',
+                         chat_id=chat_id, event=update_type)
 
             self.handle_message(full_message)
 
@@ -851,10 +890,9 @@ class BotInstance:
                     "payload": payload,
                     "message": {"chat": {"id": chat_id}}
                 }
-                self.log('DEBUG', f'Событие: message_callback, чат {chat_id}, payload: {payload}')
+                self.log('DEBUG', f'Событие: message_callback, чат {chat_id}, payload: {payload}',
+                         chat_id=chat_id, event=update_type)
                 self.handle_callback(callback_struct)
-
-        return update.get("marker", marker)
     
     def run(self):
         self.running = True
@@ -888,15 +926,26 @@ class BotInstance:
                     params["marker"] = marker
 
                 updates = self.get_updates(marker)
+                # Бот остановлен во время опроса (в том числе заменён супервизором после
+                # зависания): полученные обновления обработает новый экземпляр
+                if not self.running:
+                    break
+                # Аренда могла перейти к другому узлу, пока шёл опрос: обновления
+                # не обрабатываются, чтобы два узла не ответили на одно сообщение
+                if not self.check_lease():
+                    break
                 if "updates" in updates and updates["updates"]:
                     updates_count = len(updates["updates"])
                     if updates_count > 0:
                         self.log('DEBUG', f'Получено {updates_count} обновлений')
                     for update in updates["updates"]:
+                        # Аренда может истечь посреди пачки: остаток обработает новый владелец
+                        if not self.check_lease():
+                            break
                         try:
                             marker = self.process_update(update, marker)
                         except Exception as e:
-                            self.log('ERROR', f'Ошибка обработки обновления: {e}')
+                            self.log('ERROR', f'Ошибка обработки обновления: {e}', event='update_error')
                             # Продолжаем с текущим marker, чтобы не застрять в цикле
                 if "marker" in updates:
                     marker = updates["marker"]
@@ -905,21 +954,84 @@ class BotInstance:
                 time.sleep(5)
 
         self.log('INFO', f'Бот [ID:{self.bot_id}] остановлен')
-        update_bot_status(self.bot_id, "stopped")
+        if self.persist_stop:
+            update_bot_status(self.bot_id, "stopped")
+
+    def set_lease_token(self, token):
+        """Задаёт fencing-токен аренды, с которым бот опрашивает обновления и сохраняет состояния чатов."""
+        self.lease_token = token
+        self.lease_expires_at = 0.0
+        self.user_states.lease_token = token
+
+    def holds_lease(self):
+        """
+        Действует ли аренда бота ещё хотя бы BOT_LEASE_FENCE_MARGIN секунд (без аренды - всегда).
+
+        Срок аренды кэшируется: БД читается, только когда до известного срока осталось
+        меньше запаса, то есть примерно раз в период продления аренды.
+        """
+        token = self.lease_token
+        if token is None:
+            return True
+        now = time.time()
+        if self.lease_expires_at - BOT_LEASE_FENCE_MARGIN > now:
+            return True
+        self.lease_expires_at = get_bot_lease_expiry(self.bot_id, token) or 0.0
+        return self.lease_expires_at - BOT_LEASE_FENCE_MARGIN > now
+
+    def check_lease(self):
+        """
+        Проверяет аренду перед внешним действием (ответ пользователю, запрос к API).
+
+        При потере аренды останавливает опрос без записи статуса stopped: бот
+        продолжит работу на узле, получившем аренду.
+
+        Returns:
+            bool: False, если действие выполнять нельзя
+        """
+        if self.holds_lease():
+            return True
+        if self.running:
+            self.log('WARNING', f'Аренда бота перешла к другому узлу или истекает (токен {self.lease_token}), '
+                                f'опрос остановлен', event='lease_lost')
+            self.persist_stop = False
+            self.running = False
+        return False
 
     def start(self):
         if not self.running:
             self.log('INFO', f'Запуск бота \"{self.bot_name}\" [ID:{self.bot_id}]')
             self.running = True
-            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.last_poll_at = time.monotonic()
+            self.user_states.start()
+            self.thread = threading.Thread(target=self._run_thread, daemon=True)
             self.thread.start()
             update_bot_status(self.bot_id, "running")
 
-    def stop(self):
+    def _run_thread(self):
+        try:
+            self.run()
+        except BaseException as e:
+            # running остаётся True: упавший поток перезапустит супервизор BotManager
+            self.crash_error = e
+            self.log('ERROR', f'Поток бота завершился с ошибкой: {e!r}', event='bot_crash')
+
+    def stop(self, persist=True):
+        """
+        Останавливает бота и сохраняет состояния чатов.
+
+        Args:
+            persist (bool): Записать в БД статус stopped. False - остановка вместе
+                с раннером, после которой бот должен запуститься снова.
+        """
         self.log('INFO', f'Остановка бота "{self.bot_name}" [ID:{self.bot_id}]')
+        self.persist_stop = persist
         self.running = False
         if self.thread and self.thread.is_alive():
             self.thread.join(timeout=5)
+        self.user_states.stop()
+        if not persist:
+            return
         try:
             update_bot_status(self.bot_id, "stopped")
         except Exception as e:
@@ -950,68 +1062,418 @@ class BotInstance:
         except Exception as e:
             self.log('ERROR', f'Ошибка при перезагрузке настроек ограничения: {e}')
 
+    def reload_flow(self):
+        """
+        Загружает текущую ревизию flow из базы данных без перезапуска бота.
+
+        Новый CompiledFlow подменяет прежний одним присваиванием; чаты переходят
+        на него при следующем обращении (см. _current_session), сохраняя
+        текущую ноду, историю и переменные.
+
+        Raises:
+            ValueError: Flow бота не найден
+        """
+        flow_data = get_bot_flow(self.bot_id)
+        if not flow_data:
+            raise ValueError(f"Bot flow not found for ID: {self.bot_id}")
+        flow = CompiledFlow(flow_data)
+        self.flow_data = flow_data
+        self.flow = flow
+        self.log('INFO', f'Flow перезагружен: {len(flow.nodes)} нод')
+        for node_id, error in flow.errors.items():
+            self.log('WARNING', f'Нода {node_id} не будет выполнена: {error}', node_id=node_id)
+
+def flow_is_startable(bot_id):
+    """Проверяет, что flow бота настроен и в нём есть стартовая нода; причину отказа пишет в лог."""
+    flow_data = get_bot_flow(bot_id)
+    if not flow_data or not flow_data.get('nodes'):
+        logging.error(f"[BotManager] Не удалось запустить бот [ID:{bot_id}]: flow не настроен")
+        return False
+    start_node = next((n for n in flow_data.get('nodes', []) if n.get('isStart')), None)
+    if not start_node:
+        logging.error(f"[BotManager] Не удалось запустить бот [ID:{bot_id}]: нет стартовой ноды")
+        return False
+    return True
+
+class _BotHealth:
+    """
+    Состояние самовосстановления одного бота (см. BotManager._supervise).
+
+    Attributes:
+        restarts (int): Перезапусков супервизором с момента запуска бота
+        consecutive_failures (int): Сбоев подряд; определяет задержку перед перезапуском
+        crash_loops (int): Сколько раз бот входил в цикл падений
+        in_crash_loop (bool): BOT_CRASH_LOOP_THRESHOLD сбоев за BOT_CRASH_LOOP_WINDOW секунд
+        last_failure (Optional[str]): Причина последнего сбоя
+        next_restart_at (Optional[float]): Момент (monotonic) перезапуска; None - бот работает
+    """
+
+    __slots__ = ('restarts', 'consecutive_failures', 'crash_loops', 'in_crash_loop', 'last_failure',
+                 'last_failure_at', 'next_restart_at', 'started_at', '_failure_times')
+
+    def __init__(self):
+        self.restarts = 0
+        self.consecutive_failures = 0
+        self.crash_loops = 0
+        self.in_crash_loop = False
+        self.last_failure = None
+        self.last_failure_at = None
+        self.next_restart_at = None
+        self.started_at = time.monotonic()
+        self._failure_times = deque(maxlen=BOT_CRASH_LOOP_THRESHOLD)
+
+    def record_failure(self, reason, now):
+        """
+        Учитывает сбой и назначает перезапуск с экспоненциальной задержкой.
+
+        Returns:
+            bool: Сбой привёл к входу в цикл падений
+        """
+        self.consecutive_failures += 1
+        self.last_failure = reason
+        self.last_failure_at = time.time()
+        delay = min(BOT_RESTART_BACKOFF_BASE * 2 ** (self.consecutive_failures - 1), BOT_RESTART_BACKOFF_MAX)
+        self.next_restart_at = now + delay
+        self._failure_times.append(now)
+        entered_loop = (not self.in_crash_loop
+                        and len(self._failure_times) == BOT_CRASH_LOOP_THRESHOLD
+                        and now - self._failure_times[0] <= BOT_CRASH_LOOP_WINDOW)
+        if entered_loop:
+            self.in_crash_loop = True
+            self.crash_loops += 1
+        return entered_loop
+
+    def record_restart(self, now):
+        self.restarts += 1
+        self.next_restart_at = None
+        self.started_at = now
+
+    def record_healthy(self, now):
+        """Обнуляет счётчик сбоев подряд, если бот стабильно работает BOT_RESTART_RESET_AFTER секунд."""
+        if self.consecutive_failures and now - self.started_at >= BOT_RESTART_RESET_AFTER:
+            self.consecutive_failures = 0
+            self.in_crash_loop = False
+
+    def to_dict(self, now):
+        return {
+            'restarts': self.restarts,
+            'consecutive_failures': self.consecutive_failures,
+            'crash_loops': self.crash_loops,
+            'in_crash_loop': self.in_crash_loop,
+            'last_failure': self.last_failure,
+            'last_failure_at': datetime.fromtimestamp(self.last_failure_at).isoformat() if self.last_failure_at else None,
+            'restart_in': round(max(self.next_restart_at - now, 0), 1) if self.next_restart_at is not None else None
+        }
+
 class BotManager:
     def __init__(self):
         self.bots = {}
+        # bot_id -> _BotHealth запущенных ботов
+        self._health = {}
+        # Запуск, остановка и замена экземпляра супервизором не выполняются одновременно
+        self._lock = threading.RLock()
+        # bot_id -> экземпляр, который супервизор останавливает перед заменой (его нет в self.bots)
+        self._replacing = {}
+        self._supervisor = None
+        self._supervisor_stopped = threading.Event()
 
-    def start_bot(self, bot_id):
-        try:
-            if bot_id in self.bots and self.bots[bot_id].running:
-                logging.warning(f"[BotManager] Бот [ID:{bot_id}] уже запущен")
-                return True
+    def start_bot(self, bot_id, lease_token=None):
+        """Запускает бота; lease_token - fencing-токен аренды бота этим узлом (модуль leases)."""
+        with self._lock:
+            try:
+                if bot_id in self.bots and self.bots[bot_id].running:
+                    if lease_token is not None:
+                        self.bots[bot_id].set_lease_token(lease_token)
+                    logging.warning(f"[BotManager] Бот [ID:{bot_id}] уже запущен")
+                    return True
+
+                if not flow_is_startable(bot_id):
+                    return False
+
+                bot_config = get_bot(bot_id)
+                if bot_config:
+                    bot_name = bot_config.get('name', f'Bot_{bot_id}')
+                else:
+                    bot_name = f'Bot_{bot_id}'
 
-            flow_data = get_bot_flow(bot_id)
-            if not flow_data or not flow_data.get('nodes'):
-                logging.error(f"[BotManager] Не удалось запустить бот [ID:{bot_id}]: flow не настроен")
+                bot_instance = BotInstance(bot_id)
+                bot_instance.set_lease_token(lease_token)
+                self.bots[bot_id] = bot_instance
+                self._health[bot_id] = _BotHealth()
+                bot_instance.start()
+                self._ensure_supervisor()
+                logging.info(f"[BotManager] Бот \"{bot_name}\" [ID:{bot_id}] успешно запущен\"")
+                return True
+            except Exception as e:
+                logging.error(f"[BotManager] Ошибка запуска бота [ID:{bot_id}]: {e}")
                 return False
-            start_node = next((n for n in flow_data.get('nodes', []) if n.get('isStart')), None)
-            if not start_node:
-                logging.error(f"[BotManager] Не удалось запустить бот [ID:{bot_id}]: нет стартовой ноды")
+
+    def stop_bot(self, bot_id, persist=True):
+        """Останавливает бота; persist=False - не записывать статус stopped (бот передаётся другому узлу)."""
+        with self._lock:
+            try:
+                self._health.pop(bot_id, None)
+                if bot_id in self.bots:
+                    bot_instance = self.bots[bot_id]
+                    bot_name = bot_instance.bot_name
+                    bot_instance.stop(persist)
+                    del self.bots[bot_id]
+                    logging.info(f"[BotManager] Бот \"{bot_name}\" [ID:{bot_id}] остановлен\"")
+                    return True
+                else:
+                    logging.warning(f"[BotManager] Бот [ID:{bot_id}] не найден среди запущенных")
+                    if persist:
+                        update_bot_status(bot_id, "stopped")
+                    return True
+            except Exception as e:
+                logging.error(f"[BotManager] Ошибка остановки бота [ID:{bot_id}]: {e}")
                 return False
 
-            bot_config = get_bot(bot_id)
-            if bot_config:
-                bot_name = bot_config.get('name', f'Bot_{bot_id}')
-            else:
-                bot_name = f'Bot_{bot_id}'
+    # ------------------------------------------------------------------
+    # Самовосстановление
+    # ------------------------------------------------------------------
 
-            self.bots[bot_id] = BotInstance(bot_id)
-            self.bots[bot_id].start()
-            logging.info(f"[BotManager] Бот \"{bot_name}\" [ID:{bot_id}] успешно запущен\"")
-            return True
-        except Exception as e:
-            logging.error(f"[BotManager] Ошибка запуска бота [ID:{bot_id}]: {e}")
-            return False
+    def _ensure_supervisor(self):
+        if self._supervisor is None:
+            self._supervisor_stopped.clear()
+            self._supervisor = threading.Thread(target=self._supervise_loop, name='bot-supervisor', daemon=True)
+            self._supervisor.start()
+
+    def _supervise_loop(self):
+        while not self._supervisor_stopped.wait(BOT_SUPERVISOR_INTERVAL):
+            try:
+                self._supervise()
+            except Exception as e:
+                logging.error(f"[BotManager] Ошибка супервизора ботов: {e}")
+
+    @staticmethod
+    def _detect_failure(bot_instance, now):
+        """Причина, по которой работающий бот нужно перезапустить, или None."""
+        if not (bot_instance.thread and bot_instance.thread.is_alive()):
+            error = bot_instance.crash_error
+            return f'поток бота завершился: {error!r}' if error else 'поток бота завершился'
+        if bot_instance.last_poll_at is not None and now - bot_instance.last_poll_at > BOT_STALL_TIMEOUT:
+            return f'нет успешного опроса обновлений {int(now - bot_instance.last_poll_at)} с'
+        return None
+
+    def _supervise(self):
+        """
+        Один проход супервизора: находит упавших и зависших ботов и перезапускает их.
+
+        Бот, остановленный штатно (running=False, например при потере аренды), не перезапускается.
+        """
+        now = time.monotonic()
+        for bot_id, bot_instance in list(self.bots.items()):
+            health = self._health.get(bot_id)
+            if health is None:
+                continue
+            if health.next_restart_at is None:
+                if not bot_instance.running:
+                    continue
+                failure = self._detect_failure(bot_instance, now)
+                if failure is None:
+                    health.record_healthy(now)
+                    continue
+                self._record_failure(bot_instance, health, failure, now)
+            if now >= health.next_restart_at:
+                self._restart_failed(bot_id, bot_instance, health)
+
+    @staticmethod
+    def _record_failure(bot_instance, health, reason, now):
+        entered_loop = health.record_failure(reason, now)
+        delay = health.next_restart_at - now
+        bot_instance.log('ERROR', f'Сбой бота: {reason}. Перезапуск через {delay:.0f} с '
+                                  f'(сбоев подряд: {health.consecutive_failures})', event='bot_failure')
+        if entered_loop:
+            bot_instance.log('ERROR', f'Цикл падений: {BOT_CRASH_LOOP_THRESHOLD} сбоев за '
+                                      f'{BOT_CRASH_LOOP_WINDOW:.0f} с, перезапуски продолжаются с задержкой '
+                                      f'до {BOT_RESTART_BACKOFF_MAX:.0f} с', event='crash_loop')
+
+    def _restart_failed(self, bot_id, bot_instance, health):
+        """
+        Заменяет упавший или зависший экземпляр бота новым с тем же токеном аренды.
+
+        Старый экземпляр останавливается (ожидание потока до 5 с) без блокировки,
+        чтобы команды запуска, остановки и запросы статусов не ждали супервизор.
+        Если за это время бота остановили или запустили заново, замена отменяется.
+        """
+        with self._lock:
+            if self.bots.get(bot_id) is not bot_instance or self._health.get(bot_id) is not health:
+                return
+            del self.bots[bot_id]
+            self._replacing[bot_id] = bot_instance
 
-    def stop_bot(self, bot_id):
         try:
-            if bot_id in self.bots:
-                bot_instance = self.bots[bot_id]
-                bot_name = bot_instance.bot_name
-                bot_instance.stop()
-                del self.bots[bot_id]
-                logging.info(f"[BotManager] Бот \"{bot_name}\" [ID:{bot_id}] остановлен\"")
-                return True
-            else:
-                logging.warning(f"[BotManager] Бот [ID:{bot_id}] не найден среди запущенных")
-                update_bot_status(bot_id, "stopped")
-                return True
-        except Exception as e:
-            logging.error(f"[BotManager] Ошибка остановки бота [ID:{bot_id}]: {e}")
-            return False
+            # Зависший поток не прервать: он завершится сам после возврата из блокирующего вызова
+            bot_instance.stop(persist=False)
+        finally:
+            with self._lock:
+                if self._replacing.get(bot_id) is bot_instance:
+                    del self._replacing[bot_id]
+
+        with self._lock:
+            if self._health.get(bot_id) is not health or bot_id in self.bots:
+                return
+            try:
+                new_instance = BotInstance(bot_id)
+                new_instance.set_lease_token(bot_instance.lease_token)
+                new_instance.start()
+            except Exception as e:
+                # Старый экземпляр возвращается на место: супервизор повторит замену после задержки
+                self.bots[bot_id] = bot_instance
+                self._record_failure(bot_instance, health, f'не удалось перезапустить: {e}', time.monotonic())
+                return
+            self.bots[bot_id] = new_instance
+            health.record_restart(time.monotonic())
+            new_instance.log('WARNING', f'Бот перезапущен супервизором (перезапусков: {health.restarts})',
+                             event='bot_restart')
+
+    def get_bot_health(self, bot_id):
+        """Перезапуски, сбои и циклы падений запущенного бота или None, если бот не запущен."""
+        health = self._health.get(bot_id)
+        bot_instance = self._instance(bot_id)
+        if health is None or bot_instance is None:
+            return None
+        now = time.monotonic()
+        info = health.to_dict(now)
+        info['status'] = self._instance_status(bot_id, bot_instance)
+        info['last_poll_age'] = round(now - bot_instance.last_poll_at, 1) if bot_instance.last_poll_at else None
+        return info
+
+    def _instance_status(self, bot_id, bot_instance):
+        """Статус бота, экземпляр которого есть в self.bots: running, restarting или stopped."""
+        health = self._health.get(bot_id)
+        if health is not None and health.next_restart_at is not None:
+            return "restarting"
+        if bot_instance.running:
+            # Упавший поток супервизор заметит при ближайшей проверке
+            return "running" if bot_instance.thread and bot_instance.thread.is_alive() else "restarting"
+        return "stopped"
+
+    def _instance(self, bot_id):
+        """Экземпляр бота, в том числе заменяемый супервизором в этот момент."""
+        return self.bots.get(bot_id) or self._replacing.get(bot_id)
 
     def get_bot_status(self, bot_id):
-        if bot_id in self.bots:
-            bot_instance = self.bots[bot_id]
-            if bot_instance.thread and bot_instance.thread.is_alive():
-                return "running" if bot_instance.running else "stopped"
-            if bot_instance.running:
-                bot_instance.running = False
-                update_bot_status(bot_id, "stopped")
-            return "stopped"
+        bot_instance = self._instance(bot_id)
+        if bot_instance is not None:
+            return self._instance_status(bot_id, bot_instance)
         bot = get_bot(bot_id)
         return bot['status'] if bot else None
 
+    def get_bot_statuses(self, stored_statuses):
+        """Статусы нескольких ботов за один проход по self.bots, без обращений к БД.
+
+        Args:
+            stored_statuses (dict): bot_id -> статус из БД (например, из get_bot_summaries);
+                используется для ботов, которые не запущены в этом процессе
+
+        Returns:
+            dict: bot_id -> статус
+        """
+        statuses = dict(stored_statuses)
+        instances = dict(self._replacing)
+        instances.update(self.bots)
+        for bot_id, bot_instance in instances.items():
+            if bot_id in statuses:
+                statuses[bot_id] = self._instance_status(bot_id, bot_instance)
+        return statuses
+
+    def get_recent_logs(self, bot_id, limit=100):
+        """Возвращает последние логи запущенного бота из памяти (см. BotInstance.get_recent_logs).
+
+        Возвращает None, если бот не запущен, — в этом случае логи читаются из базы данных.
+        """
+        bot_instance = self.bots.get(bot_id)
+        if not bot_instance:
+            return None
+        return bot_instance.get_recent_logs(limit)
+
+    def clear_recent_logs(self, bot_id):
+        """Очищает буфер последних логов запущенного бота."""
+        bot_instance = self.bots.get(bot_id)
+        if bot_instance:
+            bot_instance.clear_recent_logs()
+
+    def get_session_stats(self, bot_id):
+        """Возвращает статистику хранилища состояний чатов запущенного бота или None."""
+        bot_instance = self.bots.get(bot_id)
+        if not bot_instance:
+            return None
+        return bot_instance.user_states.stats()
+
+    def reload_flow(self, bot_id):
+        """Перезагружает flow запущенного бота. Возвращает False, если бот не запущен."""
+        bot_instance = self.bots.get(bot_id)
+        if not bot_instance:
+            return False
+        bot_instance.reload_flow()
+        return True
+
+    def reload_restriction(self, bot_id):
+        """Перезагружает настройки ограничения текста запущенного бота. Возвращает False, если бот не запущен."""
+        bot_instance = self.bots.get(bot_id)
+        if not bot_instance:
+            return False
+        bot_instance.reload_restriction_settings()
+        return True
+
+    def reload_custom_commands(self, bot_id):
+        """Перезагружает пользовательские команды запущенного бота. Возвращает False, если бот не запущен."""
+        bot_instance = self.bots.get(bot_id)
+        if not bot_instance:
+            return False
+        bot_instance.reload_custom_commands()
+        return True
+
+    def start_saved_bots(self):
+        """Запускает ботов, которые по данным БД должны работать. Возвращает их ID."""
+        started = []
+        for bot in get_bot_summaries():
+            if bot['status'] == 'running' and self.start_bot(bot['id']):
+                started.append(bot['id'])
+        return started
+
+    def api_cache_stats(self):
+        """Статистика кэша ответов нод api_request этого процесса."""
+        return response_cache.stats()
+
+    def upstream_stats(self):
+        """Метрики внешних API этого процесса по хостам."""
+        return upstreams.stats()
+
+    def ping(self):
+        """Проверка доступности для канала управления: PID процесса, число ботов и их перезапусков."""
+        health = list(self._health.values())
+        return {
+            'pid': os.getpid(),
+            'bots': len(self.bots),
+            'bot_restarts': sum(item.restarts for item in health),
+            'crash_loops': sum(item.in_crash_loop for item in health)
+        }
+
+    def shutdown(self):
+        """
+        Останавливает всех ботов при завершении процесса.
+
+        Боты останавливаются параллельно, статус running в БД сохраняется,
+        поэтому при следующем запуске start_saved_bots() поднимет их снова.
+        """
+        self._supervisor_stopped.set()
+        if self._supervisor is not None:
+            self._supervisor.join()
+            self._supervisor = None
+        self._health.clear()
+        stoppers = [
+            threading.Thread(target=bot_instance.stop, kwargs={'persist': False})
+            for bot_instance in list(self.bots.values())
+        ]
+        for stopper in stoppers:
+            stopper.start()
+        for stopper in stoppers:
+            stopper.join()
+        self.bots.clear()
+
     def restart_bot(self, bot_id):
         bot_config = get_bot(bot_id)
         if not bot_config:
@@ -0,0 +1,392 @@
+"""
+Модуль bot_pool.py
+==================
+
+Режим пула процессов: боты распределяются по нескольким рабочим процессам.
+
+Все боты одного процесса делят один GIL, поэтому тяжёлая работа одного бота
+(разбор больших пачек обновлений, вычисление выражений, шаблоны) замедляет
+остальных. В режиме пула раннер (runner.py) запускает BOT_RUNNER_WORKERS
+рабочих процессов, каждый со своим BotManager и своим сокетом управления
+(runner_ipc), и сам становится супервизором:
+
+- бот закреплён за процессом по консистентному хешу bot_id (HashRing): при
+  изменении числа процессов переезжает лишь около 1/N ботов;
+- PoolBotManager предоставляет интерфейс BotManager и передаёт команду по боту
+  процессу-владельцу; статусы и сводка пула собираются со всех процессов;
+- поток проверки раз в BOT_POOL_HEALTH_INTERVAL секунд проверяет процессы: упавший
+  или не отвечающий BOT_POOL_PING_FAILURES проверок подряд процесс перезапускается,
+  и запущенные в нём боты запускаются снова с теми же аргументами (в том числе
+  с fencing-токеном аренды, если раннер работает в режиме аренд).
+
+Рабочие процессы создаются методом spawn, не наследуя потоки и соединения с БД
+супервизора. Логи ботов пишутся каждым процессом в общую БД и свои сегменты
+архива; последние логи запрашиваются у процесса-владельца.
+
+Настройки через переменные окружения:
+    BOT_RUNNER_WORKERS        - число рабочих процессов (1 - без пула, 0 - по числу ядер)
+    BOT_POOL_HEALTH_INTERVAL  - период проверки процессов в секундах (по умолчанию 2)
+    BOT_POOL_PING_TIMEOUT     - ожидание ответа процесса на проверку в секундах (по умолчанию 5)
+    BOT_POOL_PING_FAILURES    - проверок без ответа подряд до перезапуска (по умолчанию 3)
+"""
+
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+from database import get_bot_summaries
+from runner_ipc import RemoteBotManager, RunnerUnavailable, serve_until_stopped
+
+BOT_RUNNER_WORKERS = int(os.environ.get('BOT_RUNNER_WORKERS', 1)) or os.cpu_count() or 1
+BOT_POOL_HEALTH_INTERVAL = float(os.environ.get('BOT_POOL_HEALTH_INTERVAL', 2))
+BOT_POOL_PING_TIMEOUT = float(os.environ.get('BOT_POOL_PING_TIMEOUT', 5))
+BOT_POOL_PING_FAILURES = int(os.environ.get('BOT_POOL_PING_FAILURES', 3))
+
+# Виртуальных точек на процесс в кольце: сглаживает неравномерность распределения
+RING_REPLICAS = 64
+# Сколько ждать, пока новый рабочий процесс откроет сокет
+WORKER_START_TIMEOUT = 30
+
+logger = logging.getLogger(__name__)
+
+
+def _ring_hash(value):
+    return int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Консистентное хеширование ключей по узлам.
+
+    Attributes:
+        nodes (tuple): Узлы кольца
+    """
+
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        self.nodes = tuple(nodes)
+        points = sorted(
+            (_ring_hash(f'{node}#{replica}'), node)
+            for node in self.nodes for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, key):
+        """Узел, которому принадлежит ключ: первая точка кольца по часовой стрелке от хеша ключа."""
+        position = bisect.bisect(self._hashes, _ring_hash(key)) % len(self._hashes)
+        return self._owners[position]
+
+
+def _worker_main(path):
+    """Точка входа рабочего процесса: свой BotManager за сокетом path."""
+    from bot_manager import bot_manager
+    # Ctrl+C в терминале получает вся группа процессов; рабочими процессами управляет супервизор
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    serve_until_stopped(path, bot_manager, stop_signals=(signal.SIGTERM,))
+
+
+class _Worker:
+    """Рабочий процесс пула и клиенты его канала управления."""
+
+    def __init__(self, index, path):
+        self.index = index
+        self.path = path
+        self.process = None
+        self.client = RemoteBotManager(path)
+        self.probe = RemoteBotManager(path, timeout=BOT_POOL_PING_TIMEOUT)
+        self.restarts = 0
+        self.ping_failures = 0
+        self.started_at = None
+        self.last_exit = None
+
+
+# Поля статистики кэша api_request, которые складываются по рабочим процессам
+_CACHE_COUNTERS = ('size', 'max_entries', 'inflight', 'hits', 'misses', 'coalesced', 'evictions', 'expirations')
+_UPSTREAM_COUNTERS = ('in_flight', 'max_concurrency', 'requests', 'failures', 'rejected',
+                      'short_circuited', 'breaker_trips')
+# Порядок состояний breaker от лучшего к худшему
+_BREAKER_SEVERITY = ('closed', 'half_open', 'open')
+
+
+def _weighted(items, value):
+    pairs = [(value(item), item['requests']) for item in items if value(item) is not None]
+    weight = sum(requests for _, requests in pairs)
+    if not weight:
+        return pairs[0][0] if pairs else None
+    return round(sum(number * requests for number, requests in pairs) / weight, 4)
+
+
+def _merge_upstream(host, items):
+    """Сводит метрики одного хоста из нескольких рабочих процессов."""
+    merged = {'host': host}
+    merged['state'] = max((item['state'] for item in items), key=_BREAKER_SEVERITY.index)
+    merged.update({field: sum(item[field] for item in items) for field in _UPSTREAM_COUNTERS})
+    merged['error_rate'] = _weighted(items, lambda item: item['error_rate'])
+    latencies = [item['latency_ms'] for item in items]
+
+    def largest(key):
+        values = [latency[key] for latency in latencies if latency[key] is not None]
+        return max(values) if values else None
+
+    avg = _weighted(items, lambda item: item['latency_ms']['avg'])
+    merged['latency_ms'] = {
+        'avg': round(avg, 1) if avg is not None else None,
+        'p50': largest('p50'),
+        'p95': largest('p95'),
+        'max': largest('max')
+    }
+    merged['workers'] = len(items)
+    return merged
+
+
+def _route(method):
+    def call(self, bot_id, *args):
+        return getattr(self._owner(bot_id).client, method)(bot_id, *args)
+    call.__name__ = method
+    return call
+
+
+class PoolBotManager:
+    """
+    Супервизор пула рабочих процессов с интерфейсом BotManager.
+
+    Attributes:
+        workers (list): Рабочие процессы в порядке индексов
+    """
+
+    def __init__(self, size, socket_dir):
+        self.workers = [_Worker(index, os.path.join(socket_dir, f'worker-{index}.sock')) for index in range(size)]
+        self.ring = HashRing(range(size))
+        self._context = multiprocessing.get_context('spawn')
+        self._stopping = threading.Event()
+        self._health_thread = None
+        self._restart_lock = threading.Lock()
+        # bot_id -> аргументы start_bot ботов, запущенных через пул (start_bot, restart_bot, start_saved_bots):
+        # с ними боты поднимаются после перезапуска процесса
+        self._running = {}
+
+    def _owner(self, bot_id):
+        return self.workers[self.ring.node_for(bot_id)]
+
+    # ------------------------------------------------------------------
+    # Жизненный цикл процессов
+    # ------------------------------------------------------------------
+
+    def start(self):
+        """Запускает рабочие процессы, дожидается их готовности и запускает проверку здоровья."""
+        for worker in self.workers:
+            self._spawn(worker)
+        for worker in self.workers:
+            self._wait_ready(worker)
+        self._health_thread = threading.Thread(target=self._health_loop, name='bot-pool-health', daemon=True)
+        self._health_thread.start()
+        logger.info(f"[BotPool] Запущено рабочих процессов: {len(self.workers)}")
+
+    def _spawn(self, worker):
+        worker.process = self._context.Process(
+            target=_worker_main, args=(worker.path,), name=f'bot-worker-{worker.index}'
+        )
+        worker.process.start()
+        worker.started_at = time.time()
+        worker.ping_failures = 0
+
+    def _wait_ready(self, worker):
+        """Ждёт, пока процесс откроет сокет. Возвращает False, если процесс не поднялся."""
+        deadline = time.monotonic() + WORKER_START_TIMEOUT
+        while time.monotonic() < deadline and worker.process.is_alive():
+            try:
+                worker.probe.ping()
+                return True
+            except RunnerUnavailable:
+                time.sleep(0.1)
+        logger.error(f"[BotPool] Рабочий процесс {worker.index} не запустился")
+        return False
+
+    def _restart(self, worker, reason):
+        with self._restart_lock:
+            if self._stopping.is_set():
+                return
+            logger.warning(f"[BotPool] Перезапуск рабочего процесса {worker.index} "
+                           f"(PID {worker.process.pid}): {reason}")
+            if worker.process.is_alive():
+                worker.process.kill()
+            worker.process.join(timeout=5)
+            worker.last_exit = worker.process.exitcode
+            worker.restarts += 1
+            self._spawn(worker)
+            if not self._wait_ready(worker):
+                return
+            started = 0
+            for bot_id, args in list(self._running.items()):
+                if self._owner(bot_id) is not worker:
+                    continue
+                try:
+                    started += bool(worker.client.start_bot(bot_id, *args))
+                except RunnerUnavailable as e:
+                    logger.error(f"[BotPool] Не удалось запустить бот [ID:{bot_id}]: {e}")
+            logger.info(f"[BotPool] Рабочий процесс {worker.index} перезапущен, ботов запущено: {started}")
+
+    def _health_loop(self):
+        while not self._stopping.wait(BOT_POOL_HEALTH_INTERVAL):
+            self.check_workers()
+
+    def check_workers(self):
+        """Одна проверка здоровья: перезапускает упавшие и переставшие отвечать процессы."""
+        for worker in self.workers:
+            if self._stopping.is_set():
+                return
+            if not worker.process.is_alive():
+                self._restart(worker, f'процесс завершился с кодом {worker.process.exitcode}')
+                continue
+            try:
+                worker.probe.ping()
+                worker.ping_failures = 0
+            except RunnerUnavailable as e:
+                worker.ping_failures += 1
+                logger.warning(f"[BotPool] Рабочий процесс {worker.index} не ответил на проверку: {e}")
+                if worker.ping_failures >= BOT_POOL_PING_FAILURES:
+                    self._restart(worker, f'не отвечает {worker.ping_failures} проверок подряд')
+
+    def shutdown(self):
+        """Останавливает рабочие процессы; они останавливают своих ботов, сохраняя статус running."""
+        self._stopping.set()
+        with self._restart_lock:
+            for worker in self.workers:
+                if worker.process is not None and worker.process.is_alive():
+                    worker.process.terminate()
+            for worker in self.workers:
+                if worker.process is None:
+                    continue
+                worker.process.join(timeout=15)
+                if worker.process.is_alive():
+                    logger.error(f"[BotPool] Рабочий процесс {worker.index} не остановился, завершаем принудительно")
+                    worker.process.kill()
+                    worker.process.join()
+
+    # ------------------------------------------------------------------
+    # Интерфейс BotManager
+    # ------------------------------------------------------------------
+
+    def start_bot(self, bot_id, *args):
+        started = self._owner(bot_id).client.start_bot(bot_id, *args)
+        if started:
+            self._running[bot_id] = args
+        return started
+
+    def stop_bot(self, bot_id, *args):
+        self._running.pop(bot_id, None)
+        return self._owner(bot_id).client.stop_bot(bot_id, *args)
+
+    def restart_bot(self, bot_id):
+        """Перезапускает бота в его процессе; бот запоминается, чтобы подняться после перезапуска процесса."""
+        restarted = self._owner(bot_id).client.restart_bot(bot_id)
+        if restarted:
+            # BotManager.restart_bot запускает бота без аргументов start_bot
+            self._running[bot_id] = ()
+        else:
+            self._running.pop(bot_id, None)
+        return restarted
+
+    reload_flow = _route('reload_flow')
+    reload_restriction = _route('reload_restriction')
+    reload_custom_commands = _route('reload_custom_commands')
+    get_bot_status = _route('get_bot_status')
+    get_recent_logs = _route('get_recent_logs')
+    clear_recent_logs = _route('clear_recent_logs')
+    get_session_stats = _route('get_session_stats')
+    get_bot_health = _route('get_bot_health')
+
+    def get_bot_statuses(self, stored_statuses):
+        """Статусы ботов: каждый процесс отвечает за свою часть одним запросом."""
+        stored_statuses = dict(stored_statuses)
+        by_worker = {}
+        for bot_id, status in stored_statuses.items():
+            by_worker.setdefault(self._owner(bot_id), {})[bot_id] = status
+        statuses = {}
+        for worker, part in by_worker.items():
+            try:
+                statuses.update(worker.client.get_bot_statuses(part))
+            except RunnerUnavailable:
+                # Процесс перезапускается: его боты поднимутся вместе с ним
+                statuses.update(part)
+        return statuses
+
+    def _collect(self, method):
+        """Результаты method со всех доступных рабочих процессов."""
+        results = []
+        for worker in self.workers:
+            try:
+                results.append(getattr(worker.client, method)())
+            except RunnerUnavailable as e:
+                logger.warning(f"[BotPool] Рабочий процесс {worker.index} не вернул {method}: {e}")
+        return results
+
+    def api_cache_stats(self):
+        """Статистика кэшей api_request всех рабочих процессов: счётчики и размеры суммируются."""
+        parts = self._collect('api_cache_stats')
+        merged = {field: sum(part[field] for part in parts) for field in _CACHE_COUNTERS}
+        lookups = merged['hits'] + merged['misses'] + merged['coalesced']
+        merged['hit_rate'] = round((merged['hits'] + merged['coalesced']) / lookups, 4) if lookups else None
+        merged['workers'] = len(parts)
+        return merged
+
+    def upstream_stats(self):
+        """
+        Метрики внешних API по хостам со всех рабочих процессов.
+
+        Счётчики суммируются; состояние breaker - худшее среди процессов (у каждого
+        процесса свой breaker); средняя задержка и доля ошибок взвешиваются по числу
+        запросов, p50/p95/max - наибольшие среди процессов.
+        """
+        by_host = {}
+        for part in self._collect('upstream_stats'):
+            for item in part:
+                by_host.setdefault(item['host'], []).append(item)
+        return [_merge_upstream(host, items) for host, items in by_host.items()]
+
+    def start_saved_bots(self):
+        """Запускает ботов со статусом running, каждого в его рабочем процессе."""
+        started = []
+        for bot in get_bot_summaries():
+            if bot['status'] != 'running':
+                continue
+            try:
+                if self.start_bot(bot['id']):
+                    started.append(bot['id'])
+            except RunnerUnavailable as e:
+                logger.error(f"[BotPool] Не удалось запустить бот [ID:{bot['id']}]: {e}")
+        return started
+
+    def ping(self):
+        """Сводка пула: PID супервизора, число ботов и состояние каждого рабочего процесса."""
+        workers = []
+        for worker in self.workers:
+            info = {
+                'index': worker.index,
+                'pid': worker.process.pid if worker.process else None,
+                'alive': bool(worker.process and worker.process.is_alive()),
+                'bots': None,
+                'bot_restarts': None,
+                'restarts': worker.restarts,
+                'last_exit': worker.last_exit,
+                'started_at': worker.started_at
+            }
+            if info['alive']:
+                try:
+                    probe = worker.probe.ping()
+                    info['bots'] = probe['bots']
+                    info['bot_restarts'] = probe['bot_restarts']
+                except RunnerUnavailable:
+                    info['alive'] = False
+            workers.append(info)
+        return {
+            'pid': os.getpid(),
+            'bots': sum(info['bots'] or 0 for info in workers),
+            'bot_restarts': sum(info['bot_restarts'] or 0 for info in workers),
+            'workers': workers
+        }
@@ -0,0 +1,87 @@
+"""
+Модуль compiled_flow.py
+=======================
+
+Скомпилированное представление flow для горячего пути обработки обновлений.
+
+Flow хранится и редактируется как JSON ({nodes, connections}); при обработке
+каждого нажатия бот искал ноду и соединение линейным проходом по спискам.
+CompiledFlow один раз строит индексы: ноды нумеруются по порядку, их ID
+интернируются, а переходы по кнопкам и автопереходы раскладываются по словарям.
+Состояние чата хранит номер ноды (int) и ссылку на общий CompiledFlow.
+Ноды api_request компилируются в ApiRequestSpec, ноды fan_out - в FanOutSpec тогда же.
+"""
+
+import sys
+
+from api_request import ApiRequestSpec
+from fan_out import FanOutSpec
+
+
+class CompiledFlow:
+    """
+    Неизменяемые индексы одного flow.
+
+    Attributes:
+        nodes (list): Ноды в исходном порядке (словари из flow_data)
+        ids (list): Интернированные ID нод, ids[i] - ID ноды nodes[i]
+        index (dict): ID ноды -> её номер
+        auto_targets (dict): ID ноды -> ID цели первого соединения без кнопки
+        button_targets (dict): ID кнопки -> ID цели её соединения
+        typed_targets (dict): (ID ноды, тип соединения) -> ID цели; типы success/error
+            у api_request и fan_out
+        api_requests (dict): Номер ноды api_request -> ApiRequestSpec
+        fan_outs (dict): Номер ноды fan_out -> FanOutSpec
+        errors (dict): ID ноды -> описание ошибки компиляции
+    """
+
+    __slots__ = ('nodes', 'ids', 'index', 'auto_targets', 'button_targets', 'typed_targets',
+                 'api_requests', 'fan_outs', 'errors')
+
+    def __init__(self, flow_data):
+        flow_data = flow_data or {}
+        self.nodes = flow_data.get('nodes', [])
+        self.ids = [sys.intern(str(node['id'])) for node in self.nodes]
+        self.index = {}
+        for i, node_id in enumerate(self.ids):
+            self.index.setdefault(node_id, i)
+
+        self.auto_targets = {}
+        self.button_targets = {}
+        self.typed_targets = {}
+        for connection in flow_data.get('connections', []):
+            target = connection.get('to')
+            if target is not None:
+                target = sys.intern(str(target))
+            button_id = connection.get('buttonId')
+            if button_id:
+                self.button_targets.setdefault(button_id, target)
+            elif connection.get('from') is None:
+                continue
+            elif connection.get('type'):
+                self.typed_targets.setdefault((str(connection['from']), connection['type']), target)
+            else:
+                self.auto_targets.setdefault(str(connection['from']), target)
+
+        self.api_requests = {}
+        self.fan_outs = {}
+        self.errors = {}
+        for position, node in enumerate(self.nodes):
+            try:
+                if node.get('type') == 'api_request':
+                    self.api_requests[position] = ApiRequestSpec(node)
+                elif node.get('type') == 'fan_out':
+                    self.fan_outs[position] = FanOutSpec(node)
+            except ValueError as e:
+                self.errors[self.ids[position]] = str(e)
+
+    def __bool__(self):
+        return bool(self.nodes)
+
+    def find(self, node_id):
+        """Возвращает номер ноды по ID или -1."""
+        return self.index.get(node_id, -1)
+
+    def node_at(self, position):
+        """Возвращает ноду по номеру или None."""
+        return self.nodes[position] if position >= 0 else None
@@ -1,35 +1,553 @@
 import sqlite3
+import copy
 import json
+import hashlib
+import zlib
+import logging
 import os
+import queue
+import threading
+import atexit
+from collections import namedtuple
+from collections.abc import Mapping
+from concurrent.futures import Future
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
+from urllib.parse import quote
+
+from json_patch import apply_patch, make_patch
 
 # Определяем базовую директорию проекта (директория, содержащая src/)
 BASE_DIR = Path(__file__).parent.parent
 DB_FILE = str(BASE_DIR / 'data' / 'db' / 'bots_data.db')
 LOGS_DIR = str(BASE_DIR / 'data' / 'logs')
+SHARDS_DIR = str(BASE_DIR / 'data' / 'db' / 'bots')
+
+# Схема хранения:
+# 'single'  - все данные в DB_FILE;
+# 'per_bot' - каталог (bots, bot_flows, custom_commands) в DB_FILE,
+#             логи и прочие данные каждого бота в отдельном файле SHARDS_DIR/bot_<id>.db
+DB_LAYOUT = os.environ.get('DB_LAYOUT', 'single')
+
+# Каждая FLOW_SNAPSHOT_INTERVAL-я ревизия flow хранится полным снимком, остальные - дельтами
+FLOW_SNAPSHOT_INTERVAL = int(os.environ.get('FLOW_SNAPSHOT_INTERVAL', 20))
 
 # Флаг для отслеживания инициализации БД
 _db_initialized = False
 
+# Настройки, применяемые к каждому новому соединению.
+# WAL позволяет читателям работать параллельно с писателем,
+# busy_timeout заменяет ручные повторы при "database is locked".
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -16000),       # ~16 МБ кеша страниц на соединение
+    ('mmap_size', 268435456),     # 256 МБ memory-mapped I/O
+    ('busy_timeout', 5000),
+    ('temp_store', 'MEMORY'),
+)
+
+# Сколько простаивающих соединений держит пул
+POOL_MAX_IDLE = 8
+
+class _PooledConnection(sqlite3.Connection):
+    """Соединение пула; data_version - значение PRAGMA data_version при последней проверке кеша (_check_catalog)."""
+    data_version = None
+
+class _ConnectionPool:
+    """
+    Пул постоянных соединений с одним файлом SQLite.
+    
+    Соединение открывается и настраивается один раз, затем переиспользуется
+    между вызовами и потоками. Одновременно соединение используется только одним потоком.
+    Пул с create=False не создаёт отсутствующий файл (файлы ботов создаёт только _init_shard).
+    """
+    
+    def __init__(self, path, max_idle=POOL_MAX_IDLE, create=True):
+        self.path = path
+        self.max_idle = max_idle
+        self.create = create
+        self._idle = []
+        self._lock = threading.Lock()
+    
+    def _open(self):
+        if self.create:
+            conn = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False, factory=_PooledConnection)
+        else:
+            conn = sqlite3.connect(f'file:{quote(self.path)}?mode=rw', timeout=5.0,
+                                   check_same_thread=False, uri=True, factory=_PooledConnection)
+        for name, value in SQLITE_PRAGMAS:
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+    
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._open()
+    
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+    
+    def close_all(self):
+        """Закрывает все простаивающие соединения."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+# Максимальное количество операций, объединяемых в одну транзакцию
+WRITE_BATCH_SIZE = 256
+
+# Сколько старых логов удаляется одной транзакцией при очистке (prune_bot_logs)
+PRUNE_BATCH_SIZE = 5000
+
+logger = logging.getLogger(__name__)
+
+# Результат операции записи: id вставленной строки и число затронутых строк
+WriteResult = namedtuple('WriteResult', ['lastrowid', 'rowcount'])
+
+class _WriteQueue:
+    """
+    Единственный поток-писатель для файла SQLite.
+    
+    Все изменения данных выполняются в этом потоке: операции из очереди
+    собираются в пачки до WRITE_BATCH_SIZE и фиксируются одной транзакцией.
+    Каждая операция выполняется в своей точке сохранения (SAVEPOINT), поэтому
+    ошибка одной операции не откатывает остальные операции пачки.
+    """
+    
+    def __init__(self, path, batch_size=WRITE_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+    
+    def submit(self, operation):
+        """
+        Ставит операцию в очередь записи.
+        
+        Args:
+            operation: Функция, принимающая курсор; её результат станет результатом Future
+        
+        Returns:
+            Future: Завершается после фиксации транзакции с этой операцией
+        """
+        future = Future()
+        self._ensure_started()
+        self._queue.put((operation, future))
+        return future
+    
+    def flush(self):
+        """Дожидается записи всех операций, поставленных в очередь ранее."""
+        if self._thread is not None:
+            self.submit(lambda cursor: None).result()
+    
+    def close(self):
+        """Записывает оставшиеся операции и останавливает поток-писатель."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+    
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+    
+    def _run(self):
+        conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None, check_same_thread=False)
+        for name, value in SQLITE_PRAGMAS:
+            conn.execute(f'PRAGMA {name} = {value}')
+        
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            batch = []
+            if item is None:
+                stop = True
+            else:
+                batch.append(item)
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    continue
+                batch.append(item)
+            if batch:
+                self._execute_batch(conn, batch)
+        
+        conn.close()
+    
+    def _execute_batch(self, conn, batch):
+        results = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.cursor()
+            for operation, future in batch:
+                cursor.execute('SAVEPOINT write_op')
+                try:
+                    results.append((future, operation(cursor), None))
+                    cursor.execute('RELEASE write_op')
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO write_op')
+                    cursor.execute('RELEASE write_op')
+                    results.append((future, None, e))
+            conn.execute('COMMIT')
+        except Exception as e:
+            logger.error(f"[database] Ошибка записи пачки из {len(batch)} операций: {e}")
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+# Пулы соединений и потоки-писатели по пути к файлу БД
+_pools = {}
+_writers = {}
+_routing_lock = threading.Lock()
+_initialized_shards = set()
+# Создание, выбор и удаление файлов ботов (схема 'per_bot'): запись в файл бота ставится
+# в очередь под этой блокировкой, поэтому удаление файла не пересекается с записью в него
+_shard_lock = threading.RLock()
+
+def _shard_path(bot_id):
+    return os.path.join(SHARDS_DIR, f'bot_{bot_id}.db')
+
+def _db_path(bot_id=None):
+    """
+    Возвращает файл БД, в котором хранятся данные бота.
+    
+    В схеме 'single' и для данных каталога (bot_id=None) это DB_FILE,
+    в схеме 'per_bot' - отдельный файл бота, который создаётся при первом обращении.
+    Функции чтения сначала проверяют _shard_exists, поэтому файл создают только записи.
+    
+    Файл создаётся только для бота из каталога: запись, пришедшая после удаления бота
+    (например, последний лог его потока опроса), не создаёт файл заново.
+    
+    Raises:
+        LookupError: Файла бота нет, а самого бота нет в каталоге
+    """
+    if bot_id is None or DB_LAYOUT != 'per_bot':
+        return DB_FILE
+    path = _shard_path(bot_id)
+    if path in _initialized_shards and os.path.exists(path):
+        return path
+    with _shard_lock:
+        if path in _initialized_shards:
+            if os.path.exists(path):
+                return path
+            # Файл удалён другим процессом (delete_bot в процессе веб-интерфейса)
+            _forget_shard(path)
+        if not os.path.exists(path) and not _bot_in_catalog(bot_id):
+            raise LookupError(f"Бот {bot_id} не найден: файл БД бота не создаётся")
+        _init_shard(path)
+    return path
+
+def _bot_in_catalog(bot_id):
+    with _connect() as conn:
+        return conn.execute('SELECT 1 FROM bots WHERE id = ?', (bot_id,)).fetchone() is not None
+
+def _shard_exists(bot_id):
+    """
+    Есть ли БД, в которой лежат данные бота.
+    
+    В схеме 'per_bot' файл бота создаётся только записью: чтение логов и состояний
+    чатов несуществующего (или ещё ничего не записавшего) бота не должно создавать
+    и мигрировать пустой файл.
+    """
+    if bot_id is None or DB_LAYOUT != 'per_bot':
+        return True
+    return os.path.exists(_shard_path(bot_id))
+
+def _pool_for(path):
+    pool = _pools.get(path)
+    if pool is None:
+        with _routing_lock:
+            pool = _pools.setdefault(path, _ConnectionPool(path, create=path == DB_FILE))
+    return pool
+
+def _writer_for(path):
+    writer = _writers.get(path)
+    if writer is None:
+        with _routing_lock:
+            writer = _writers.setdefault(path, _WriteQueue(path))
+    return writer
+
+def _shard_bot_ids():
+    """Возвращает ID ботов, для которых существуют отдельные файлы БД."""
+    if not os.path.isdir(SHARDS_DIR):
+        return []
+    bot_ids = []
+    for name in os.listdir(SHARDS_DIR):
+        if name.startswith('bot_') and name.endswith('.db'):
+            try:
+                bot_ids.append(int(name[4:-3]))
+            except ValueError:
+                continue
+    return sorted(bot_ids)
+
+def _log_database_bot_ids():
+    """Ключи маршрутизации всех БД, в которых хранятся логи."""
+    if DB_LAYOUT == 'per_bot':
+        return _shard_bot_ids()
+    return [None]
+
+def _forget_shard(path):
+    """Дописывает очередь записи и закрывает соединения файла бота. Вызывается под _shard_lock."""
+    with _routing_lock:
+        writer = _writers.pop(path, None)
+        pool = _pools.pop(path, None)
+        _initialized_shards.discard(path)
+    if writer is not None:
+        writer.close()
+    if pool is not None:
+        pool.close_all()
+
+def _drop_shard(bot_id):
+    """Останавливает писателя, закрывает соединения и удаляет файл БД бота."""
+    path = _shard_path(bot_id)
+    with _shard_lock:
+        _forget_shard(path)
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+
+def _close_all():
+    """Дописывает очереди записи и закрывает все соединения."""
+    for writer in list(_writers.values()):
+        writer.close()
+    for pool in list(_pools.values()):
+        pool.close_all()
+
+atexit.register(_close_all)
+
+def _sql_operation(sql, params=()):
+    """Создаёт операцию записи из одного SQL-выражения."""
+    def operation(cursor):
+        cursor.execute(sql, params)
+        return WriteResult(cursor.lastrowid, cursor.rowcount)
+    return operation
+
+def _submit_write(operation, bot_id=None):
+    """Ставит операцию в очередь потока-писателя БД бота и возвращает Future."""
+    if bot_id is None or DB_LAYOUT != 'per_bot':
+        return _writer_for(DB_FILE).submit(operation)
+    with _shard_lock:
+        return _writer_for(_db_path(bot_id)).submit(operation)
+
+def _write(sql, params=(), bot_id=None):
+    """Выполняет SQL-выражение через поток-писатель и дожидается фиксации."""
+    return _submit_write(_sql_operation(sql, params), bot_id).result()
+
+def _report_failed_write(future):
+    """Сообщает об ошибке записи, результат которой никто не ждёт."""
+    error = future.exception()
+    if error is not None:
+        logger.error(f"[database] Ошибка фоновой записи: {error}")
+
+@contextmanager
+def _connect(bot_id=None):
+    """
+    Выдаёт соединение из пула БД, в которой хранятся данные бота (см. _db_path).
+    
+    При успешном выходе из блока транзакция фиксируется, при исключении — откатывается.
+    """
+    if bot_id is None or DB_LAYOUT != 'per_bot':
+        pool = _pool_for(DB_FILE)
+    else:
+        with _shard_lock:
+            pool = _pool_for(_db_path(bot_id))
+    conn = pool.acquire()
+    try:
+        yield conn
+        if conn.in_transaction:
+            conn.commit()
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        pool.release(conn)
+
+# ==========================================================================
+# Кеш ботов, flow и пользовательских команд
+# ==========================================================================
+
+_MISSING = object()
+
+class _EntityCache:
+    """
+    Кеш одного типа сущностей с версиями ключей.
+    
+    Каждое изменение ключа увеличивает его версию. Значение, прочитанное из БД,
+    попадает в кеш, только если версия ключа не изменилась за время чтения,
+    поэтому запись, завершившаяся во время чтения, не оставит в кеше устаревшее значение.
+    """
+    
+    def __init__(self):
+        self._data = {}
+        self._versions = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        return self._data.get(key, _MISSING)
+    
+    def version(self, key):
+        return (self._generation, self._versions.get(key, 0))
+    
+    def put(self, key, value, version):
+        with self._lock:
+            if self.version(key) == version:
+                self._data[key] = value
+    
+    def invalidate(self, key):
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self._data.pop(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+_bot_cache = _EntityCache()          # bot_id -> BotRecord
+_bot_list_cache = _EntityCache()     # None -> [BotRecord]
+_bot_summary_cache = _EntityCache()  # None -> [dict] (get_bot_summaries)
+_flow_cache = _EntityCache()         # bot_id -> (flow_json, flow_data, flow_etag, revision)
+_commands_cache = _EntityCache()     # bot_id -> [command]
+_command_cache = _EntityCache()      # command_id -> command
+_ALL_CACHES = (_bot_cache, _bot_list_cache, _bot_summary_cache, _flow_cache, _commands_cache, _command_cache)
+
+# Значение счётчика catalog_version, которому соответствуют кеши
+_catalog_version = None
+_catalog_lock = threading.Lock()
+
+def _clear_caches():
+    """Сбрасывает все кеши (каталог изменён другим процессом или в обход функций модуля)."""
+    for cache in _ALL_CACHES:
+        cache.clear()
+
+def _check_catalog():
+    """
+    Сбрасывает кеши, если каталог изменён другим соединением после последней проверки.
+    
+    Вызывается при каждом чтении через кеш. PRAGMA data_version соединения меняется,
+    только когда другое соединение (другой процесс или поток-писатель) зафиксировало
+    транзакцию, поэтому обычно проверка - одна прагма без чтения страниц. После записи
+    читается счётчик catalog_version, который триггеры увеличивают только при изменении
+    ботов, flow и команд: запись логов и состояний чатов кеш не сбрасывает.
+    """
+    global _catalog_version
+    with _connect() as conn:
+        data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == conn.data_version:
+            return
+        version = conn.execute('SELECT version FROM catalog_version').fetchone()[0]
+        with _catalog_lock:
+            if version != _catalog_version:
+                if _catalog_version is not None:
+                    _clear_caches()
+                _catalog_version = version
+        conn.data_version = data_version
+
+def _cached(cache, key, loader):
+    """
+    Возвращает значение из кеша или загружает его через loader.
+    
+    Возвращаемые объекты разделяются между вызовами и не должны изменяться вызывающим кодом:
+    публичные функции отдают наружу копии (flow, команды) или неизменяемые BotRecord.
+    """
+    _check_catalog()
+    value = cache.get(key)
+    if value is not _MISSING:
+        return value
+    version = cache.version(key)
+    value = loader()
+    cache.put(key, value, version)
+    return value
+
+def _invalidate_bot(bot_id):
+    _bot_cache.invalidate(bot_id)
+    _bot_list_cache.invalidate(None)
+    _bot_summary_cache.invalidate(None)
+
+def _invalidate_command(command_id, bot_id):
+    _command_cache.invalidate(command_id)
+    _commands_cache.invalidate(bot_id)
+
+def _write_command(command_id, sql, params):
+    """Изменяет пользовательскую команду и сбрасывает её кеш (вместе со списком команд бота)."""
+    def operation(cursor):
+        cursor.execute('SELECT bot_id FROM custom_commands WHERE id = ?', (command_id,))
+        row = cursor.fetchone()
+        cursor.execute(sql, params)
+        return row[0] if row else None
+    
+    bot_id = _submit_write(operation).result()
+    _invalidate_command(command_id, bot_id)
+
 def ensure_directories():
     """Создаёт необходимые директории, если они не существуют"""
     db_dir = os.path.dirname(DB_FILE)
     os.makedirs(db_dir, exist_ok=True)
     os.makedirs(LOGS_DIR, exist_ok=True)
+    if DB_LAYOUT == 'per_bot':
+        os.makedirs(SHARDS_DIR, exist_ok=True)
 
 def init_db():
-    """Инициализирует базу данных, создавая таблицы если они не существуют"""
+    """
+    Инициализирует базу данных: создаёт каталоги и применяет недостающие миграции.
+    
+    Вызывается явно при старте сервиса; остальные функции модуля вызывают её
+    лениво, повторный вызов в том же процессе ничего не делает.
+    """
     global _db_initialized
     if _db_initialized:
         return
     
     # Убеждаемся, что директории существуют
     ensure_directories()
-    
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
+    apply_migrations()
+    _db_initialized = True
+
+# ==========================================================================
+# Миграции схемы
+# ==========================================================================
+#
+# Версия схемы хранится в PRAGMA user_version файла БД. Каждый шаг - пара
+# (версия, функция(cursor)); шаги применяются по возрастанию версии в одной
+# транзакции с обновлением user_version. Шаги должны быть идемпотентными:
+# БД, созданные до появления версий, имеют user_version = 0 и уже могут
+# содержать часть схемы. Новые таблицы и индексы добавляются только новыми
+# шагами в конце списка, существующие шаги не меняются.
+
+def _migration_create_catalog(cursor):
+    """Таблицы каталога: боты, их flow и пользовательские команды."""
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS bots (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -57,6 +575,38 @@ def init_db():
         )
     ''')
     
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS custom_commands (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bot_id INTEGER NOT NULL,
+            command TEXT NOT NULL,
+            description TEXT,
+            flow_data TEXT NOT NULL,
+            enabled INTEGER DEFAULT 1,
+            created_at TEXT,
+            updated_at TEXT,
+            UNIQUE(bot_id, command),
+            FOREIGN KEY (bot_id) REFERENCES bots (id) ON DELETE CASCADE
+        )
+    ''')
+
+def _migration_text_restriction_fields(cursor):
+    """Поля ограничения текстовых сообщений в таблицах bots, созданных до их появления."""
+    cursor.execute("PRAGMA table_info(bots)")
+    columns = [column[1] for column in cursor.fetchall()]
+    
+    if 'text_restriction_enabled' not in columns:
+        cursor.execute('ALTER TABLE bots ADD COLUMN text_restriction_enabled INTEGER DEFAULT 1')
+    if 'text_restriction_warning' not in columns:
+        cursor.execute(
+            "ALTER TABLE bots ADD COLUMN text_restriction_warning TEXT "
+            "DEFAULT 'Для управления ботом, пожалуйста, используйте кнопки ⬇️'"
+        )
+    if 'allowed_commands' not in columns:
+        cursor.execute('''ALTER TABLE bots ADD COLUMN allowed_commands TEXT DEFAULT '["/start", "/help"]' ''')
+
+def _migration_create_log_tables(cursor):
+    """Таблица логов, её индекс и полнотекстовый индекс."""
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS bot_logs (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -69,124 +619,361 @@ def init_db():
     ''')
     
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS custom_commands (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+        CREATE INDEX IF NOT EXISTS idx_bot_logs_bot_timestamp ON bot_logs (bot_id, timestamp)
+    ''')
+    
+    _init_logs_fts(cursor)
+
+def _migration_create_chat_sessions(cursor):
+    """Сохранённые состояния чатов (позиция во flow, история, переменные)."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_sessions (
             bot_id INTEGER NOT NULL,
-            command TEXT NOT NULL,
-            description TEXT,
-            flow_data TEXT NOT NULL,
-            enabled INTEGER DEFAULT 1,
-            created_at TEXT,
-            updated_at TEXT,
-            UNIQUE(bot_id, command),
-            FOREIGN KEY (bot_id) REFERENCES bots (id) ON DELETE CASCADE
+            chat_id INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (bot_id, chat_id)
+        ) WITHOUT ROWID
+    ''')
+
+def _migration_flow_revisions(cursor):
+    """Номер ревизии flow для сохранения патчами с проверкой базовой ревизии."""
+    cursor.execute("PRAGMA table_info(bot_flows)")
+    columns = [column[1] for column in cursor.fetchall()]
+    
+    if 'revision' not in columns:
+        cursor.execute('ALTER TABLE bot_flows ADD COLUMN revision INTEGER NOT NULL DEFAULT 1')
+
+def _migration_create_flow_revisions(cursor):
+    """
+    История ревизий flow: полные снимки и дельты (JSON Patch) между ними, сжатые zlib.
+    
+    Текущий flow каждого бота сохраняется снимком своей ревизии - с него начинается история.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bot_flow_revisions (
+            bot_id INTEGER NOT NULL,
+            revision INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            data BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (bot_id, revision)
+        ) WITHOUT ROWID
+    ''')
+    
+    cursor.execute('SELECT bot_id, flow_data, revision, updated_at FROM bot_flows')
+    for bot_id, flow_json, revision, updated_at in cursor.fetchall():
+        data = zlib.compress(flow_json.encode('utf-8'))
+        cursor.execute('''
+            INSERT OR IGNORE INTO bot_flow_revisions (bot_id, revision, kind, data, size, created_at)
+            VALUES (?, ?, 'snapshot', ?, ?, ?)
+        ''', (bot_id, revision, data, len(data), updated_at or datetime.now().isoformat()))
+
+def _migration_create_runner_leases(cursor):
+    """
+    Узлы раннеров и аренда ботов: каждый бот опрашивает только узел, владеющий его арендой.
+    
+    token - fencing-токен, растёт при каждой смене владельца; reload_seq и restart_seq -
+    счётчики запросов на перезагрузку и перезапуск бота, которые выполняет владелец.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS runner_nodes (
+            node_id TEXT PRIMARY KEY,
+            host TEXT,
+            pid INTEGER,
+            started_at REAL NOT NULL,
+            heartbeat_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bot_leases (
+            bot_id INTEGER PRIMARY KEY,
+            node_id TEXT,
+            token INTEGER NOT NULL DEFAULT 0,
+            expires_at REAL NOT NULL DEFAULT 0,
+            reload_seq INTEGER NOT NULL DEFAULT 0,
+            restart_seq INTEGER NOT NULL DEFAULT 0
         )
     ''')
+
+def _migration_index_log_timestamps(cursor):
+    """Индекс по времени логов: очистка старых логов (prune_bot_logs) без полного просмотра таблицы."""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_bot_logs_timestamp ON bot_logs (timestamp)')
+
+def _migration_catalog_version(cursor):
+    """
+    Счётчик изменений каталога для проверки кешей (_check_catalog).
     
-    conn.commit()
-    conn.close()
-    _db_initialized = True
+    Триггеры увеличивают его при любом изменении ботов, flow и команд,
+    в том числе сделанном другим процессом или напрямую в SQLite.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0)')
+    for table in ('bots', 'bot_flows', 'custom_commands'):
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_catalog_version_{event.lower()} AFTER {event} ON {table} BEGIN
+                    UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+                END
+            ''')
+
+# Миграции основной БД (DB_FILE)
+MIGRATIONS = (
+    (1, _migration_create_catalog),
+    (2, _migration_text_restriction_fields),
+    (3, _migration_create_log_tables),
+    (4, _migration_create_chat_sessions),
+    (5, _migration_flow_revisions),
+    (6, _migration_create_flow_revisions),
+    (7, _migration_create_runner_leases),
+    (8, _migration_index_log_timestamps),
+    (9, _migration_catalog_version),
+)
+
+# Миграции отдельной БД бота (схема 'per_bot'); версия ведётся в каждом файле отдельно
+SHARD_MIGRATIONS = (
+    (1, _migration_create_log_tables),
+    (2, _migration_create_chat_sessions),
+    (3, _migration_index_log_timestamps),
+)
+
+def _migrate(path, migrations):
+    """
+    Приводит схему файла БД к последней версии из migrations.
+    
+    Для актуальной БД это одно чтение PRAGMA user_version. Иначе шаги применяются
+    под BEGIN IMMEDIATE, а версия перечитывается уже под блокировкой, поэтому
+    процессы, стартующие одновременно, не выполнят одну миграцию дважды.
+    
+    Returns:
+        int: Версия схемы после миграции
+    """
+    target = migrations[-1][0]
+    pool = _pool_for(path)
+    conn = pool.acquire()
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= target:
+            return version
+        
+        conn.execute('BEGIN IMMEDIATE')
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        cursor = conn.cursor()
+        for step_version, step in migrations:
+            if step_version > version:
+                step(cursor)
+                logger.info(f"Миграция БД {path}: версия {step_version} ({step.__name__})")
+                version = step_version
+        cursor.execute(f'PRAGMA user_version = {version}')
+        conn.commit()
+        return version
+    finally:
+        pool.release(conn)
+
+def apply_migrations():
+    """Применяет недостающие миграции основной БД. Возвращает версию схемы."""
+    return _migrate(DB_FILE, MIGRATIONS)
+
+def _init_shard(path):
+    """Создаёт или обновляет схему отдельной БД бота (схема 'per_bot')."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Пул соединений файла бота не создаёт файлы, поэтому файл создаётся здесь
+    sqlite3.connect(path).close()
+    _migrate(path, SHARD_MIGRATIONS)
+    _initialized_shards.add(path)
+
+def _init_logs_fts(cursor):
+    """
+    Создаёт полнотекстовый индекс FTS5 по bot_logs.message.
+    
+    Индекс хранит только ссылки на строки bot_logs (external content)
+    и поддерживается триггерами при вставке и удалении логов.
+    Если индекс создаётся для уже заполненной таблицы, он перестраивается.
+    """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='bot_logs_fts'")
+    fts_exists = cursor.fetchone()
+    
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS bot_logs_fts USING fts5(
+            message,
+            content='bot_logs',
+            content_rowid='id'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS bot_logs_fts_insert AFTER INSERT ON bot_logs BEGIN
+            INSERT INTO bot_logs_fts (rowid, message) VALUES (new.id, new.message);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS bot_logs_fts_delete AFTER DELETE ON bot_logs BEGIN
+            INSERT INTO bot_logs_fts (bot_logs_fts, rowid, message) VALUES ('delete', old.id, old.message);
+        END
+    ''')
+    
+    if not fts_exists:
+        cursor.execute("INSERT INTO bot_logs_fts (bot_logs_fts) VALUES ('rebuild')")
 
 def add_bot(name, token, base_url='https://platform-api.max.ru'):
     """Добавляет нового бота в базу данных. БД создаётся автоматически при первом вызове."""
     init_db()  # Автоматическая инициализация при первом использовании
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
     now = datetime.now().isoformat()
-    cursor.execute('''
+    result = _write('''
         INSERT INTO bots (name, token, base_url, status, created_at, updated_at)
         VALUES (?, ?, ?, 'stopped', ?, ?)
     ''', (name, token, base_url, now, now))
+    _invalidate_bot(result.lastrowid)
+    
+    return result.lastrowid
+
+# Колонки таблицы bots в порядке, в котором их ожидает BotRecord
+BOT_COLUMNS = (
+    'id', 'name', 'token', 'base_url', 'start_message', 'menu_config', 'status',
+    'text_restriction_enabled', 'text_restriction_warning', 'allowed_commands',
+    'created_at', 'updated_at'
+)
+_BOT_SELECT = f'SELECT {", ".join(BOT_COLUMNS)} FROM bots'
+
+DEFAULT_TEXT_RESTRICTION_WARNING = 'Для управления ботом, пожалуйста, используйте кнопки ⬇️'
+DEFAULT_ALLOWED_COMMANDS = ['/start', '/help']
+
+class BotRecord(Mapping):
+    """
+    Компактная запись бота, построенная из строки таблицы bots.
     
-    bot_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    Поддерживает доступ как к словарю (bot['name'], bot.get('status')) и как к атрибутам.
+    JSON-колонки menu_config и allowed_commands декодируются при первом обращении.
+    Для сериализации в ответ API используйте to_dict().
+    """
     
-    return bot_id
+    __slots__ = (
+        'id', 'name', 'token', 'base_url', 'start_message', 'status',
+        'text_restriction_enabled', 'text_restriction_warning', 'created_at', 'updated_at',
+        '_menu_config_raw', '_menu_config', '_allowed_commands_raw', '_allowed_commands'
+    )
+    
+    _NOT_DECODED = object()
+    
+    def __init__(self, row):
+        (self.id, self.name, self.token, self.base_url, self.start_message, self._menu_config_raw,
+         self.status, text_restriction_enabled, text_restriction_warning, self._allowed_commands_raw,
+         self.created_at, self.updated_at) = row
+        self.text_restriction_enabled = bool(text_restriction_enabled) if text_restriction_enabled is not None else True
+        self.text_restriction_warning = text_restriction_warning or DEFAULT_TEXT_RESTRICTION_WARNING
+        self._menu_config = self._NOT_DECODED
+        self._allowed_commands = self._NOT_DECODED
+    
+    @classmethod
+    def row_factory(cls, cursor, row):
+        """row_factory для курсора, выполняющего _BOT_SELECT."""
+        return cls(row)
+    
+    @property
+    def menu_config(self):
+        if self._menu_config is self._NOT_DECODED:
+            self._menu_config = json.loads(self._menu_config_raw) if self._menu_config_raw else []
+        return self._menu_config
+    
+    @property
+    def allowed_commands(self):
+        if self._allowed_commands is self._NOT_DECODED:
+            self._allowed_commands = (json.loads(self._allowed_commands_raw) if self._allowed_commands_raw
+                                      else list(DEFAULT_ALLOWED_COMMANDS))
+        return self._allowed_commands
+    
+    def __getitem__(self, key):
+        if key not in BOT_COLUMNS:
+            raise KeyError(key)
+        return getattr(self, key)
+    
+    def __iter__(self):
+        return iter(BOT_COLUMNS)
+    
+    def __len__(self):
+        return len(BOT_COLUMNS)
+    
+    def to_dict(self):
+        """Возвращает обычный словарь со всеми полями бота."""
+        return {key: getattr(self, key) for key in BOT_COLUMNS}
+    
+    def __repr__(self):
+        return f'BotRecord(id={self.id!r}, name={self.name!r}, status={self.status!r})'
 
 def get_bot(bot_id):
     """Получает информацию о боте по ID. Если БД не существует, возвращает None."""
     if not os.path.exists(DB_FILE):
         return None
     init_db()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    # Получаем данные с именами колонок для безопасности
-    cursor.execute('PRAGMA table_info(bots)')
-    columns = [col[1] for col in cursor.fetchall()]
     
-    cursor.execute('SELECT * FROM bots WHERE id = ?', (bot_id,))
-    bot = cursor.fetchone()
-    
-    conn.close()
+    def load():
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = BotRecord.row_factory
+            cursor.execute(f'{_BOT_SELECT} WHERE id = ?', (bot_id,))
+            return cursor.fetchone()
     
-    if bot:
-        # Создаём словарь по именам колонок
-        bot_dict = dict(zip(columns, bot))
-        
-        return {
-            'id': bot_dict.get('id'),
-            'name': bot_dict.get('name'),
-            'token': bot_dict.get('token'),
-            'base_url': bot_dict.get('base_url'),
-            'start_message': bot_dict.get('start_message'),
-            'menu_config': json.loads(bot_dict['menu_config']) if bot_dict.get('menu_config') else [],
-            'status': bot_dict.get('status'),
-            'text_restriction_enabled': bool(bot_dict.get('text_restriction_enabled')) if bot_dict.get('text_restriction_enabled') is not None else True,
-            'text_restriction_warning': bot_dict.get('text_restriction_warning') if bot_dict.get('text_restriction_warning') else 'Для управления ботом, пожалуйста, используйте кнопки ⬇️',
-            'allowed_commands': json.loads(bot_dict['allowed_commands']) if bot_dict.get('allowed_commands') else ['/start', '/help'],
-            'created_at': bot_dict.get('created_at'),
-            'updated_at': bot_dict.get('updated_at')
-        }
-    return None
+    return _cached(_bot_cache, bot_id, load)
 
 def get_all_bots():
     """Получает список всех ботов. Если БД не существует, возвращает пустой список."""
     if not os.path.exists(DB_FILE):
         return []
     init_db()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
     
-    # Получаем имена колонок для безопасного доступа
-    cursor.execute('PRAGMA table_info(bots)')
-    columns = [col[1] for col in cursor.fetchall()]
+    def load():
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = BotRecord.row_factory
+            cursor.execute(_BOT_SELECT)
+            return cursor.fetchall()
     
-    cursor.execute('SELECT * FROM bots')
-    bots = cursor.fetchall()
+    return list(_cached(_bot_list_cache, None, load))
+
+# Поля сводки бота для списка ботов: без токена, menu_config и других тяжёлых колонок.
+# token_preview - последние 4 символа токена, чтобы отличать ботов в списке.
+BOT_SUMMARY_FIELDS = (
+    'id', 'name', 'base_url', 'status', 'text_restriction_enabled', 'token_preview',
+    'created_at', 'updated_at'
+)
+_BOT_SUMMARY_SELECT = (
+    'SELECT id, name, base_url, status, text_restriction_enabled, substr(token, -4), '
+    'created_at, updated_at FROM bots ORDER BY id'
+)
+
+def get_bot_summaries():
+    """
+    Получает сводки всех ботов одним запросом, читающим только нужные списку колонки.
     
-    conn.close()
+    Returns:
+        list: Словари с полями BOT_SUMMARY_FIELDS. Словари разделяются между вызовами
+            (кеш) и не должны изменяться вызывающим кодом. Если БД не существует - пустой список.
+    """
+    if not os.path.exists(DB_FILE):
+        return []
+    init_db()
     
-    result = []
-    for bot in bots:
-        # Создаём словарь по именам колонок
-        bot_dict = dict(zip(columns, bot))
-        
-        result.append({
-            'id': bot_dict.get('id'),
-            'name': bot_dict.get('name'),
-            'token': bot_dict.get('token'),
-            'base_url': bot_dict.get('base_url'),
-            'start_message': bot_dict.get('start_message'),
-            'menu_config': json.loads(bot_dict['menu_config']) if bot_dict.get('menu_config') else [],
-            'status': bot_dict.get('status'),
-            'text_restriction_enabled': bool(bot_dict.get('text_restriction_enabled')) if bot_dict.get('text_restriction_enabled') is not None else True,
-            'text_restriction_warning': bot_dict.get('text_restriction_warning') if bot_dict.get('text_restriction_warning') else 'Для управления ботом, пожалуйста, используйте кнопки ⬇️',
-            'allowed_commands': json.loads(bot_dict['allowed_commands']) if bot_dict.get('allowed_commands') else ['/start', '/help'],
-            'created_at': bot_dict.get('created_at'),
-            'updated_at': bot_dict.get('updated_at')
-        })
-    
-    return result
+    def load():
+        with _connect() as conn:
+            rows = conn.execute(_BOT_SUMMARY_SELECT).fetchall()
+        summaries = []
+        for row in rows:
+            summary = dict(zip(BOT_SUMMARY_FIELDS, row))
+            enabled = summary['text_restriction_enabled']
+            summary['text_restriction_enabled'] = bool(enabled) if enabled is not None else True
+            summaries.append(summary)
+        return summaries
+    
+    return _cached(_bot_summary_cache, None, load)
 
 def update_bot(bot_id, name=None, token=None, base_url=None, text_restriction_enabled=None, text_restriction_warning=None, allowed_commands=None):
     """Обновляет информацию о боте. БД создаётся автоматически при первом вызове."""
     init_db()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
     updates = []
     values = []
     
@@ -214,210 +1001,704 @@ def update_bot(bot_id, name=None, token=None, base_url=None, text_restriction_en
     values.append(bot_id)
     
     if updates:
-        cursor.execute(f'UPDATE bots SET {", ".join(updates)} WHERE id = ?', values)
-    
-    conn.commit()
-    conn.close()
+        _write(f'UPDATE bots SET {", ".join(updates)} WHERE id = ?', values)
+        _invalidate_bot(bot_id)
 
 def delete_bot(bot_id):
     """Удаляет бота из базы данных."""
     if not os.path.exists(DB_FILE):
         return
     init_db()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
     
-    cursor.execute('DELETE FROM bots WHERE id = ?', (bot_id,))
-    
-    conn.commit()
-    conn.close()
+    def delete(cursor):
+        cursor.execute('DELETE FROM bots WHERE id = ?', (bot_id,))
+        cursor.execute('DELETE FROM bot_flow_revisions WHERE bot_id = ?', (bot_id,))
+        cursor.execute('DELETE FROM bot_leases WHERE bot_id = ?', (bot_id,))
+        if DB_LAYOUT != 'per_bot':
+            cursor.execute('DELETE FROM chat_sessions WHERE bot_id = ?', (bot_id,))
+    
+    _submit_write(delete).result()
+    _invalidate_bot(bot_id)
+    _flow_cache.invalidate(bot_id)
+    _commands_cache.invalidate(bot_id)
+    if DB_LAYOUT == 'per_bot':
+        _drop_shard(bot_id)
 
 def update_bot_status(bot_id, status):
     """Обновляет статус бота. БД создаётся автоматически при первом вызове."""
     init_db()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute('UPDATE bots SET status = ?, updated_at = ? WHERE id = ?', 
-                   (status, datetime.now().isoformat(), bot_id))
+    _write('UPDATE bots SET status = ?, updated_at = ? WHERE id = ?',
+           (status, datetime.now().isoformat(), bot_id))
+    _invalidate_bot(bot_id)
+
+class FlowConflictError(Exception):
+    """Flow изменён после ревизии, на основе которой сделана правка."""
     
-    conn.commit()
-    conn.close()
+    def __init__(self, revision):
+        super().__init__(f"Flow изменён: текущая ревизия {revision}")
+        self.revision = revision
 
-def save_bot_flow(bot_id, flow_data):
-    """Сохраняет flow для бота. БД создаётся автоматически при первом вызове."""
-    init_db()
+def _validate_flow(flow_data):
+    """Проверяет, что flow можно сохранить: есть ноды и хотя бы одна стартовая."""
+    if not isinstance(flow_data, dict):
+        raise ValueError("Flow must be a JSON object")
+    
     # Проверяем, что flow не пустой
     nodes = flow_data.get('nodes', [])
     if not nodes:
         raise ValueError("Cannot save empty flow - at least one node is required")
     
     # Проверяем, что есть хотя бы один start-узел
-    start_node = next((n for n in nodes if n.get('isStart')), None)
+    start_node = next((n for n in nodes if isinstance(n, dict) and n.get('isStart')), None)
     if not start_node:
         raise ValueError("Cannot save flow without start node - at least one node must have isStart: true")
+
+def _write_flow(bot_id, flow_json, base_revision, delta=None, delta_base=None):
+    """
+    Записывает flow новой ревизией, добавляет её в историю и возвращает номер ревизии.
     
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    Если base_revision указана, запись выполняется только когда текущая ревизия
+    с ней совпадает; проверка и запись идут в одной транзакции потока-писателя.
     
+    В историю ревизия попадает дельтой (delta - JSON Patch от ревизии delta_base),
+    если предыдущая ревизия - delta_base, с последнего снимка прошло меньше
+    FLOW_SNAPSHOT_INTERVAL ревизий и дельта заметно меньше flow; иначе - полным снимком.
+    
+    Raises:
+        FlowConflictError: Текущая ревизия отличается от base_revision
+    """
     now = datetime.now().isoformat()
+    delta_json = json.dumps(delta) if delta is not None else None
+    if delta_json is not None and len(delta_json) * 2 > len(flow_json):
+        delta_json = None
+    
+    def save(cursor):
+        cursor.execute('SELECT revision FROM bot_flows WHERE bot_id = ?', (bot_id,))
+        existing = cursor.fetchone()
+        current = existing[0] if existing else 0
+        if base_revision is not None and base_revision != current:
+            raise FlowConflictError(current)
+        revision = current + 1
+        
+        if existing:
+            cursor.execute('''
+                UPDATE bot_flows SET flow_data = ?, revision = ?, updated_at = ? WHERE bot_id = ?
+            ''', (flow_json, revision, now, bot_id))
+        else:
+            cursor.execute('''
+                INSERT INTO bot_flows (bot_id, flow_data, revision, updated_at)
+                VALUES (?, ?, ?, ?)
+            ''', (bot_id, flow_json, revision, now))
+        
+        kind = 'snapshot'
+        if delta_json is not None and delta_base == current:
+            cursor.execute('''
+                SELECT MAX(revision), MAX(CASE WHEN kind = 'snapshot' THEN revision END)
+                FROM bot_flow_revisions WHERE bot_id = ?
+            ''', (bot_id,))
+            last, last_snapshot = cursor.fetchone()
+            if last == current and last_snapshot is not None and revision - last_snapshot < FLOW_SNAPSHOT_INTERVAL:
+                kind = 'delta'
+        data = zlib.compress((delta_json if kind == 'delta' else flow_json).encode('utf-8'))
+        cursor.execute('''
+            INSERT OR REPLACE INTO bot_flow_revisions (bot_id, revision, kind, data, size, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (bot_id, revision, kind, data, len(data), now))
+        return revision
     
-    cursor.execute('SELECT id FROM bot_flows WHERE bot_id = ?', (bot_id,))
-    existing = cursor.fetchone()
+    try:
+        return _submit_write(save).result()
+    finally:
+        _flow_cache.invalidate(bot_id)
+
+def save_bot_flow(bot_id, flow_data, base_revision=None):
+    """
+    Сохраняет flow для бота. БД создаётся автоматически при первом вызове.
     
-    if existing:
-        cursor.execute('''
-            UPDATE bot_flows SET flow_data = ?, updated_at = ? WHERE bot_id = ?
-        ''', (json.dumps(flow_data), now, bot_id))
-    else:
-        cursor.execute('''
-            INSERT INTO bot_flows (bot_id, flow_data, updated_at)
-            VALUES (?, ?, ?)
-        ''', (bot_id, json.dumps(flow_data), now))
+    Args:
+        base_revision: Ревизия, на основе которой сделана правка; None - перезаписать без проверки
+    
+    Returns:
+        int: Номер новой ревизии
+    
+    Raises:
+        ValueError: Flow пустой или без стартовой ноды
+        FlowConflictError: Flow изменён после base_revision
+    """
+    init_db()
+    _validate_flow(flow_data)
+    # Дельта для истории строится от текущей ревизии из кеша
+    _, previous, _, previous_revision = _load_bot_flow(bot_id)
+    delta = make_patch(previous, flow_data) if previous is not None else None
+    return _write_flow(bot_id, json.dumps(flow_data), base_revision, delta, previous_revision)
+
+def patch_bot_flow(bot_id, patch, base_revision):
+    """
+    Применяет к flow бота JSON Patch (RFC 6902) и сохраняет результат новой ревизией.
     
-    conn.commit()
-    conn.close()
+    Патч применяется к закешированному flow копированием по пути, без полной копии документа.
+    
+    Returns:
+        int: Номер новой ревизии
+    
+    Raises:
+        JsonPatchError: Патч некорректен или неприменим
+        ValueError: Результат нельзя сохранить (нет нод или стартовой ноды)
+        FlowConflictError: Flow изменён после base_revision
+        LookupError: У бота нет сохранённого flow
+    """
+    init_db()
+    _, flow_data, _, revision = _load_bot_flow(bot_id)
+    if flow_data is None:
+        raise LookupError(f"Flow бота {bot_id} не найден")
+    if revision != base_revision:
+        raise FlowConflictError(revision)
+    
+    patched = apply_patch(flow_data, patch)
+    _validate_flow(patched)
+    # Присланный патч и есть дельта для истории ревизий
+    return _write_flow(bot_id, json.dumps(patched), base_revision, patch, revision)
+
+def _load_bot_flow(bot_id):
+    """Возвращает (flow_json, flow_data, flow_etag, revision) из кеша или из БД."""
+    def load():
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT flow_data, revision FROM bot_flows WHERE bot_id = ?', (bot_id,))
+            result = cursor.fetchone()
+        if result:
+            etag = hashlib.blake2b(result[0].encode('utf-8'), digest_size=16).hexdigest()
+            return (result[0], json.loads(result[0]), etag, result[1])
+        return (None, None, None, None)
+    
+    return _cached(_flow_cache, bot_id, load)
 
 def get_bot_flow(bot_id):
-    """Получает flow бота. Если БД не существует, возвращает None."""
+    """
+    Получает flow бота. Если БД не существует, возвращает None.
+    
+    Возвращается новый объект, разобранный из закешированной JSON-строки:
+    вызывающий код может его менять, не затрагивая кеш.
+    """
+    if not os.path.exists(DB_FILE):
+        return None
+    init_db()
+    flow_json = _load_bot_flow(bot_id)[0]
+    return json.loads(flow_json) if flow_json is not None else None
+
+def get_bot_flow_json(bot_id):
+    """Получает flow бота в виде JSON-строки, как он хранится в БД (без повторной сериализации)."""
     if not os.path.exists(DB_FILE):
         return None
     init_db()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    return _load_bot_flow(bot_id)[0]
+
+def get_bot_flow_etag(bot_id):
+    """
+    Возвращает хеш содержимого flow бота (для HTTP ETag) или None, если flow нет.
+    
+    Хеш вычисляется один раз при загрузке flow в кеш, поэтому повторные
+    проверки неизменившегося flow не обращаются к SQLite.
+    """
+    if not os.path.exists(DB_FILE):
+        return None
+    init_db()
+    return _load_bot_flow(bot_id)[2]
+
+def get_bot_flow_snapshot(bot_id):
+    """
+    Возвращает (flow_json, flow_etag, revision) одной версии flow или (None, None, None).
     
-    cursor.execute('SELECT flow_data FROM bot_flows WHERE bot_id = ?', (bot_id,))
-    result = cursor.fetchone()
+    Все три значения берутся из одной записи кеша: отдельные вызовы
+    get_bot_flow_json/get_bot_flow_etag/get_bot_flow_revision могут попасть
+    по разные стороны сохранения и вернуть тело одной ревизии с номером другой.
+    """
+    if not os.path.exists(DB_FILE):
+        return (None, None, None)
+    init_db()
+    flow_json, _, etag, revision = _load_bot_flow(bot_id)
+    return (flow_json, etag, revision)
+
+def get_bot_flow_revision(bot_id):
+    """Возвращает номер текущей ревизии flow бота или None, если flow нет."""
+    if not os.path.exists(DB_FILE):
+        return None
+    init_db()
+    return _load_bot_flow(bot_id)[3]
+
+def get_flow_revisions(bot_id, limit=50, before=None):
+    """
+    Возвращает ревизии flow бота от новых к старым.
     
-    conn.close()
+    Args:
+        limit: Максимальное число ревизий
+        before: Вернуть только ревизии с номером меньше указанного (пагинация)
     
-    if result:
-        return json.loads(result[0])
-    return None
+    Returns:
+        list: Словари revision, kind ('snapshot' или 'delta'), size (байт в БД), created_at
+    """
+    if not os.path.exists(DB_FILE):
+        return []
+    init_db()
+    query = 'SELECT revision, kind, size, created_at FROM bot_flow_revisions WHERE bot_id = ?'
+    params = [bot_id]
+    if before is not None:
+        query += ' AND revision < ?'
+        params.append(before)
+    query += ' ORDER BY revision DESC LIMIT ?'
+    params.append(limit)
+    with _connect() as conn:
+        rows = conn.execute(query, params).fetchall()
+    return [{'revision': revision, 'kind': kind, 'size': size, 'created_at': created_at}
+            for revision, kind, size, created_at in rows]
 
-def add_bot_log(bot_id, level, message):
-    """Добавляет лог для бота. БД создаётся автоматически при первом вызове."""
+def get_flow_revision(bot_id, revision):
+    """
+    Восстанавливает flow бота в указанной ревизии или возвращает None, если её нет в истории.
+    
+    Читается ближайший снимок не новее ревизии и дельты после него - не больше
+    FLOW_SNAPSHOT_INTERVAL строк независимо от длины истории.
+    Текущая ревизия разбирается из закешированной JSON-строки, как в get_bot_flow.
+    """
+    if not os.path.exists(DB_FILE):
+        return None
     init_db()
-    import time
-    for attempt in range(5):
-        try:
-            conn = sqlite3.connect(DB_FILE, timeout=5.0)
-            cursor = conn.cursor()
-            
-            now = datetime.now().isoformat()
-            cursor.execute('''
-                INSERT INTO bot_logs (bot_id, level, message, timestamp)
-                VALUES (?, ?, ?, ?)
-            ''', (bot_id, level, message, now))
-            
-            conn.commit()
-            conn.close()
-            return
-        except sqlite3.OperationalError as e:
-            if "database is locked" in str(e):
-                time.sleep(0.1)
-                continue
-            else:
-                raise
-    raise Exception("Failed to add log after retries")
+    flow_json, _, _, current = _load_bot_flow(bot_id)
+    if revision == current:
+        return json.loads(flow_json)
+    
+    with _connect() as conn:
+        rows = conn.execute('''
+            SELECT revision, kind, data FROM bot_flow_revisions
+            WHERE bot_id = ? AND revision <= ? AND revision >= (
+                SELECT MAX(revision) FROM bot_flow_revisions
+                WHERE bot_id = ? AND kind = 'snapshot' AND revision <= ?
+            )
+            ORDER BY revision
+        ''', (bot_id, revision, bot_id, revision)).fetchall()
+    if not rows or rows[-1][0] != revision:
+        return None
+    
+    document = json.loads(zlib.decompress(rows[0][2]))
+    for _, _, data in rows[1:]:
+        document = apply_patch(document, json.loads(zlib.decompress(data)))
+    return document
 
-def get_bot_logs(bot_id, limit=100):
-    """Получает логи бота. Если БД не существует, возвращает пустой список."""
+def diff_flow_revisions(bot_id, from_revision, to_revision):
+    """
+    Возвращает JSON Patch, переводящий flow из одной ревизии в другую.
+    
+    Raises:
+        LookupError: Одной из ревизий нет в истории
+    """
+    before = get_flow_revision(bot_id, from_revision)
+    after = get_flow_revision(bot_id, to_revision)
+    if before is None or after is None:
+        missing = from_revision if before is None else to_revision
+        raise LookupError(f"Ревизия {missing} flow бота {bot_id} не найдена")
+    return make_patch(before, after)
+
+def rollback_bot_flow(bot_id, revision):
+    """
+    Делает flow из указанной ревизии текущим. История не переписывается:
+    откат сохраняется новой ревизией.
+    
+    Returns:
+        int: Номер новой ревизии
+    
+    Raises:
+        LookupError: Ревизии нет в истории
+    """
+    flow_data = get_flow_revision(bot_id, revision)
+    if flow_data is None:
+        raise LookupError(f"Ревизия {revision} flow бота {bot_id} не найдена")
+    return save_bot_flow(bot_id, flow_data)
+
+def add_bot_log(bot_id, level, message, timestamp=None):
+    """
+    Добавляет лог для бота. БД создаётся автоматически при первом вызове.
+    
+    Запись не ждёт фиксации транзакции: лог попадает в очередь потока-писателя
+    и сохраняется вместе с другими записями одной пачкой.
+    
+    Returns:
+        Optional[Future]: Завершается после фиксации записи в БД; None, если бот удалён
+    """
+    init_db()
+    now = timestamp or datetime.now().isoformat()
+    try:
+        future = _submit_write(_sql_operation('''
+            INSERT INTO bot_logs (bot_id, level, message, timestamp)
+            VALUES (?, ?, ?, ?)
+        ''', (bot_id, level, message, now)), bot_id)
+    except LookupError:
+        # Бот удалён (схема per_bot): последние логи его потока опроса не создают файл заново
+        return None
+    future.add_done_callback(_report_failed_write)
+    return future
+
+def get_bot_logs(bot_id, limit=100, before=None):
+    """
+    Получает логи бота (новые первыми). Если БД не существует, возвращает пустой список.
+    
+    Args:
+        before: Вернуть только логи старше указанного момента (ISO-строка времени)
+    """
     if not os.path.exists(DB_FILE):
         return []
     init_db()
-    import time
-    for attempt in range(5):
-        try:
-            conn = sqlite3.connect(DB_FILE, timeout=5.0)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT id, bot_id, level, message, timestamp 
-                FROM bot_logs 
-                WHERE bot_id = ? 
-                ORDER BY timestamp DESC 
-                LIMIT ?
-            ''', (bot_id, limit))
-            
-            logs = cursor.fetchall()
-            
-            conn.close()
-            
-            return [
-                {
-                    'id': log[0],
-                    'bot_id': log[1],
-                    'level': log[2],
-                    'message': log[3],
-                    'timestamp': log[4]
-                }
-                for log in logs
-            ]
-        except sqlite3.OperationalError as e:
-            if "database is locked" in str(e):
-                time.sleep(0.1)
-                continue
-            else:
-                raise
-    raise Exception("Failed to get logs after retries")
+    if not _shard_exists(bot_id):
+        return []
+    query = 'SELECT id, bot_id, level, message, timestamp FROM bot_logs WHERE bot_id = ?'
+    params = [bot_id]
+    if before is not None:
+        query += ' AND timestamp < ?'
+        params.append(before)
+    query += ' ORDER BY timestamp DESC LIMIT ?'
+    params.append(limit)
+    with _connect(bot_id) as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        
+        logs = cursor.fetchall()
+    
+    return [
+        {
+            'id': log[0],
+            'bot_id': log[1],
+            'level': log[2],
+            'message': log[3],
+            'timestamp': log[4]
+        }
+        for log in logs
+    ]
+
+def prune_bot_logs(before, batch_size=PRUNE_BATCH_SIZE):
+    """
+    Удаляет из SQLite логи всех ботов старше указанного момента.
+    
+    Записи удаляются пачками по batch_size, каждая пачка - отдельная транзакция:
+    первая очистка большой таблицы (и триггеры полнотекстового индекса на каждую
+    строку) не занимает поток-писатель надолго, записи ботов идут между пачками.
+    
+    Args:
+        before: ISO-строка времени; логи с меньшим timestamp удаляются
+    
+    Returns:
+        int: Количество удалённых записей
+    """
+    if not os.path.exists(DB_FILE):
+        return 0
+    init_db()
+    deleted = 0
+    for db_bot_id in _log_database_bot_ids():
+        while True:
+            removed = _write('''
+                DELETE FROM bot_logs WHERE id IN (
+                    SELECT id FROM bot_logs WHERE timestamp < ? ORDER BY timestamp LIMIT ?
+                )
+            ''', (before, batch_size), db_bot_id).rowcount
+            deleted += removed
+            if removed < batch_size:
+                break
+    return deleted
+
+def _fts_query(text):
+    """
+    Превращает пользовательскую строку поиска в запрос FTS5.
+    
+    Каждое слово берётся в кавычки, поэтому спецсимволы синтаксиса FTS5
+    (двоеточия, дефисы, скобки) ищутся как обычный текст. Слова объединяются через AND.
+    """
+    terms = [term.replace('"', '""') for term in text.split()]
+    return ' '.join(f'"{term}"' for term in terms if term)
+
+def search_bot_logs(bot_id, query, level=None, since=None, until=None, limit=50, offset=0):
+    """
+    Полнотекстовый поиск по логам бота.
+    
+    Args:
+        bot_id: ID бота (None - поиск по всем ботам)
+        query: Строка поиска (chat id, id ноды, текст ошибки и т.п.)
+        level: Уровень лога или список уровней для фильтрации
+        since: Начало интервала (ISO-строка времени, включительно)
+        until: Конец интервала (ISO-строка времени, включительно)
+        limit: Размер страницы
+        offset: Смещение страницы
+    
+    Returns:
+        dict: {'results': [...], 'has_more': bool}. Результаты одной БД отсортированы
+            по релевантности. При поиске по всем ботам в схеме 'per_bot' - по времени,
+            от новых к старым: оценка bm25 зависит от статистики своего файла и между
+            файлами ботов несравнима.
+    """
+    fts_query = _fts_query(query or '')
+    if not fts_query or not os.path.exists(DB_FILE):
+        return {'results': [], 'has_more': False}
+    init_db()
+    
+    conditions = ['bot_logs_fts MATCH ?']
+    values = [fts_query]
+    
+    if bot_id is not None:
+        conditions.append('l.bot_id = ?')
+        values.append(bot_id)
+    if level:
+        levels = [level] if isinstance(level, str) else list(level)
+        conditions.append(f'l.level IN ({", ".join("?" for _ in levels)})')
+        values.extend(levels)
+    if since:
+        conditions.append('l.timestamp >= ?')
+        values.append(since)
+    if until:
+        conditions.append('l.timestamp <= ?')
+        values.append(until)
+    
+    # Запрашиваем на одну запись больше, чтобы узнать, есть ли следующая страница
+    if bot_id is not None or DB_LAYOUT != 'per_bot':
+        # Одна БД: пагинация выполняется самим SQLite
+        if not _shard_exists(bot_id):
+            return {'results': [], 'has_more': False}
+        logs = _search_logs_in(bot_id, conditions, values, limit + 1, offset)
+    else:
+        # Поиск по всем файлам ботов: объединяем результаты по времени
+        logs = []
+        for db_bot_id in _shard_bot_ids():
+            logs.extend(_search_logs_in(db_bot_id, conditions, values, offset + limit + 1, 0,
+                                        order='l.timestamp DESC, l.id DESC'))
+        logs.sort(key=lambda log: (log[4], log[0]), reverse=True)
+        logs = logs[offset:offset + limit + 1]
+    
+    return {
+        'results': [
+            {
+                'id': log[0],
+                'bot_id': log[1],
+                'level': log[2],
+                'message': log[3],
+                'timestamp': log[4]
+            }
+            for log in logs[:limit]
+        ],
+        'has_more': len(logs) > limit
+    }
+
+def _search_logs_in(db_bot_id, conditions, values, limit, offset, order='bot_logs_fts.rank'):
+    """Выполняет поисковый запрос в одной БД логов."""
+    with _connect(db_bot_id) as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT l.id, l.bot_id, l.level, l.message, l.timestamp, bot_logs_fts.rank
+            FROM bot_logs_fts
+            JOIN bot_logs l ON l.id = bot_logs_fts.rowid
+            WHERE {" AND ".join(conditions)}
+            ORDER BY {order}
+            LIMIT ? OFFSET ?
+        ''', values + [limit, offset])
+        return cursor.fetchall()
 
 def clear_bot_logs(bot_id):
     """Очищает логи бота."""
     if not os.path.exists(DB_FILE):
         return
     init_db()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    if not _shard_exists(bot_id):
+        return
+    _write('DELETE FROM bot_logs WHERE bot_id = ?', (bot_id,), bot_id)
+
+# ==========================================================================
+# Состояния чатов
+# ==========================================================================
+
+def get_chat_session(bot_id, chat_id):
+    """Загружает сохранённое состояние чата. Возвращает словарь или None."""
+    if not os.path.exists(DB_FILE):
+        return None
+    init_db()
+    if not _shard_exists(bot_id):
+        return None
+    with _connect(bot_id) as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT state FROM chat_sessions WHERE bot_id = ? AND chat_id = ?',
+                       (bot_id, chat_id))
+        row = cursor.fetchone()
+    return json.loads(row[0]) if row else None
+
+def save_chat_sessions(bot_id, sessions, lease_token=None):
+    """
+    Сохраняет пачку состояний чатов одной транзакцией.
+    
+    Args:
+        bot_id: ID бота
+        sessions: Список пар (chat_id, state_json)
+        lease_token: fencing-токен аренды бота (модуль leases); если аренда перешла
+            к другому узлу, запись отклоняется с LeaseLostError
+    
+    Returns:
+        Future: Завершается после фиксации записи в БД
+    """
+    init_db()
+    now = datetime.now().isoformat()
+    rows = [(bot_id, chat_id, state, now) for chat_id, state in sessions]
+    # В схеме per_bot аренды лежат в основной БД, а состояния - в файле бота:
+    # токен проверяется отдельным чтением непосредственно перед записью
+    fence_in_transaction = DB_LAYOUT != 'per_bot'
+    if lease_token is not None and not fence_in_transaction:
+        try:
+            with _connect() as conn:
+                _check_lease(conn.cursor(), bot_id, lease_token)
+        except LeaseLostError as e:
+            future = Future()
+            future.set_exception(e)
+            return future
+    
+    def save(cursor):
+        if lease_token is not None and fence_in_transaction:
+            _check_lease(cursor, bot_id, lease_token)
+        cursor.executemany('''
+            INSERT INTO chat_sessions (bot_id, chat_id, state, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (bot_id, chat_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at
+        ''', rows)
+    
+    return _submit_write(save, bot_id)
+
+# ==========================================================================
+# Аренда ботов узлами раннеров (модуль leases)
+# ==========================================================================
+
+class LeaseLostError(Exception):
+    """Аренда бота перешла к другому узлу: запись от имени прежнего владельца отклонена."""
+
+def _check_lease(cursor, bot_id, token):
+    row = cursor.execute('SELECT token FROM bot_leases WHERE bot_id = ?', (bot_id,)).fetchone()
+    if row is None or row[0] != token:
+        raise LeaseLostError(f"Аренда бота {bot_id} с токеном {token} больше не действительна")
+
+def heartbeat_runner_node(node_id, host, pid, now):
+    """Отмечает узел раннера живым; при первом вызове регистрирует его."""
+    init_db()
+    _write('''
+        INSERT INTO runner_nodes (node_id, host, pid, started_at, heartbeat_at) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (node_id) DO UPDATE SET host = excluded.host, pid = excluded.pid,
+                                            heartbeat_at = excluded.heartbeat_at
+    ''', (node_id, host, pid, now, now))
+
+def get_runner_nodes():
+    """Возвращает все зарегистрированные узлы раннеров (без кеша: читается при каждом такте)."""
+    init_db()
+    with _connect() as conn:
+        rows = conn.execute(
+            'SELECT node_id, host, pid, started_at, heartbeat_at FROM runner_nodes ORDER BY node_id'
+        ).fetchall()
+    return [dict(zip(('node_id', 'host', 'pid', 'started_at', 'heartbeat_at'), row)) for row in rows]
+
+def remove_runner_nodes(node_ids):
+    """Удаляет узлы раннеров (остановленные или давно не подававшие признаков жизни)."""
+    if not node_ids:
+        return
+    init_db()
     
-    cursor.execute('DELETE FROM bot_logs WHERE bot_id = ?', (bot_id,))
+    def remove(cursor):
+        cursor.executemany('DELETE FROM runner_nodes WHERE node_id = ?', [(node_id,) for node_id in node_ids])
     
-    conn.commit()
-    conn.close()
+    _submit_write(remove).result()
 
-def migrate_add_text_restriction_fields():
+def get_bot_leases():
+    """Возвращает аренды ботов: bot_id -> словарь node_id, token, expires_at, reload_seq, restart_seq."""
+    init_db()
+    with _connect() as conn:
+        rows = conn.execute(
+            'SELECT bot_id, node_id, token, expires_at, reload_seq, restart_seq FROM bot_leases'
+        ).fetchall()
+    return {
+        row[0]: dict(zip(('node_id', 'token', 'expires_at', 'reload_seq', 'restart_seq'), row[1:]))
+        for row in rows
+    }
+
+def acquire_bot_lease(bot_id, node_id, expires_at, now):
     """
-    Миграция для добавления полей ограничения текстовых сообщений в существующую БД.
-    Эта функция безопасна для многократного вызова.
+    Берёт аренду бота, если она свободна или истекла.
+    
+    Returns:
+        Optional[int]: fencing-токен аренды или None, если бот арендован другим узлом.
+            Для аренды, уже принадлежащей узлу, возвращается её текущий токен.
     """
-    if not os.path.exists(DB_FILE):
-        return
+    init_db()
+    
+    def acquire(cursor):
+        row = cursor.execute('SELECT node_id, token, expires_at FROM bot_leases WHERE bot_id = ?',
+                             (bot_id,)).fetchone()
+        if row is None:
+            cursor.execute('INSERT INTO bot_leases (bot_id, node_id, token, expires_at) VALUES (?, ?, 1, ?)',
+                           (bot_id, node_id, expires_at))
+            return 1
+        holder, token, current_expiry = row
+        if current_expiry > now:
+            if holder != node_id:
+                return None
+        else:
+            token += 1
+        cursor.execute('UPDATE bot_leases SET node_id = ?, token = ?, expires_at = ? WHERE bot_id = ?',
+                       (node_id, token, expires_at, bot_id))
+        return token
+    
+    return _submit_write(acquire).result()
+
+def renew_bot_leases(node_id, tokens, expires_at):
+    """
+    Продлевает аренды узла одной транзакцией.
     
+    Args:
+        tokens (dict): bot_id -> fencing-токен аренды
+    
+    Returns:
+        set: ID ботов, аренда которых продлена; остальные перешли к другому узлу
+    """
+    if not tokens:
+        return set()
     init_db()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
     
-    try:
-        # Проверяем, существуют ли новые колонки
-        cursor.execute("PRAGMA table_info(bots)")
-        columns = [column[1] for column in cursor.fetchall()]
-        
-        # Добавляем недостающие колонки
-        if 'text_restriction_enabled' not in columns:
-            cursor.execute('''
-                ALTER TABLE bots ADD COLUMN text_restriction_enabled INTEGER DEFAULT 1
-            ''')
-            print("Добавлено поле text_restriction_enabled")
-        
-        if 'text_restriction_warning' not in columns:
-            cursor.execute('''
-                ALTER TABLE bots ADD COLUMN text_restriction_warning TEXT DEFAULT 'Для управления ботом, пожалуйста, используйте кнопки ⬇️'
-            ''')
-            print("Добавлено поле text_restriction_warning")
-        
-        if 'allowed_commands' not in columns:
-            cursor.execute('''
-                ALTER TABLE bots ADD COLUMN allowed_commands TEXT DEFAULT '["/start", "/help"]'
-            ''')
-            print("Добавлено поле allowed_commands")
-        
-        conn.commit()
-        print("Миграция успешно выполнена")
-        
-    except sqlite3.OperationalError as e:
-        print(f"Ошибка миграции: {e}")
-    finally:
-        conn.close()
+    def renew(cursor):
+        renewed = set()
+        for bot_id, token in tokens.items():
+            # Освобождённая аренда (expires_at = 0) не продлевается: продление, начатое
+            # до освобождения, иначе вернуло бы её узлу до истечения срока
+            cursor.execute('UPDATE bot_leases SET expires_at = ? '
+                           'WHERE bot_id = ? AND node_id = ? AND token = ? AND expires_at > 0',
+                           (expires_at, bot_id, node_id, token))
+            if cursor.rowcount:
+                renewed.add(bot_id)
+        return renewed
+    
+    return _submit_write(renew).result()
+
+def release_bot_lease(bot_id, node_id, token):
+    """Освобождает аренду: следующий узел получит её, не дожидаясь истечения."""
+    init_db()
+    _write('UPDATE bot_leases SET expires_at = 0 WHERE bot_id = ? AND node_id = ? AND token = ?',
+           (bot_id, node_id, token))
+
+def get_bot_lease_expiry(bot_id, token):
+    """Срок аренды бота с указанным токеном или None, если аренда перешла к другому токену."""
+    init_db()
+    with _connect() as conn:
+        row = conn.execute('SELECT token, expires_at FROM bot_leases WHERE bot_id = ?', (bot_id,)).fetchone()
+    return row[1] if row is not None and row[0] == token else None
+
+def is_bot_lease_valid(bot_id, token, now):
+    """Действует ли ещё аренда бота с указанным токеном."""
+    expires_at = get_bot_lease_expiry(bot_id, token)
+    return expires_at is not None and expires_at > now
+
+def request_bot_reload(bot_id):
+    """Просит узел-владелец перечитать flow, настройки и команды бота. Возвращает False, если аренды нет."""
+    init_db()
+    return _write('UPDATE bot_leases SET reload_seq = reload_seq + 1 WHERE bot_id = ?', (bot_id,)).rowcount > 0
+
+def request_bot_restart(bot_id):
+    """Просит узел-владелец перезапустить бота. Возвращает False, если аренды нет."""
+    init_db()
+    return _write('UPDATE bot_leases SET restart_seq = restart_seq + 1 WHERE bot_id = ?', (bot_id,)).rowcount > 0
 
 # ==========================================================================
 # Функции для работы с пользовательскими командами
@@ -429,124 +1710,81 @@ def add_custom_command(bot_id, command, description='', flow_data=None):
     if flow_data is None:
         flow_data = {'nodes': [], 'connections': []}
     
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
     now = datetime.now().isoformat()
     
     try:
-        cursor.execute('''
+        result = _write('''
             INSERT INTO custom_commands (bot_id, command, description, flow_data, enabled, created_at, updated_at)
             VALUES (?, ?, ?, ?, 1, ?, ?)
         ''', (bot_id, command, description, json.dumps(flow_data), now, now))
         
-        command_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        
-        return command_id
+        _invalidate_command(result.lastrowid, bot_id)
+        return result.lastrowid
     except sqlite3.IntegrityError:
-        conn.close()
         raise ValueError(f"Команда '{command}' уже существует для этого бота")
 
+_COMMAND_SELECT = '''
+    SELECT id, bot_id, command, description, flow_data, enabled, created_at, updated_at
+    FROM custom_commands
+'''
+
+def _command_from_row(cmd):
+    return {
+        'id': cmd[0],
+        'bot_id': cmd[1],
+        'command': cmd[2],
+        'description': cmd[3],
+        'flow_data': json.loads(cmd[4]) if cmd[4] else {'nodes': [], 'connections': []},
+        'enabled': bool(cmd[5]),
+        'created_at': cmd[6],
+        'updated_at': cmd[7]
+    }
+
+def _load_custom_commands(bot_id):
+    """Команды бота из кеша; словари разделяются между вызовами и не изменяются."""
+    def load():
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'{_COMMAND_SELECT} WHERE bot_id = ? ORDER BY command ASC', (bot_id,))
+            commands = cursor.fetchall()
+        return [_command_from_row(cmd) for cmd in commands]
+    
+    return _cached(_commands_cache, bot_id, load)
+
 def get_custom_commands(bot_id):
-    """Получает список всех пользовательских команд бота."""
+    """Получает список всех пользовательских команд бота (копии, которые можно изменять)."""
     if not os.path.exists(DB_FILE):
         return []
     init_db()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT id, bot_id, command, description, flow_data, enabled, created_at, updated_at
-        FROM custom_commands
-        WHERE bot_id = ?
-        ORDER BY command ASC
-    ''', (bot_id,))
-    
-    commands = cursor.fetchall()
-    conn.close()
-    
-    return [
-        {
-            'id': cmd[0],
-            'bot_id': cmd[1],
-            'command': cmd[2],
-            'description': cmd[3],
-            'flow_data': json.loads(cmd[4]) if cmd[4] else {'nodes': [], 'connections': []},
-            'enabled': bool(cmd[5]),
-            'created_at': cmd[6],
-            'updated_at': cmd[7]
-        }
-        for cmd in commands
-    ]
+    return copy.deepcopy(_load_custom_commands(bot_id))
 
 def get_custom_command(bot_id, command):
-    """Получает конкретную пользовательскую команду бота."""
+    """Получает конкретную пользовательскую команду бота (копию)."""
     if not os.path.exists(DB_FILE):
         return None
     init_db()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT id, bot_id, command, description, flow_data, enabled, created_at, updated_at
-        FROM custom_commands
-        WHERE bot_id = ? AND command = ?
-    ''', (bot_id, command))
-    
-    cmd = cursor.fetchone()
-    conn.close()
-    
-    if cmd:
-        return {
-            'id': cmd[0],
-            'bot_id': cmd[1],
-            'command': cmd[2],
-            'description': cmd[3],
-            'flow_data': json.loads(cmd[4]) if cmd[4] else {'nodes': [], 'connections': []},
-            'enabled': bool(cmd[5]),
-            'created_at': cmd[6],
-            'updated_at': cmd[7]
-        }
-    return None
+    cmd = next((cmd for cmd in _load_custom_commands(bot_id) if cmd['command'] == command), None)
+    return copy.deepcopy(cmd)
 
 def get_custom_command_by_id(command_id):
     """Получает пользовательскую команду по ID."""
     if not os.path.exists(DB_FILE):
         return None
     init_db()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
     
-    cursor.execute('''
-        SELECT id, bot_id, command, description, flow_data, enabled, created_at, updated_at
-        FROM custom_commands
-        WHERE id = ?
-    ''', (command_id,))
-    
-    cmd = cursor.fetchone()
-    conn.close()
-    
-    if cmd:
-        return {
-            'id': cmd[0],
-            'bot_id': cmd[1],
-            'command': cmd[2],
-            'description': cmd[3],
-            'flow_data': json.loads(cmd[4]) if cmd[4] else {'nodes': [], 'connections': []},
-            'enabled': bool(cmd[5]),
-            'created_at': cmd[6],
-            'updated_at': cmd[7]
-        }
-    return None
+    def load():
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'{_COMMAND_SELECT} WHERE id = ?', (command_id,))
+            cmd = cursor.fetchone()
+        return _command_from_row(cmd) if cmd else None
+    
+    # Копия: изменения вызывающего кода не должны попасть в кеш
+    return copy.deepcopy(_cached(_command_cache, command_id, load))
 
 def update_custom_command(command_id, command=None, description=None, flow_data=None, enabled=None):
     """Обновляет пользовательскую команду."""
     init_db()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
     updates = []
     values = []
     
@@ -568,23 +1806,14 @@ def update_custom_command(command_id, command=None, description=None, flow_data=
     values.append(command_id)
     
     if updates:
-        cursor.execute(f'UPDATE custom_commands SET {", ".join(updates)} WHERE id = ?', values)
-    
-    conn.commit()
-    conn.close()
+        _write_command(command_id, f'UPDATE custom_commands SET {", ".join(updates)} WHERE id = ?', values)
 
 def delete_custom_command(command_id):
     """Удаляет пользовательскую команду."""
     if not os.path.exists(DB_FILE):
         return
     init_db()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute('DELETE FROM custom_commands WHERE id = ?', (command_id,))
-    
-    conn.commit()
-    conn.close()
+    _write_command(command_id, 'DELETE FROM custom_commands WHERE id = ?', (command_id,))
 
 def save_custom_command_flow(command_id, flow_data):
     """Сохраняет flow для пользовательской команды."""
@@ -594,97 +1823,12 @@ def save_custom_command_flow(command_id, flow_data):
     if not nodes:
         raise ValueError("Cannot save empty flow - at least one node is required")
     
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
     now = datetime.now().isoformat()
-    
-    cursor.execute('''
+    _write_command(command_id, '''
         UPDATE custom_commands SET flow_data = ?, updated_at = ? WHERE id = ?
     ''', (json.dumps(flow_data), now, command_id))
-    
-    conn.commit()
-    conn.close()
 
 def get_custom_command_flow(command_id):
     """Получает flow пользовательской команды."""
-    if not os.path.exists(DB_FILE):
-        return None
-    init_db()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT flow_data FROM custom_commands WHERE id = ?', (command_id,))
-    result = cursor.fetchone()
-    
-    conn.close()
-    
-    if result:
-        return json.loads(result[0])
-    return None
-
-def migrate_add_custom_commands_table():
-    """
-    Миграция для добавления таблицы пользовательских команд в существующую БД.
-    Эта функция безопасна для многократного вызова.
-    """
-    if not os.path.exists(DB_FILE):
-        return
-    
-    init_db()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    try:
-        # Проверяем, существует ли таблица custom_commands
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='custom_commands'")
-        table_exists = cursor.fetchone()
-        
-        if not table_exists:
-            # Создаём таблицу custom_commands
-            cursor.execute('''
-                CREATE TABLE custom_commands (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    bot_id INTEGER NOT NULL,
-                    command TEXT NOT NULL,
-                    description TEXT,
-                    flow_data TEXT NOT NULL,
-                    enabled INTEGER DEFAULT 1,
-                    created_at TEXT,
-                    updated_at TEXT,
-                    UNIQUE(bot_id, command),
-                    FOREIGN KEY (bot_id) REFERENCES bots (id) ON DELETE CASCADE
-                )
-            ''')
-            print("Таблица custom_commands создана")
-        else:
-            print("Таблица custom_commands уже существует")
-        
-        conn.commit()
-        print("Миграция custom_commands выполнена успешно")
-        
-    except sqlite3.OperationalError as e:
-        print(f"Ошибка миграции: {e}")
-    finally:
-        conn.close()
-
-# БД больше не инициализируется автоматически при импорте модуля
-# Инициализация происходит при первом вызове любой функции, работающей с БД
-
-# =============================================================================
-# Автоматическое применение миграций при импорте модуля
-# =============================================================================
-def apply_migrations():
-    """Применяет все миграции базы данных."""
-    try:
-        migrate_add_text_restriction_fields()
-        migrate_add_custom_commands_table()
-    except Exception as e:
-        print(f"Ошибка при применении миграций: {e}")
-
-# Применяем миграции при импорте модуля (только если БД существует)
-if os.path.exists(DB_FILE):
-    apply_migrations()
-else:
-    # Если БД не существует, миграции будут применены при первой инициализации
-    init_db()
+    cmd = get_custom_command_by_id(command_id)
+    return cmd['flow_data'] if cmd else None
@@ -0,0 +1,144 @@
+"""
+Модуль fan_out.py
+=================
+
+Выполнение нод fan_out: несколько HTTP-запросов одновременно.
+
+Нода содержит список запросов requests в формате ноды api_request (method, url,
+headers, body, extractVars, ignoreError, cacheTtl, cacheKeyHeaders) и условие
+завершения:
+    waitFor  - сколько успешных ответов нужно дождаться (0 - все запросы);
+    timeout  - общий срок ожидания в секундах (по умолчанию API_REQUEST_TIMEOUT).
+
+Все запросы стартуют сразу в общем пуле потоков, поэтому время ноды равно
+времени самого медленного из нужных запросов, а не их сумме. Каждый запрос видит
+снимок переменных чата на момент входа в ноду; извлечённые значения успешных
+запросов сливаются в переменные чата в порядке запросов в ноде (при совпадении
+имён побеждает запрос, указанный позже). Запросы, не успевшие к сроку или
+оказавшиеся лишними после набора waitFor успехов, в результат не попадают.
+
+Нода уходит по соединению success, если условие выполнено, иначе - по error
+(или тоже по success при ignoreError).
+
+Настройки через переменные окружения:
+    FAN_OUT_MAX_WORKERS - потоков для запросов нод fan_out (по умолчанию 32)
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from api_request import API_REQUEST_TIMEOUT, ApiRequestSpec, load_json_field
+
+FAN_OUT_MAX_WORKERS = int(os.environ.get('FAN_OUT_MAX_WORKERS', 32))
+
+# Пул создаётся при первом выполнении ноды: процессы без ботов (веб-приложение
+# при отдельном раннере) импортируют модуль ради компиляции flow, но запросов не делают
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=FAN_OUT_MAX_WORKERS, thread_name_prefix='fan-out')
+    return _executor
+
+
+class FanOutResult:
+    """
+    Итог выполнения ноды fan_out.
+
+    Attributes:
+        ok (bool): Условие завершения выполнено
+        succeeded (int): Успешных запросов к моменту завершения
+        total (int): Запросов в ноде
+        errors (list): Пары (номер запроса, текст ошибки) для неуспешных и не успевших запросов
+    """
+
+    __slots__ = ('ok', 'succeeded', 'total', 'errors')
+
+    def __init__(self, ok, succeeded, total, errors):
+        self.ok = ok
+        self.succeeded = succeeded
+        self.total = total
+        self.errors = errors
+
+
+class FanOutSpec:
+    """
+    Скомпилированная нода fan_out.
+
+    Attributes:
+        branches (tuple): ApiRequestSpec для каждого запроса
+        required (int): Сколько успешных запросов нужно для перехода по success
+        timeout (float): Общий срок ожидания в секундах
+        ignore_error (bool): При невыполненном условии идти по соединению success
+    """
+
+    __slots__ = ('branches', 'required', 'timeout', 'ignore_error')
+
+    def __init__(self, node):
+        requests = load_json_field(node.get('requests'), [])
+        if not isinstance(requests, list) or not all(isinstance(item, dict) for item in requests):
+            raise ValueError('Поле requests должно быть списком запросов')
+        if not requests:
+            raise ValueError('Нет ни одного запроса')
+        self.branches = tuple(ApiRequestSpec(item) for item in requests)
+
+        try:
+            wait_for = int(node.get('waitFor') or 0)
+            self.timeout = float(node.get('timeout') or API_REQUEST_TIMEOUT)
+        except (TypeError, ValueError):
+            raise ValueError(f"Некорректные waitFor/timeout: {node.get('waitFor')!r}/{node.get('timeout')!r}")
+        if wait_for < 0 or self.timeout <= 0:
+            raise ValueError('waitFor не может быть отрицательным, timeout должен быть больше нуля')
+        self.required = min(wait_for, len(self.branches)) if wait_for else len(self.branches)
+        self.ignore_error = bool(node.get('ignoreError'))
+
+    def execute(self, variables):
+        """
+        Выполняет запросы одновременно и записывает извлечённые переменные успешных.
+
+        Returns:
+            FanOutResult
+        """
+        deadline = time.monotonic() + self.timeout
+        snapshot = dict(variables)
+        request_timeout = min(API_REQUEST_TIMEOUT, self.timeout)
+        executor = _get_executor()
+        futures = {
+            executor.submit(branch.run, snapshot, request_timeout): position
+            for position, branch in enumerate(self.branches)
+        }
+
+        pending = set(futures)
+        results = {}
+        succeeded = 0
+        errors = []
+        while pending and succeeded < self.required and succeeded + len(pending) >= self.required:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                position = futures[future]
+                ok, status, error, values = future.result()
+                if ok or self.branches[position].ignore_error:
+                    results[position] = values if ok else {}
+                    succeeded += 1
+                else:
+                    errors.append((position, error))
+
+        # Не начатые запросы больше не нужны; начатые завершатся по своему таймауту
+        for future in pending:
+            future.cancel()
+            errors.append((futures[future], 'Результат не дождались'))
+
+        for position in sorted(results):
+            variables.update(results[position])
+        errors.sort()
+        return FanOutResult(succeeded >= self.required, succeeded, len(self.branches), errors)
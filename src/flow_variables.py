@@ -0,0 +1,191 @@
+"""
+Модуль flow_variables.py
+========================
+
+Типизированные переменные чата: вычисление выражений трансформаций и подстановка в текст.
+
+Переменные хранятся в ChatSession.variables в исходных типах: int, float, bool, str,
+а также списки и словари (JSON). Выражение компилируется один раз в список токенов,
+ссылки {{var}} подставляются значениями без преобразования в строку и обратно.
+В строку значение переводится только при подстановке в текст сообщения (render_value).
+
+Правило сравнения строк и чисел сохранено: строка, состоящая из цифр (и, возможно,
+точки), считается числом - поэтому {{user_text}} == "999" истинно при вводе 999.
+"""
+
+import json
+import operator
+import re
+from functools import lru_cache
+
+VARIABLE_PATTERN = re.compile(r'\{\{(\w+)\}\}')
+
+OPERATORS = {
+    # Арифметические
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '//': operator.floordiv,
+    '%': operator.mod,
+    '**': operator.pow,
+    # Сравнения
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+    # Логические
+    'and': lambda a, b: bool(a and b),
+    'or': lambda a, b: bool(a or b),
+}
+
+# Виды токенов скомпилированного выражения
+_VALUE = 0
+_VARIABLE = 1
+_OPERATOR = 2
+
+
+def coerce(value):
+    """Переводит строку из цифр в int или float; остальные значения возвращает как есть."""
+    if isinstance(value, str):
+        if value.isdigit():
+            return int(value)
+        if '.' in value and value.replace('.', '').isdigit():
+            return float(value)
+    return value
+
+
+def render_value(value):
+    """Представление значения переменной в тексте сообщения."""
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+def render_template(text, variables):
+    """Заменяет {{var}} в тексте значениями переменных; неизвестные переменные остаются как есть."""
+    if '{{' not in text:
+        return text
+
+    def replace_var(match):
+        name = match.group(1)
+        if name not in variables:
+            return match.group(0)
+        return render_value(variables[name])
+
+    return VARIABLE_PATTERN.sub(replace_var, text)
+
+
+@lru_cache(maxsize=1024)
+def compile_expression(expr):
+    """
+    Разбирает выражение на токены: литералы, ссылки на переменные и операторы.
+
+    Returns:
+        tuple: Пары (вид токена, значение)
+
+    Raises:
+        ValueError: Недопустимый символ в выражении
+    """
+    tokens = []
+    i = 0
+    while i < len(expr):
+        # Пробелы пропускаем
+        if expr[i].isspace():
+            i += 1
+            continue
+
+        # Ссылки на переменные
+        match = VARIABLE_PATTERN.match(expr, i)
+        if match:
+            tokens.append((_VARIABLE, match.group(1)))
+            i = match.end()
+            continue
+
+        # Строки в кавычках
+        if expr[i] in '"\'':
+            quote = expr[i]
+            i += 1
+            start = i
+            while i < len(expr) and expr[i] != quote:
+                if expr[i] == '\\' and i + 1 < len(expr):
+                    i += 2
+                else:
+                    i += 1
+            tokens.append((_VALUE, coerce(expr[start:i])))
+            i += 1
+            continue
+
+        # Числа (целые и дробные)
+        if expr[i].isdigit() or expr[i] == '.':
+            start = i
+            while i < len(expr) and (expr[i].isdigit() or expr[i] == '.'):
+                i += 1
+            tokens.append((_VALUE, coerce(expr[start:i])))
+            continue
+
+        # Операторы (сначала трёх- и двухсимвольные)
+        if expr.startswith('and', i):
+            tokens.append((_OPERATOR, 'and'))
+            i += 3
+            continue
+        if i + 1 < len(expr) and expr[i:i + 2] in OPERATORS:
+            tokens.append((_OPERATOR, expr[i:i + 2]))
+            i += 2
+            continue
+
+        # Односимвольные операторы
+        if expr[i] in OPERATORS:
+            tokens.append((_OPERATOR, expr[i]))
+            i += 1
+            continue
+
+        # Неизвестные символы - ошибка
+        raise ValueError(f"Недопустимый символ: {expr[i]}")
+
+    return tuple(tokens)
+
+
+def evaluate(expr, variables):
+    """
+    Вычисляет выражение над переменными чата.
+
+    Операторы применяются слева направо без учёта приоритета.
+    Отсутствующая переменная равна пустой строке.
+
+    Returns:
+        Результат в исходном типе (число, bool, строка, ...), '' для пустого выражения
+
+    Raises:
+        ValueError: Недопустимый символ или оператор
+    """
+    tokens = compile_expression(expr)
+    if not tokens:
+        return ''
+
+    def operand(token):
+        kind, value = token
+        if kind == _VARIABLE:
+            return coerce(variables.get(value, ''))
+        if kind == _OPERATOR:
+            raise ValueError(f"Ожидалось значение, получен оператор: {value}")
+        return value
+
+    result = operand(tokens[0])
+
+    # Обрабатываем пары оператор-значение
+    i = 1
+    while i + 1 < len(tokens):
+        kind, op = tokens[i]
+        if kind != _OPERATOR:
+            raise ValueError(f"Неизвестный оператор: {op}")
+        result = OPERATORS[op](result, operand(tokens[i + 1]))
+        i += 2
+
+    return result
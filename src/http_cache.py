@@ -0,0 +1,112 @@
+"""
+Модуль http_cache.py
+====================
+
+Условные GET-запросы и сжатие больших JSON-ответов API.
+
+Ответ получает сильный ETag - хеш содержимого. Если клиент прислал его в
+If-None-Match, возвращается 304 без тела; тело при этом может вообще не
+формироваться, если ETag известен заранее (например, хранится в кеше flow).
+
+Клиентам, принимающим gzip, ответ крупнее GZIP_MIN_SIZE байт отдаётся сжатым.
+У сжатого представления свой ETag (с суффиксом -gzip), как того требует
+RFC 9110 для разных кодировок; If-None-Match принимает оба варианта. Сжатые тела
+хранятся в небольшом LRU-кеше по ETag, поэтому неизменившийся большой flow
+сжимается один раз, а не при каждой загрузке редактора.
+"""
+
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import current_app, request
+
+# Ответы меньше этого размера не сжимаются: выигрыш не окупает заголовки и CPU
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+# Сколько сжатых тел хранится в памяти
+GZIP_CACHE_MAX_ENTRIES = 64
+
+_GZIP_SUFFIX = '-gzip'
+
+_gzip_cache = OrderedDict()
+_gzip_lock = threading.Lock()
+
+
+def content_etag(body):
+    """Сильный ETag (без кавычек) для тела ответа: хеш содержимого."""
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def _accepts_gzip():
+    return 'gzip' in request.accept_encodings
+
+
+def _matching_etag(etag):
+    """Возвращает ETag представления, указанный клиентом в If-None-Match, или None."""
+    if_none_match = request.if_none_match
+    if not if_none_match:
+        return None
+    for candidate in (etag, etag + _GZIP_SUFFIX):
+        if if_none_match.contains_weak(candidate):
+            return candidate
+    return None
+
+
+def _compressed(etag, body):
+    with _gzip_lock:
+        data = _gzip_cache.get(etag)
+        if data is not None:
+            _gzip_cache.move_to_end(etag)
+            return data
+    data = gzip.compress(body, compresslevel=GZIP_LEVEL)
+    with _gzip_lock:
+        _gzip_cache[etag] = data
+        while len(_gzip_cache) > GZIP_CACHE_MAX_ENTRIES:
+            _gzip_cache.popitem(last=False)
+    return data
+
+
+def cached_json_response(body, etag=None):
+    """
+    Формирует ответ с готовым JSON-телом, ETag и, при возможности, gzip-сжатием.
+
+    Args:
+        body: JSON-строка или bytes, либо функция без аргументов, возвращающая их.
+            Функция вызывается только если клиенту действительно нужно тело.
+        etag: ETag без кавычек; если не указан, вычисляется по телу
+
+    Returns:
+        Response: 200 с телом или 304 без тела
+    """
+    if etag is None:
+        if callable(body):
+            body = body()
+        etag = content_etag(body)
+
+    response_class = current_app.response_class
+    matched = _matching_etag(etag)
+    if matched is not None:
+        response = response_class(status=304)
+        etag = matched
+    else:
+        if callable(body):
+            body = body()
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        response = response_class(mimetype='application/json')
+        if len(body) >= GZIP_MIN_SIZE and _accepts_gzip():
+            response.set_data(_compressed(etag, body))
+            response.headers['Content-Encoding'] = 'gzip'
+            etag += _GZIP_SUFFIX
+        else:
+            response.set_data(body)
+
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    # Клиент может хранить ответ, но обязан перепроверять его при каждом использовании
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
@@ -0,0 +1,252 @@
+"""
+Модуль json_patch.py
+====================
+
+Применение JSON Patch (RFC 6902) к документам flow и построение патча между
+двумя версиями документа (make_patch) - для истории ревизий flow.
+
+Поддерживаются все операции: add, remove, replace, move, copy, test; пути -
+JSON Pointer (RFC 6901), включая экранирование ~0/~1 и "-" для конца массива.
+
+Исходный документ не изменяется: он может лежать в кеше и разделяться между
+потоками. Вместо полной копии применяется копирование по пути - копируются
+только контейнеры на пути к изменённым значениям, остальные поддеревья
+разделяются со старым документом. Правка текста одной ноды большого flow
+копирует корень, список nodes и саму ноду.
+
+Патч применяется целиком или не применяется вовсе: при ошибке в любой
+операции исходный документ остаётся прежним, а частично изменённая копия
+отбрасывается.
+"""
+
+import copy
+
+OPERATIONS = ('add', 'remove', 'replace', 'move', 'copy', 'test')
+
+
+class JsonPatchError(ValueError):
+    """Некорректный патч или операция, неприменимая к документу."""
+
+
+def parse_pointer(pointer):
+    """
+    Разбирает JSON Pointer в список ключей.
+
+    Raises:
+        JsonPatchError: Указатель не пустой и не начинается с "/"
+    """
+    if not isinstance(pointer, str):
+        raise JsonPatchError(f'Путь должен быть строкой: {pointer!r}')
+    if pointer == '':
+        return []
+    if not pointer.startswith('/'):
+        raise JsonPatchError(f'Путь должен начинаться с "/": {pointer!r}')
+    return [token.replace('~1', '/').replace('~0', '~') for token in pointer[1:].split('/')]
+
+
+def _array_index(array, token, pointer, allow_end=False):
+    if allow_end and token == '-':
+        return len(array)
+    if not token.isdigit() or (len(token) > 1 and token[0] == '0'):
+        raise JsonPatchError(f'Некорректный индекс массива "{token}" в пути {pointer}')
+    index = int(token)
+    limit = len(array) + 1 if allow_end else len(array)
+    if index >= limit:
+        raise JsonPatchError(f'Индекс {index} за пределами массива в пути {pointer}')
+    return index
+
+
+def _json_equal(a, b):
+    """Сравнение по правилам JSON: true не равно 1, порядок ключей объекта не важен."""
+    if isinstance(a, bool) or isinstance(b, bool):
+        return isinstance(a, bool) and isinstance(b, bool) and a == b
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(_json_equal(a[key], b[key]) for key in a)
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(_json_equal(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+class _PatchedDocument:
+    """Документ, изменяемый копированием по пути."""
+
+    def __init__(self, document):
+        self.root = document
+        # id -> контейнер, созданный при применении этого патча (его можно менять на месте)
+        self._owned = {}
+
+    def _own(self, value):
+        if isinstance(value, (dict, list)) and id(value) not in self._owned:
+            value = value.copy()
+            self._owned[id(value)] = value
+        return value
+
+    def resolve(self, tokens, pointer):
+        """Возвращает значение по пути без изменения документа."""
+        value = self.root
+        for token in tokens:
+            if isinstance(value, dict):
+                if token not in value:
+                    raise JsonPatchError(f'Путь не найден: {pointer}')
+                value = value[token]
+            elif isinstance(value, list):
+                value = value[_array_index(value, token, pointer)]
+            else:
+                raise JsonPatchError(f'Путь не найден: {pointer}')
+        return value
+
+    def writable_parent(self, tokens, pointer):
+        """Возвращает изменяемый контейнер-родитель для последнего ключа пути."""
+        self.root = self._own(self.root)
+        parent = self.root
+        for token in tokens[:-1]:
+            if isinstance(parent, dict):
+                if token not in parent:
+                    raise JsonPatchError(f'Путь не найден: {pointer}')
+                key = token
+            elif isinstance(parent, list):
+                key = _array_index(parent, token, pointer)
+            else:
+                raise JsonPatchError(f'Путь не найден: {pointer}')
+            child = self._own(parent[key])
+            parent[key] = child
+            parent = child
+        if not isinstance(parent, (dict, list)):
+            raise JsonPatchError(f'Путь не найден: {pointer}')
+        return parent
+
+    def add(self, tokens, pointer, value):
+        if not tokens:
+            self.root = value
+            return
+        parent = self.writable_parent(tokens, pointer)
+        if isinstance(parent, dict):
+            parent[tokens[-1]] = value
+        else:
+            parent.insert(_array_index(parent, tokens[-1], pointer, allow_end=True), value)
+
+    def remove(self, tokens, pointer):
+        if not tokens:
+            raise JsonPatchError('Нельзя удалить корень документа')
+        parent = self.writable_parent(tokens, pointer)
+        if isinstance(parent, dict):
+            if tokens[-1] not in parent:
+                raise JsonPatchError(f'Путь не найден: {pointer}')
+            return parent.pop(tokens[-1])
+        return parent.pop(_array_index(parent, tokens[-1], pointer))
+
+    def replace(self, tokens, pointer, value):
+        if not tokens:
+            self.root = value
+            return
+        parent = self.writable_parent(tokens, pointer)
+        if isinstance(parent, dict):
+            if tokens[-1] not in parent:
+                raise JsonPatchError(f'Путь не найден: {pointer}')
+            parent[tokens[-1]] = value
+        else:
+            parent[_array_index(parent, tokens[-1], pointer)] = value
+
+
+def apply_patch(document, patch):
+    """
+    Применяет JSON Patch и возвращает новый документ; исходный не изменяется.
+
+    Args:
+        document: Разобранный JSON-документ
+        patch (list): Операции RFC 6902 ({"op": ..., "path": ..., ...})
+
+    Raises:
+        JsonPatchError: Некорректная операция, несуществующий путь или неуспешный test
+    """
+    if not isinstance(patch, list):
+        raise JsonPatchError('Патч должен быть списком операций')
+
+    doc = _PatchedDocument(document)
+    for number, operation in enumerate(patch, 1):
+        if not isinstance(operation, dict):
+            raise JsonPatchError(f'Операция {number}: ожидается объект')
+        op = operation.get('op')
+        if op not in OPERATIONS:
+            raise JsonPatchError(f'Операция {number}: неизвестная операция {op!r}')
+        if 'path' not in operation:
+            raise JsonPatchError(f'Операция {number}: нет поля path')
+        pointer = operation['path']
+        tokens = parse_pointer(pointer)
+        if op in ('add', 'replace', 'test') and 'value' not in operation:
+            raise JsonPatchError(f'Операция {number}: нет поля value')
+
+        if op == 'add':
+            doc.add(tokens, pointer, operation['value'])
+        elif op == 'remove':
+            doc.remove(tokens, pointer)
+        elif op == 'replace':
+            doc.replace(tokens, pointer, operation['value'])
+        elif op == 'test':
+            if not _json_equal(doc.resolve(tokens, pointer), operation['value']):
+                raise JsonPatchError(f'Операция {number}: test не выполнен для {pointer}')
+        else:
+            if 'from' not in operation:
+                raise JsonPatchError(f'Операция {number}: нет поля from')
+            source = operation['from']
+            source_tokens = parse_pointer(source)
+            if op == 'move':
+                if source_tokens == tokens:
+                    continue
+                if tokens[:len(source_tokens)] == source_tokens:
+                    raise JsonPatchError(f'Операция {number}: нельзя переместить {source} внутрь себя')
+                value = doc.remove(source_tokens, source)
+            else:
+                value = copy.deepcopy(doc.resolve(source_tokens, source))
+            doc.add(tokens, pointer, value)
+    return doc.root
+
+
+def _escape(key):
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def _diff(before, after, path, ops):
+    if before is after:
+        return
+    if isinstance(before, dict) and isinstance(after, dict):
+        for key in before:
+            if key not in after:
+                ops.append({'op': 'remove', 'path': f'{path}/{_escape(key)}'})
+        for key, value in after.items():
+            if key not in before:
+                ops.append({'op': 'add', 'path': f'{path}/{_escape(key)}', 'value': value})
+            else:
+                _diff(before[key], value, f'{path}/{_escape(key)}', ops)
+        return
+    if isinstance(before, list) and isinstance(after, list):
+        # Общие начало и конец не меняются; вставка или удаление в середине дают одну операцию
+        start = 0
+        while start < len(before) and start < len(after) and _json_equal(before[start], after[start]):
+            start += 1
+        end_before, end_after = len(before), len(after)
+        while end_before > start and end_after > start and _json_equal(before[end_before - 1], after[end_after - 1]):
+            end_before -= 1
+            end_after -= 1
+        paired = min(end_before, end_after) - start
+        for i in range(start, start + paired):
+            _diff(before[i], after[i], f'{path}/{i}', ops)
+        for i in range(end_before - 1, start + paired - 1, -1):
+            ops.append({'op': 'remove', 'path': f'{path}/{i}'})
+        for i in range(start + paired, end_after):
+            ops.append({'op': 'add', 'path': f'{path}/{i}', 'value': after[i]})
+        return
+    if not _json_equal(before, after):
+        ops.append({'op': 'replace', 'path': path, 'value': after})
+
+
+def make_patch(before, after):
+    """
+    Строит JSON Patch, переводящий документ before в after.
+
+    Словари сравниваются по ключам, у списков отбрасываются совпадающие начало
+    и конец, поэтому вставка или удаление ноды в середине flow - одна операция.
+    """
+    ops = []
+    _diff(before, after, '', ops)
+    return ops
@@ -0,0 +1,391 @@
+"""
+Модуль leases.py
+================
+
+Распределение ботов между несколькими узлами раннеров (runner.py) через общую БД.
+
+Каждый бот должен опрашивать ровно один узел: два опрашивающих процесса делят
+marker и отвечают на одно сообщение дважды. Право на бота выдаётся арендой
+(таблица bot_leases) на BOT_LEASE_TTL секунд:
+
+- узел регистрируется в runner_nodes и раз в BOT_LEASE_RENEW_INTERVAL секунд
+  отмечается живым и продлевает свои аренды (отдельный поток, который не ждёт
+  запуска и остановки ботов), а также сверяет распределение; боты, снятые при
+  сверке, останавливаются в фоне;
+- владелец бота - живой узел с наибольшим хешем (узел, bot_id) (rendezvous hashing):
+  все узлы вычисляют одно и то же распределение без координатора, а при
+  появлении или уходе узла переезжают только боты, затронутые изменением;
+- аренда берётся, только если она свободна или истекла; каждая смена владельца
+  увеличивает fencing-токен. Бот опрашивает обновления и сохраняет состояния
+  чатов только с действующим токеном, поэтому «зависший» узел, потерявший аренду,
+  не ответит пользователям и не перезапишет состояния нового владельца;
+- узел, переставший отмечаться, через BOT_LEASE_TTL секунд теряет аренды, и его
+  боты подхватывают остальные узлы; при штатной остановке аренды освобождаются сразу.
+
+Желаемое состояние бота - статус в таблице bots: команды запуска и остановки
+меняют его, а боты запускает и останавливает узел-владелец. Перезагрузку и
+перезапуск бота, арендованного другим узлом, узел-владелец выполняет по счётчикам
+reload_seq и restart_seq в строке аренды.
+
+Срок аренды сравнивается по часам узлов: их рассинхронизация должна быть заметно
+меньше BOT_LEASE_TTL.
+
+Настройки через переменные окружения:
+    BOT_LEASES                - 1 - включить аренды (раннер работает как один из узлов)
+    RUNNER_NODE_ID            - имя узла (по умолчанию <hostname>-<pid>)
+    BOT_LEASE_TTL             - срок аренды и признак живого узла в секундах (по умолчанию 6)
+    BOT_LEASE_RENEW_INTERVAL  - период продления и сверки в секундах (по умолчанию 2)
+"""
+
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+
+from database import (get_bot, get_bot_summaries, update_bot_status, heartbeat_runner_node,
+                      get_runner_nodes, remove_runner_nodes, get_bot_leases, acquire_bot_lease,
+                      renew_bot_leases, release_bot_lease, request_bot_reload, request_bot_restart)
+from bot_manager import flow_is_startable
+
+BOT_LEASES = os.environ.get('BOT_LEASES', '') == '1'
+RUNNER_NODE_ID = os.environ.get('RUNNER_NODE_ID', '')
+BOT_LEASE_TTL = float(os.environ.get('BOT_LEASE_TTL', 6))
+BOT_LEASE_RENEW_INTERVAL = float(os.environ.get('BOT_LEASE_RENEW_INTERVAL', 2))
+
+# Узлы, молчащие дольше, удаляются из runner_nodes
+NODE_FORGET_AFTER = 3600
+# Пауза перед повторной попыткой запустить бота, который не удалось запустить
+START_RETRY_INTERVAL = 30
+
+logger = logging.getLogger(__name__)
+
+
+def rendezvous_owner(bot_id, nodes):
+    """Узел-владелец бота среди nodes: узел с наибольшим хешем пары (узел, bot_id)."""
+    return max(nodes, key=lambda node: hashlib.blake2b(f'{node}:{bot_id}'.encode('utf-8'), digest_size=8).digest())
+
+
+class LeaseBotManager:
+    """
+    Узел раннера, запускающий только арендованных им ботов; интерфейс BotManager.
+
+    Attributes:
+        local: BotManager или PoolBotManager, в котором работают боты этого узла
+        node_id (str): Имя узла
+        held (dict): bot_id -> fencing-токен арендованных узлом ботов
+        live_nodes (tuple): Живые узлы по результатам последней сверки
+    """
+
+    def __init__(self, local, node_id=RUNNER_NODE_ID):
+        self.local = local
+        self.node_id = node_id or f'{socket.gethostname()}-{os.getpid()}'
+        self.held = {}
+        self.live_nodes = (self.node_id,)
+        # bot_id -> (токен, освободить ли аренду, поток) ботов, которые останавливаются в фоне;
+        # пока бот не остановлен, он не запускается снова, а его аренда продлевается
+        self._draining = {}
+        # bot_id -> (reload_seq, restart_seq), уже выполненные этим узлом
+        self._applied = {}
+        self._start_failed_at = {}
+        # _lock - сверка и команды управления; _state_lock - короткие изменения held/_draining,
+        # на которых продление аренд никогда не ждёт запуска и остановки ботов
+        self._lock = threading.RLock()
+        self._state_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._renew_thread = None
+        self.acquired = 0
+        self.lost = 0
+        self.handed_over = 0
+        if BOT_LEASE_TTL < 2 * BOT_LEASE_RENEW_INTERVAL:
+            logger.warning(f"[Leases] BOT_LEASE_TTL={BOT_LEASE_TTL} меньше двух периодов продления "
+                           f"({BOT_LEASE_RENEW_INTERVAL} с): одна задержка записи в БД приведёт к потере аренд")
+
+    # ------------------------------------------------------------------
+    # Продление аренд
+    # ------------------------------------------------------------------
+
+    def _renew_loop(self):
+        while not self._stopping.wait(BOT_LEASE_RENEW_INTERVAL):
+            try:
+                self.renew()
+            except Exception as e:
+                logger.error(f"[Leases] Ошибка продления аренд узла {self.node_id}: {e}")
+
+    def renew(self):
+        """Отмечает узел живым и продлевает его аренды; не ждёт запуска и остановки ботов."""
+        now = time.time()
+        heartbeat_runner_node(self.node_id, socket.gethostname(), os.getpid(), now)
+        with self._state_lock:
+            tokens = dict(self.held)
+            tokens.update({bot_id: token for bot_id, (token, release, _) in self._draining.items() if release})
+        if not tokens:
+            return
+        renewed = renew_bot_leases(self.node_id, tokens, now + BOT_LEASE_TTL)
+        for bot_id, token in tokens.items():
+            if bot_id in renewed:
+                continue
+            with self._state_lock:
+                # Бот мог быть снят или перезапущен с новым токеном, пока шло продление
+                if self.held.get(bot_id) != token:
+                    continue
+            logger.warning(f"[Leases] Аренда бота [ID:{bot_id}] перешла к другому узлу")
+            self.lost += 1
+            self._drop(bot_id, release=False)
+
+    # ------------------------------------------------------------------
+    # Сверка
+    # ------------------------------------------------------------------
+
+    def _loop(self):
+        while not self._stopping.is_set():
+            self._wake.wait(BOT_LEASE_RENEW_INTERVAL)
+            self._wake.clear()
+            if self._stopping.is_set():
+                return
+            try:
+                self.reconcile()
+            except Exception as e:
+                logger.error(f"[Leases] Ошибка сверки аренд узла {self.node_id}: {e}")
+
+    def reconcile(self):
+        """Один такт: передача и захват ботов. Аренды продлевает отдельный поток (renew)."""
+        with self._lock:
+            now = time.time()
+            nodes = get_runner_nodes()
+            self.live_nodes = tuple(sorted(
+                {node['node_id'] for node in nodes if node['heartbeat_at'] >= now - BOT_LEASE_TTL} | {self.node_id}
+            ))
+            remove_runner_nodes([node['node_id'] for node in nodes
+                                 if node['heartbeat_at'] < now - NODE_FORGET_AFTER])
+
+            desired = {bot['id'] for bot in get_bot_summaries() if bot['status'] == 'running'}
+            leases = get_bot_leases()
+            with self._state_lock:
+                held = set(self.held)
+                draining = set(self._draining)
+
+            for bot_id in sorted(held):
+                if bot_id not in desired:
+                    self._drop(bot_id)
+                elif self._owner(bot_id) != self.node_id:
+                    logger.info(f"[Leases] Бот [ID:{bot_id}] передаётся узлу {self._owner(bot_id)}")
+                    self.handed_over += 1
+                    self._drop(bot_id)
+                else:
+                    self._apply_requests(bot_id, leases.get(bot_id))
+
+            for bot_id in sorted(desired - held - draining):
+                if self._owner(bot_id) != self.node_id:
+                    continue
+                if now - self._start_failed_at.get(bot_id, 0) < START_RETRY_INTERVAL:
+                    continue
+                token = acquire_bot_lease(bot_id, self.node_id, now + BOT_LEASE_TTL, now)
+                if token is None:
+                    continue
+                if self.local.start_bot(bot_id, token):
+                    lease = leases.get(bot_id) or {}
+                    with self._state_lock:
+                        self.held[bot_id] = token
+                        self._applied[bot_id] = (lease.get('reload_seq', 0), lease.get('restart_seq', 0))
+                    self._start_failed_at.pop(bot_id, None)
+                    self.acquired += 1
+                    logger.info(f"[Leases] Узел {self.node_id} запустил бот [ID:{bot_id}], токен {token}")
+                else:
+                    self._start_failed_at[bot_id] = now
+                    release_bot_lease(bot_id, self.node_id, token)
+
+    def _owner(self, bot_id):
+        return rendezvous_owner(bot_id, self.live_nodes)
+
+    def _drop(self, bot_id, release=True):
+        """
+        Снимает бота с узла, не меняя желаемый статус.
+
+        Остановка (ожидание потока опроса до 5 с) идёт в фоновом потоке, поэтому
+        снятие нескольких ботов за такт не задерживает сверку. Аренда продлевается
+        до конца остановки и затем освобождается: новый владелец не начнёт опрос,
+        пока старый экземпляр ещё получает обновления.
+
+        Returns:
+            threading.Thread: Поток остановки или None, если бот уже снят
+        """
+        with self._state_lock:
+            token = self.held.pop(bot_id, None)
+            if token is None:
+                return None
+            self._applied.pop(bot_id, None)
+            thread = threading.Thread(target=self._stop_dropped, args=(bot_id, token, release),
+                                      name=f'bot-lease-drop-{bot_id}', daemon=True)
+            self._draining[bot_id] = (token, release, thread)
+        thread.start()
+        return thread
+
+    def _stop_dropped(self, bot_id, token, release):
+        try:
+            self.local.stop_bot(bot_id, False)
+            if release:
+                release_bot_lease(bot_id, self.node_id, token)
+        except Exception as e:
+            logger.error(f"[Leases] Ошибка остановки бота [ID:{bot_id}]: {e}")
+        finally:
+            with self._state_lock:
+                self._draining.pop(bot_id, None)
+            # Бот снова может быть запущен, если он опять должен работать на этом узле
+            self._wake.set()
+
+    def _apply_requests(self, bot_id, lease):
+        """Выполняет перезагрузку и перезапуск, запрошенные через другие узлы."""
+        token = self.held.get(bot_id)
+        if lease is None or token is None:
+            return
+        reload_seq, restart_seq = self._applied.get(bot_id, (0, 0))
+        if lease['restart_seq'] != restart_seq:
+            self.local.stop_bot(bot_id, False)
+            self.local.start_bot(bot_id, token)
+        elif lease['reload_seq'] != reload_seq:
+            self.local.reload_flow(bot_id)
+            self.local.reload_restriction(bot_id)
+            self.local.reload_custom_commands(bot_id)
+        self._applied[bot_id] = (lease['reload_seq'], lease['restart_seq'])
+
+    def _held_elsewhere(self, bot_id, leases=None):
+        lease = (leases if leases is not None else get_bot_leases()).get(bot_id)
+        return lease is not None and lease['node_id'] != self.node_id and lease['expires_at'] > time.time()
+
+    # ------------------------------------------------------------------
+    # Интерфейс BotManager
+    # ------------------------------------------------------------------
+
+    def start_bot(self, bot_id, lease_token=None):
+        """Отмечает бота как работающего; запустит его узел-владелец при ближайшей сверке."""
+        if not flow_is_startable(bot_id):
+            return False
+        update_bot_status(bot_id, 'running')
+        self._wake.set()
+        return True
+
+    def stop_bot(self, bot_id, persist=True):
+        """Отмечает бота как остановленного; арендованный этим узлом бот останавливается сразу."""
+        if persist:
+            update_bot_status(bot_id, 'stopped')
+        with self._lock:
+            thread = self._drop(bot_id)
+        if thread is not None:
+            thread.join()
+        self._wake.set()
+        return True
+
+    def restart_bot(self, bot_id):
+        with self._lock:
+            token = self.held.get(bot_id)
+            if token is not None:
+                self.local.stop_bot(bot_id, False)
+                return self.local.start_bot(bot_id, token)
+        if self._held_elsewhere(bot_id):
+            return request_bot_restart(bot_id)
+        return self.start_bot(bot_id)
+
+    def _reload(self, bot_id, method):
+        with self._lock:
+            if bot_id in self.held:
+                return getattr(self.local, method)(bot_id)
+        if self._held_elsewhere(bot_id):
+            return request_bot_reload(bot_id)
+        return False
+
+    def reload_flow(self, bot_id):
+        return self._reload(bot_id, 'reload_flow')
+
+    def reload_restriction(self, bot_id):
+        return self._reload(bot_id, 'reload_restriction')
+
+    def reload_custom_commands(self, bot_id):
+        return self._reload(bot_id, 'reload_custom_commands')
+
+    def get_bot_status(self, bot_id):
+        if bot_id in self.held:
+            return self.local.get_bot_status(bot_id)
+        if self._held_elsewhere(bot_id):
+            return 'running'
+        bot = get_bot(bot_id)
+        return bot['status'] if bot else None
+
+    def get_bot_statuses(self, stored_statuses):
+        statuses = dict(stored_statuses)
+        held = {bot_id: status for bot_id, status in statuses.items() if bot_id in self.held}
+        if held:
+            statuses.update(self.local.get_bot_statuses(held))
+        leases = get_bot_leases()
+        for bot_id in statuses:
+            if bot_id not in held and self._held_elsewhere(bot_id, leases):
+                statuses[bot_id] = 'running'
+        return statuses
+
+    def get_recent_logs(self, bot_id, limit=100):
+        return self.local.get_recent_logs(bot_id, limit) if bot_id in self.held else None
+
+    def clear_recent_logs(self, bot_id):
+        if bot_id in self.held:
+            self.local.clear_recent_logs(bot_id)
+
+    def get_session_stats(self, bot_id):
+        return self.local.get_session_stats(bot_id) if bot_id in self.held else None
+
+    def get_bot_health(self, bot_id):
+        return self.local.get_bot_health(bot_id) if bot_id in self.held else None
+
+    def api_cache_stats(self):
+        return self.local.api_cache_stats()
+
+    def upstream_stats(self):
+        return self.local.upstream_stats()
+
+    def start_saved_bots(self):
+        """Выполняет первую сверку и запускает фоновые сверку и продление. Возвращает ID ботов, арендованных узлом."""
+        self.renew()
+        self.reconcile()
+        if self._thread is None:
+            self._renew_thread = threading.Thread(target=self._renew_loop, name='bot-lease-renew', daemon=True)
+            self._renew_thread.start()
+            self._thread = threading.Thread(target=self._loop, name='bot-leases', daemon=True)
+            self._thread.start()
+        return sorted(self.held)
+
+    def ping(self):
+        info = self.local.ping()
+        info.update({
+            'node_id': self.node_id,
+            'nodes': list(self.live_nodes),
+            'leases': len(self.held),
+            'draining': len(self._draining),
+            'acquired': self.acquired,
+            'lost': self.lost,
+            'handed_over': self.handed_over
+        })
+        return info
+
+    def shutdown(self):
+        """Останавливает ботов узла и освобождает аренды, чтобы их сразу подхватили другие узлы."""
+        self._stopping.set()
+        self._wake.set()
+        for thread in (self._thread, self._renew_thread):
+            if thread is not None:
+                thread.join(timeout=BOT_LEASE_RENEW_INTERVAL + 10)
+        with self._state_lock:
+            drains = [thread for _, _, thread in self._draining.values()]
+        for thread in drains:
+            thread.join()
+        with self._lock:
+            with self._state_lock:
+                held, self.held = dict(self.held), {}
+            self.local.shutdown()
+            for bot_id, token in held.items():
+                try:
+                    release_bot_lease(bot_id, self.node_id, token)
+                except Exception as e:
+                    logger.error(f"[Leases] Не удалось освободить аренду бота [ID:{bot_id}]: {e}")
+            remove_runner_nodes([self.node_id])
@@ -0,0 +1,236 @@
+"""
+Модуль log_archive.py
+=====================
+
+Структурированный архив логов ботов в каталоге data/logs.
+
+Каждая запись лога пишется одной строкой NDJSON с полями timestamp, level, bot_id,
+chat_id, node_id, event, latency_ms и message (пустые поля не пишутся).
+Записи попадают в текущий сегмент; сегмент закрывается при превышении
+размера или возраста, после чего фоновый поток сжимает его в .ndjson.gz.
+
+Тот же фоновый поток периодически удаляет из SQLite логи старше «горячего окна»:
+долговременная история и офлайн-анализ работают с последовательными файлами архива.
+Очистка общая для всех процессов, поэтому включается только в одном из них
+(enable_pruning): в раннере или, если раннера нет, в веб-приложении.
+
+Настройки через переменные окружения:
+    LOG_SEGMENT_MAX_BYTES   - максимальный размер сегмента (по умолчанию 64 МБ)
+    LOG_SEGMENT_MAX_AGE     - максимальный возраст сегмента в секундах (по умолчанию 3600)
+    LOG_HOT_WINDOW_HOURS    - сколько часов логи хранятся в SQLite (по умолчанию 168, 0 - без очистки)
+"""
+
+import atexit
+import glob
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from database import LOGS_DIR, prune_bot_logs
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = 'bots-'
+SEGMENT_SUFFIX = '.ndjson'
+
+# Как часто фоновый поток проверяет возраст сегмента и чистит SQLite (секунды)
+MAINTENANCE_INTERVAL = 60
+
+
+class LogArchive:
+    """
+    Потокобезопасный приёмник структурированных логов с ротацией сегментов.
+
+    Attributes:
+        logs_dir (str): Каталог с сегментами
+        max_segment_bytes (int): Размер, после которого сегмент закрывается
+        max_segment_age (float): Возраст сегмента в секундах, после которого он закрывается
+        hot_window (Optional[timedelta]): Сколько логов хранить в SQLite (None - не чистить)
+    """
+
+    def __init__(
+        self,
+        logs_dir: str = LOGS_DIR,
+        max_segment_bytes: int = 64 * 1024 * 1024,
+        max_segment_age: float = 3600,
+        hot_window: Optional[timedelta] = timedelta(days=7)
+    ):
+        self.logs_dir = logs_dir
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_age = max_segment_age
+        self.hot_window = hot_window
+
+        self._lock = threading.Lock()
+        self._file = None
+        self._path = None
+        self._size = 0
+        self._opened_at = 0.0
+
+        self._compress_queue = queue.Queue()
+        self._thread = None
+        self._stopped = threading.Event()
+        # Чистит ли этот процесс SQLite (см. enable_pruning)
+        self._prune = False
+
+    # ------------------------------------------------------------------
+    # Запись
+    # ------------------------------------------------------------------
+
+    def write(self, record: dict):
+        """
+        Записывает одну структурированную запись в текущий сегмент.
+
+        Args:
+            record: Словарь с полями записи. Поля со значением None не сохраняются.
+        """
+        line = json.dumps(
+            {key: value for key, value in record.items() if value is not None},
+            ensure_ascii=False
+        ) + '\n'
+        data = line.encode('utf-8')
+
+        with self._lock:
+            self._ensure_started()
+            if self._file is not None and self._segment_is_full(len(data)):
+                self._rotate()
+            if self._file is None:
+                self._open_segment()
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data)
+
+    def close(self):
+        """Закрывает текущий сегмент и дожидается сжатия закрытых сегментов."""
+        with self._lock:
+            if self._file is not None:
+                self._rotate()
+        if self._thread is not None:
+            self._stopped.set()
+            self._compress_queue.put(None)
+            self._thread.join(timeout=30)
+            self._thread = None
+
+    def _segment_is_full(self, incoming: int) -> bool:
+        if self._size + incoming > self.max_segment_bytes:
+            return True
+        return time.monotonic() - self._opened_at >= self.max_segment_age
+
+    def _open_segment(self):
+        os.makedirs(self.logs_dir, exist_ok=True)
+        name = f"{SEGMENT_PREFIX}{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{os.getpid()}{SEGMENT_SUFFIX}"
+        self._path = os.path.join(self.logs_dir, name)
+        self._file = open(self._path, 'ab')
+        self._size = 0
+        self._opened_at = time.monotonic()
+
+    def _rotate(self):
+        """Закрывает текущий сегмент и ставит его в очередь на сжатие."""
+        self._file.close()
+        self._compress_queue.put(self._path)
+        self._file = None
+        self._path = None
+        self._size = 0
+
+    # ------------------------------------------------------------------
+    # Фоновое обслуживание
+    # ------------------------------------------------------------------
+
+    def enable_pruning(self):
+        """Включает в этом процессе очистку SQLite от логов старше hot_window."""
+        with self._lock:
+            self._prune = True
+            self._ensure_started()
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._stopped.clear()
+            for path in self._orphan_segments():
+                self._compress_queue.put(path)
+            self._thread = threading.Thread(target=self._maintenance_loop, daemon=True)
+            self._thread.start()
+
+    def _orphan_segments(self):
+        """Несжатые сегменты процессов, которые уже завершились (например, после падения)."""
+        for path in glob.glob(os.path.join(self.logs_dir, f'{SEGMENT_PREFIX}*{SEGMENT_SUFFIX}')):
+            try:
+                pid = int(os.path.basename(path)[:-len(SEGMENT_SUFFIX)].rsplit('-', 1)[1])
+            except (IndexError, ValueError):
+                continue
+            if pid != os.getpid() and not _process_alive(pid):
+                yield path
+
+    def _maintenance_loop(self):
+        last_prune = 0.0
+        while not self._stopped.is_set():
+            try:
+                path = self._compress_queue.get(timeout=MAINTENANCE_INTERVAL)
+            except queue.Empty:
+                path = None
+
+            if path:
+                self._compress_segment(path)
+
+            # Закрываем простаивающий сегмент, даже если в него давно ничего не писали
+            with self._lock:
+                if self._file is not None and self._segment_is_full(0):
+                    self._rotate()
+
+            if self._prune and self.hot_window and time.monotonic() - last_prune >= MAINTENANCE_INTERVAL:
+                last_prune = time.monotonic()
+                try:
+                    cutoff = (datetime.now() - self.hot_window).isoformat()
+                    prune_bot_logs(cutoff)
+                except Exception as e:
+                    logger.error(f"[LogArchive] Ошибка очистки старых логов в SQLite: {e}")
+
+        # Дожимаем оставшиеся в очереди сегменты
+        while True:
+            try:
+                path = self._compress_queue.get_nowait()
+            except queue.Empty:
+                break
+            if path:
+                self._compress_segment(path)
+
+    def _compress_segment(self, path: str):
+        """Сжимает закрытый сегмент в .gz и удаляет исходный файл."""
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(path)
+        except Exception as e:
+            logger.error(f"[LogArchive] Ошибка сжатия сегмента {path}: {e}")
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _hot_window_from_env() -> Optional[timedelta]:
+    hours = float(os.environ.get('LOG_HOT_WINDOW_HOURS', 7 * 24))
+    return timedelta(hours=hours) if hours > 0 else None
+
+
+log_archive = LogArchive(
+    LOGS_DIR,
+    max_segment_bytes=int(os.environ.get('LOG_SEGMENT_MAX_BYTES', 64 * 1024 * 1024)),
+    max_segment_age=float(os.environ.get('LOG_SEGMENT_MAX_AGE', 3600)),
+    hot_window=_hot_window_from_env()
+)
+
+atexit.register(log_archive.close)
@@ -0,0 +1,77 @@
+"""
+Модуль runner.py
+================
+
+Отдельный процесс, в котором работают боты.
+
+Раннер владеет BotManager: при старте поднимает ботов со статусом running,
+а команды веб-приложения (запуск, остановка, перезапуск, перезагрузка flow и
+настроек, статусы, логи) принимает через Unix-сокет (модуль runner_ipc).
+Веб-приложение при этом можно запускать в нескольких процессах WSGI-сервера:
+боты не стартуют в каждом из них и не делят с обработкой запросов один GIL.
+
+При BOT_RUNNER_WORKERS больше 1 раннер распределяет ботов по рабочим процессам
+и следит за ними (модуль bot_pool). При BOT_LEASES=1 раннер - один из узлов,
+делящих ботов через аренды в общей БД (модуль leases), и запускает только своих.
+
+Запуск:
+    BOT_RUNNER_SOCKET=data/run/bot_runner.sock python src/runner.py
+    BOT_RUNNER_SOCKET=data/run/bot_runner.sock gunicorn -w 4 --chdir src app:app
+
+По SIGTERM/SIGINT раннер останавливает ботов, сохраняя состояния чатов; статус
+running в БД остаётся, и при следующем запуске боты поднимаются снова.
+"""
+
+import logging
+import os
+import sys
+
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass
+
+from database import BASE_DIR, init_db
+from runner_ipc import BOT_RUNNER_SOCKET, serve_until_stopped
+from bot_pool import BOT_RUNNER_WORKERS, PoolBotManager
+from leases import BOT_LEASES, LeaseBotManager
+from log_archive import log_archive
+
+DEFAULT_SOCKET = str(BASE_DIR / 'data' / 'run' / 'bot_runner.sock')
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def main():
+    path = BOT_RUNNER_SOCKET or DEFAULT_SOCKET
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    init_db()
+    # Старые логи из SQLite удаляет только раннер: не веб-приложение и не рабочие процессы пула
+    log_archive.enable_pruning()
+
+    pool = None
+    if BOT_RUNNER_WORKERS > 1:
+        manager = pool = PoolBotManager(BOT_RUNNER_WORKERS, os.path.dirname(os.path.abspath(path)))
+    else:
+        from bot_manager import bot_manager as manager
+    if BOT_LEASES:
+        manager = LeaseBotManager(manager)
+
+    def on_started():
+        if pool is not None:
+            pool.start()
+        started = manager.start_saved_bots()
+        logging.info(f"[Runner] Запущено ботов: {len(started)}")
+
+    try:
+        serve_until_stopped(path, manager, on_started)
+    except RuntimeError as e:
+        logging.error(f"[Runner] {e}")
+        return 1
+    logging.info("[Runner] Остановлен")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
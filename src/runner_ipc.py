@@ -0,0 +1,267 @@
+"""
+Модуль runner_ipc.py
+====================
+
+Канал управления процессом-раннером ботов (runner.py) через Unix-сокет.
+
+Раннер владеет BotManager и обслуживает сокет RunnerServer; веб-приложение
+вместо собственного BotManager использует RemoteBotManager с тем же набором
+методов (CONTROL_METHODS), поэтому код обработчиков не зависит от того, где
+работают боты.
+
+Протокол: одна строка JSON на запрос и на ответ.
+    запрос:  {"method": "start_bot", "args": [1]}
+    ответ:   {"result": true}  или  {"error": "текст", "type": "ValueError"}
+
+Соединения с раннером хранятся по одному на поток веб-сервера и переиспользуются;
+при разрыве соединение открывается заново. Команда повторяется по новому соединению,
+только если раннер её точно не получил (не удалась отправка) или если она только
+читает состояние (READ_ONLY_METHODS): ответ мог потеряться после выполнения команды,
+и повтор перезапустил бы бота второй раз.
+
+Настройки через переменные окружения:
+    BOT_RUNNER_SOCKET   - путь к сокету; если задан, app.py управляет ботами
+                          через раннер, иначе запускает их в своём процессе
+    BOT_RUNNER_TIMEOUT  - ожидание ответа раннера в секундах (по умолчанию 30)
+"""
+
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import threading
+
+BOT_RUNNER_SOCKET = os.environ.get('BOT_RUNNER_SOCKET', '')
+BOT_RUNNER_TIMEOUT = float(os.environ.get('BOT_RUNNER_TIMEOUT', 30))
+
+# Методы BotManager, доступные через сокет
+CONTROL_METHODS = (
+    'start_bot', 'stop_bot', 'restart_bot', 'reload_flow', 'reload_restriction',
+    'reload_custom_commands', 'get_bot_status', 'get_bot_statuses', 'get_recent_logs',
+    'clear_recent_logs', 'get_session_stats', 'get_bot_health', 'api_cache_stats',
+    'upstream_stats', 'ping'
+)
+
+# Методы, которые не меняют состояние раннера: их можно повторить после потери ответа
+READ_ONLY_METHODS = frozenset((
+    'get_bot_status', 'get_bot_statuses', 'get_recent_logs', 'get_session_stats',
+    'get_bot_health', 'api_cache_stats', 'upstream_stats', 'ping'
+))
+
+logger = logging.getLogger(__name__)
+
+
+class RunnerUnavailable(Exception):
+    """Раннер ботов не запущен или не ответил вовремя."""
+
+
+# Исключения раннера, которые воспроизводятся на стороне клиента с тем же типом
+_REMOTE_ERRORS = {
+    'ValueError': ValueError, 'LookupError': LookupError, 'KeyError': KeyError,
+    # Раннер в режиме пула не смог связаться со своим рабочим процессом
+    'RunnerUnavailable': RunnerUnavailable
+}
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    """Обслуживает одно соединение: запросы выполняются по очереди до закрытия сокета."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                method = request.get('method')
+                if method not in CONTROL_METHODS:
+                    raise ValueError(f'Неизвестная команда: {method!r}')
+                reply = {'result': getattr(self.server.manager, method)(*request.get('args', ()))}
+            except Exception as e:
+                reply = {'error': str(e), 'type': type(e).__name__}
+            self.wfile.write(json.dumps(reply, ensure_ascii=False, default=str).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class RunnerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Сервер канала управления: каждое соединение обслуживается в своём потоке.
+
+    Attributes:
+        manager (BotManager): Менеджер, методы которого вызываются по запросам
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, manager):
+        self.manager = manager
+        _remove_stale_socket(path)
+        super().__init__(path, _ControlHandler)
+        # Доступ только владельцу и группе (веб-приложение может работать от другого пользователя группы)
+        os.chmod(path, 0o660)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+def _remove_stale_socket(path):
+    """
+    Удаляет сокет, оставшийся от завершившегося раннера.
+
+    Raises:
+        RuntimeError: На сокете уже работает другой раннер
+    """
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.unlink(path)
+    else:
+        raise RuntimeError(f'Раннер ботов уже запущен на {path}')
+    finally:
+        probe.close()
+
+
+def serve_until_stopped(path, manager, on_started=None, stop_signals=(signal.SIGTERM, signal.SIGINT)):
+    """
+    Обслуживает канал управления manager до сигнала остановки, затем вызывает manager.shutdown().
+
+    Должна вызываться из главного потока процесса (устанавливает обработчики сигналов).
+
+    Args:
+        path (str): Путь к сокету
+        manager: BotManager или совместимый объект
+        on_started: Функция без аргументов, вызываемая после открытия сокета
+        stop_signals: Сигналы, по которым процесс завершается
+
+    Raises:
+        RuntimeError: На сокете уже работает другой раннер
+    """
+    server = RunnerServer(path, manager)
+    stopping = threading.Event()
+
+    def request_stop(signum, frame):
+        logger.info(f"[Runner] Получен сигнал {signum}, остановка (PID {os.getpid()})")
+        stopping.set()
+
+    for signum in stop_signals:
+        signal.signal(signum, request_stop)
+
+    threading.Thread(target=server.serve_forever, name='runner-ipc', daemon=True).start()
+    logger.info(f"[Runner] Канал управления: {path} (PID {os.getpid()})")
+    try:
+        if on_started is not None:
+            on_started()
+        stopping.wait()
+    finally:
+        server.shutdown()
+        server.server_close()
+        manager.shutdown()
+
+
+def _remote(method):
+    def call(self, *args):
+        return self._call(method, args)
+    call.__name__ = method
+    return call
+
+
+class RemoteBotManager:
+    """
+    Клиент канала управления с интерфейсом BotManager (методы CONTROL_METHODS).
+
+    Raises:
+        RunnerUnavailable: Из любого метода, если раннер недоступен
+    """
+
+    def __init__(self, path=BOT_RUNNER_SOCKET, timeout=BOT_RUNNER_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+            except OSError as e:
+                sock.close()
+                raise RunnerUnavailable(f'Раннер ботов недоступен ({self.path}): {e}')
+            connection = (sock, sock.makefile('rb'))
+            self._local.connection = connection
+        return connection
+
+    def _close(self):
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+
+    def _call(self, method, args):
+        payload = json.dumps({'method': method, 'args': list(args)}).encode('utf-8') + b'\n'
+        # Соединение, открытое ранее, могло быть закрыто перезапущенным раннером -
+        # в этом случае запрос повторяется один раз по новому соединению. Если запрос
+        # уже отправлен, раннер мог выполнить команду, и повторяются только чтения.
+        for attempt in (1, 2):
+            retry = getattr(self._local, 'connection', None) is not None and attempt == 1
+            sock, reader = self._connection()
+            try:
+                sock.sendall(payload)
+            except socket.timeout:
+                self._close()
+                raise RunnerUnavailable(f'Раннер ботов не ответил за {self.timeout} с на {method}')
+            except OSError as e:
+                self._close()
+                if retry:
+                    continue
+                raise RunnerUnavailable(f'Ошибка связи с раннером ботов: {e}')
+            retry = retry and method in READ_ONLY_METHODS
+            try:
+                line = reader.readline()
+            except socket.timeout:
+                self._close()
+                raise RunnerUnavailable(f'Раннер ботов не ответил за {self.timeout} с на {method}')
+            except OSError as e:
+                self._close()
+                if retry:
+                    continue
+                raise RunnerUnavailable(f'Ошибка связи с раннером ботов: {e}')
+            if not line:
+                self._close()
+                if retry:
+                    continue
+                raise RunnerUnavailable('Раннер ботов закрыл соединение')
+            break
+
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise _REMOTE_ERRORS.get(reply.get('type'), RuntimeError)(reply['error'])
+        return reply['result']
+
+    start_bot = _remote('start_bot')
+    stop_bot = _remote('stop_bot')
+    restart_bot = _remote('restart_bot')
+    reload_flow = _remote('reload_flow')
+    reload_restriction = _remote('reload_restriction')
+    reload_custom_commands = _remote('reload_custom_commands')
+    get_bot_status = _remote('get_bot_status')
+    get_recent_logs = _remote('get_recent_logs')
+    clear_recent_logs = _remote('clear_recent_logs')
+    get_session_stats = _remote('get_session_stats')
+    get_bot_health = _remote('get_bot_health')
+    api_cache_stats = _remote('api_cache_stats')
+    upstream_stats = _remote('upstream_stats')
+    ping = _remote('ping')
+
+    def get_bot_statuses(self, stored_statuses):
+        # Ключи-числа JSON превращает в строки: передаём пары и восстанавливаем ключи
+        statuses = self._call('get_bot_statuses', (list(stored_statuses.items()),))
+        return {int(bot_id): status for bot_id, status in statuses.items()}
@@ -0,0 +1,472 @@
+"""
+Модуль session_store.py
+=======================
+
+Хранилище состояний чатов бота с отложенной записью в SQLite (write-behind).
+
+Состояние чата (ChatSession: текущая нода, история переходов и переменные)
+живёт в памяти и читается без обращения к БД. Изменённые чаты помечаются «грязными»
+один раз за обработку обновления, а фоновый поток сохраняет их пачкой одной
+транзакцией раз в SESSION_FLUSH_INTERVAL секунд и при остановке бота.
+После перезапуска состояние чата загружается из БД при первом обновлении от него.
+
+Память ограничена: в ней держится не больше SESSION_MAX_ENTRIES чатов, давно
+неактивные (дольше SESSION_TTL) и наименее недавно использованные (LRU) чаты
+вытесняются. Несохранённые изменения вытесняемого чата сначала записываются
+в SQLite, так что при следующем обновлении состояние загружается обратно.
+
+Настройки через переменные окружения:
+    SESSION_FLUSH_INTERVAL  - период сохранения изменённых состояний в секундах (по умолчанию 2)
+    SESSION_MAX_ENTRIES     - максимальное число чатов в памяти на бота (по умолчанию 10000)
+    SESSION_TTL             - время простоя в секундах, после которого чат вытесняется (по умолчанию 3600, 0 - без TTL)
+    SESSION_HISTORY_LIMIT   - сколько переходов хранится в истории чата для кнопки «Назад» (по умолчанию 50)
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from array import array
+from collections import OrderedDict
+
+from database import LeaseLostError, get_chat_session, save_chat_sessions
+
+logger = logging.getLogger(__name__)
+
+SESSION_FLUSH_INTERVAL = float(os.environ.get('SESSION_FLUSH_INTERVAL', 2))
+SESSION_MAX_ENTRIES = int(os.environ.get('SESSION_MAX_ENTRIES', 10000))
+SESSION_TTL = float(os.environ.get('SESSION_TTL', 3600))
+SESSION_HISTORY_LIMIT = int(os.environ.get('SESSION_HISTORY_LIMIT', 50))
+
+_live_stores = weakref.WeakSet()
+
+
+class ChatSession:
+    """
+    Состояние одного чата.
+
+    Позиция хранится номером ноды в общем CompiledFlow, история переходов - массивом
+    номеров фиксированной ёмкости (самые старые переходы отбрасываются), переменные
+    (ввод пользователя, контакт, геолокация, результаты трансформаций) - отдельным словарём.
+
+    Attributes:
+        flow (CompiledFlow): Flow, по которому сейчас идёт чат (основной или flow команды)
+        node (int): Номер текущей ноды во flow или -1
+        history (array): Номера пройденных нод
+        command (Optional[str]): Пользовательская команда, flow которой выполняется
+        variables (dict): Переменные чата
+    """
+
+    __slots__ = ('flow', 'node', 'history', 'command', 'variables')
+
+    def __init__(self, flow, command=None):
+        self.flow = flow
+        self.node = -1
+        self.history = array('i')
+        self.command = command
+        self.variables = {}
+
+    @property
+    def current_node_id(self):
+        return self.flow.ids[self.node] if self.node >= 0 else None
+
+    def current_node(self):
+        """Возвращает текущую ноду (словарь из flow) или None."""
+        return self.flow.node_at(self.node)
+
+    def move_to(self, node_id):
+        """Делает ноду текущей. Возвращает её или None, если такой ноды во flow нет."""
+        position = self.flow.find(node_id)
+        if position < 0:
+            return None
+        self.node = position
+        return self.flow.nodes[position]
+
+    def push_history(self):
+        """Запоминает текущую ноду в истории перед переходом."""
+        if self.node < 0:
+            return
+        if len(self.history) >= SESSION_HISTORY_LIMIT:
+            del self.history[0]
+        self.history.append(self.node)
+
+    def pop_history(self):
+        """Возвращает ID предыдущей ноды из истории или None."""
+        if not self.history:
+            return None
+        return self.flow.ids[self.history.pop()]
+
+    def enter_flow(self, flow, command=None):
+        """Переключает чат на другой flow (например, flow пользовательской команды)."""
+        self.flow = flow
+        self.command = command
+        self.node = -1
+        self.history = array('i')
+
+    def rebind(self, flow):
+        """
+        Переводит чат на новую версию того же flow (например, после отката ревизии).
+
+        Номера нод в разных версиях flow не совпадают, поэтому текущая нода
+        и история переносятся по ID; ноды, которых в новой версии нет, пропускаются.
+        """
+        ids = self.flow.ids
+        self.node = flow.find(ids[self.node]) if self.node >= 0 else -1
+        history = array('i')
+        for position in self.history:
+            new_position = flow.find(ids[position])
+            if new_position >= 0:
+                history.append(new_position)
+        self.history = history
+        self.flow = flow
+
+    def to_dict(self):
+        """Сериализуемое представление: ноды сохраняются по ID, а не по номерам."""
+        ids = self.flow.ids
+        return {
+            'current_node': self.current_node_id,
+            'history': [ids[position] for position in self.history],
+            'command_mode': self.command,
+            'variables': dict(self.variables)
+        }
+
+    @classmethod
+    def from_dict(cls, data, flow, command=None):
+        """
+        Восстанавливает состояние, сохранённое to_dict().
+
+        Поддерживает и прежний формат, где переменные лежали в одном словаре
+        с current_node и history. Ноды, которых больше нет во flow, пропускаются.
+        """
+        if 'variables' in data:
+            variables = dict(data['variables'] or {})
+        else:
+            variables = {key: value for key, value in data.items()
+                         if key not in ('current_node', 'history', 'command_mode', 'original_flow')}
+
+        session = cls(flow, command)
+        session.node = flow.find(data.get('current_node'))
+        for node_id in (data.get('history') or [])[-SESSION_HISTORY_LIMIT:]:
+            position = flow.find(node_id)
+            if position >= 0:
+                session.history.append(position)
+        session.variables = variables
+        return session
+
+
+class SessionStore:
+    """
+    Состояния чатов одного бота: словарь chat_id -> ChatSession с ленивой загрузкой из SQLite.
+
+    Поддерживает операции словаря, которые использует BotInstance
+    (store[chat_id], store[chat_id] = state, chat_id in store, store.get(chat_id, default)).
+    Чаты в памяти упорядочены по последнему обращению; при превышении max_entries
+    и по истечении ttl они вытесняются с сохранением несохранённых изменений.
+
+    Attributes:
+        bot_id (int): ID бота
+        restore (callable): Восстанавливает ChatSession из словаря, загруженного из БД
+        flush_interval (float): Период фонового сохранения в секундах
+        max_entries (int): Максимальное число чатов в памяти
+        ttl (float): Время простоя в секундах до вытеснения (0 - без ограничения)
+    """
+
+    def __init__(
+        self,
+        bot_id,
+        restore,
+        flush_interval: float = SESSION_FLUSH_INTERVAL,
+        max_entries: int = SESSION_MAX_ENTRIES,
+        ttl: float = SESSION_TTL
+    ):
+        self.bot_id = bot_id
+        self.restore = restore
+        self.flush_interval = flush_interval
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # chat_id -> [state, время последнего обращения]; порядок - от давних обращений к недавним
+        self._sessions = OrderedDict()
+        self._dirty = set()
+        # chat_id -> (state, batch) состояний, запись которых ещё не зафиксирована в БД
+        self._spilling = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+        # fencing-токен аренды бота (модуль leases): после смены владельца запись отклоняется
+        self.lease_token = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        _live_stores.add(self)
+
+    # ------------------------------------------------------------------
+    # Доступ к состояниям
+    # ------------------------------------------------------------------
+
+    def _load(self, chat_id):
+        """Возвращает состояние чата из памяти, при первом обращении - из БД."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.get(chat_id)
+            if entry is not None:
+                entry[1] = now
+                self._sessions.move_to_end(chat_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            spilled = self._spilling.get(chat_id)
+            state = spilled[0] if spilled is not None else None
+
+        if state is None:
+            try:
+                data = get_chat_session(self.bot_id, chat_id)
+                state = self.restore(data) if data is not None else None
+            except Exception as e:
+                logger.error(f"[SessionStore] Ошибка загрузки состояния чата {chat_id} бота {self.bot_id}: {e}")
+                state = None
+            if state is None:
+                return None
+
+        with self._lock:
+            entry = self._sessions.get(chat_id)
+            if entry is not None:
+                return entry[0]
+            self._sessions[chat_id] = [state, now]
+            payload = self._evict_overflow()
+        self._spill(payload)
+        return state
+
+    def __contains__(self, chat_id):
+        return self._load(chat_id) is not None
+
+    def __getitem__(self, chat_id):
+        state = self._load(chat_id)
+        if state is None:
+            raise KeyError(chat_id)
+        return state
+
+    def __setitem__(self, chat_id, state):
+        with self._lock:
+            self._sessions[chat_id] = [state, time.monotonic()]
+            self._sessions.move_to_end(chat_id)
+            self._dirty.add(chat_id)
+            payload = self._evict_overflow()
+        self._spill(payload)
+
+    def get(self, chat_id, default=None):
+        state = self._load(chat_id)
+        return default if state is None else state
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def mark_dirty(self, chat_id):
+        """Помечает состояние чата для сохранения при следующем сбросе."""
+        with self._lock:
+            if chat_id in self._sessions:
+                self._dirty.add(chat_id)
+
+    def stats(self):
+        """
+        Возвращает статистику хранилища.
+
+        Returns:
+            dict: size (чатов в памяти), max_entries, ttl, hits, misses, hit_rate,
+                  evictions (вытеснено по LRU), expirations (вытеснено по TTL), dirty
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._sessions),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'dirty': len(self._dirty)
+            }
+
+    # ------------------------------------------------------------------
+    # Вытеснение
+    # ------------------------------------------------------------------
+
+    def _evict_overflow(self):
+        """
+        Вытесняет наименее недавно использованные чаты сверх max_entries. Вызывается под блокировкой.
+
+        Returns:
+            tuple: Копии несохранённых вытесненных состояний для _spill
+        """
+        evicted = []
+        while len(self._sessions) > self.max_entries:
+            chat_id, entry = self._sessions.popitem(last=False)
+            self.evictions += 1
+            if chat_id in self._dirty:
+                self._dirty.discard(chat_id)
+                evicted.append((chat_id, entry[0]))
+        return self._prepare(evicted)
+
+    def expire(self):
+        """Вытесняет чаты, к которым не обращались дольше ttl. Возвращает их количество."""
+        if not self.ttl:
+            return 0
+        deadline = time.monotonic() - self.ttl
+        evicted = []
+        expired = 0
+        with self._lock:
+            while self._sessions:
+                chat_id, entry = next(iter(self._sessions.items()))
+                if entry[1] > deadline:
+                    break
+                del self._sessions[chat_id]
+                expired += 1
+                if chat_id in self._dirty:
+                    self._dirty.discard(chat_id)
+                    evicted.append((chat_id, entry[0]))
+            self.expirations += expired
+            payload = self._prepare(evicted)
+        self._spill(payload)
+        return expired
+
+    def _spill(self, payload):
+        """Сохраняет несохранённые изменения вытесненных чатов (копии сняты при вытеснении)."""
+        batch, snapshots = payload
+        if snapshots:
+            self._submit(batch, snapshots)
+
+    # ------------------------------------------------------------------
+    # Сохранение
+    # ------------------------------------------------------------------
+
+    def _prepare(self, states):
+        """
+        Снимает копии состояний для записи. Вызывается под блокировкой.
+
+        До фиксации записи состояния лежат в self._spilling: чат, вытесненный
+        в это время, загружается оттуда, а не из устаревшей строки БД.
+
+        Returns:
+            tuple: (batch, [(chat_id, state, данные to_dict())]); batch отличает эту запись от более новых
+        """
+        batch = object()
+        snapshots = []
+        for chat_id, state in states:
+            try:
+                data = state.to_dict()
+            except Exception as e:
+                logger.error(f"[SessionStore] Не удалось снять копию состояния чата {chat_id} бота {self.bot_id}: {e}")
+                self._requeue(chat_id, state)
+                continue
+            self._spilling[chat_id] = (state, batch)
+            snapshots.append((chat_id, state, data))
+        return batch, snapshots
+
+    def _requeue(self, chat_id, state):
+        """Возвращает несохранённое состояние к следующему сбросу. Вызывается под блокировкой."""
+        if chat_id not in self._sessions:
+            # Чат уже вытеснен: держим его в памяти, пока изменения не записаны
+            self._sessions[chat_id] = [state, time.monotonic()]
+            self._sessions.move_to_end(chat_id, last=False)
+        self._dirty.add(chat_id)
+
+    def _submit(self, batch, snapshots, wait=False):
+        """Записывает копии состояний одной транзакцией. Возвращает количество записанных состояний."""
+        rows = []
+        for chat_id, _, data in snapshots:
+            try:
+                rows.append((chat_id, json.dumps(data, ensure_ascii=False)))
+            except (TypeError, ValueError) as e:
+                logger.error(f"[SessionStore] Состояние чата {chat_id} бота {self.bot_id} не сериализуется: {e}")
+        if not rows:
+            self._saved(batch, snapshots, None)
+            return 0
+        try:
+            future = save_chat_sessions(self.bot_id, rows, self.lease_token)
+        except Exception as e:
+            self._saved(batch, snapshots, e)
+            raise
+        future.add_done_callback(lambda done: self._saved(batch, snapshots, done.exception()))
+        if wait:
+            future.result()
+        return len(rows)
+
+    def _saved(self, batch, snapshots, error):
+        """
+        Завершает запись: убирает состояния из self._spilling, при ошибке возвращает их к сохранению.
+
+        После потери аренды (LeaseLostError) запись не повторяется: состояния чатов
+        принадлежат новому владельцу бота.
+        """
+        retry = error is not None and not isinstance(error, LeaseLostError)
+        with self._lock:
+            for chat_id, state, _ in snapshots:
+                spilled = self._spilling.get(chat_id)
+                # Более новая запись того же чата ещё не зафиксирована - она и сохранит состояние
+                if spilled is None or spilled[1] is not batch:
+                    continue
+                del self._spilling[chat_id]
+                if retry:
+                    self._requeue(chat_id, state)
+        if error is not None:
+            logger.error(f"[SessionStore] Ошибка сохранения состояний бота {self.bot_id}: {error}")
+
+    def flush(self, wait=False):
+        """
+        Сохраняет изменённые состояния одной транзакцией.
+
+        Копии состояний снимаются под блокировкой; если запись не удалась, чаты
+        снова помечаются изменёнными и сохраняются при следующем сбросе.
+
+        Args:
+            wait: Дождаться фиксации записи в БД
+
+        Returns:
+            int: Количество сохранённых состояний
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            batch, snapshots = self._prepare(
+                [(chat_id, self._sessions[chat_id][0]) for chat_id in dirty if chat_id in self._sessions]
+            )
+        return self._submit(batch, snapshots, wait)
+
+    def start(self):
+        """Запускает фоновое сохранение изменённых состояний и вытеснение по TTL."""
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Останавливает фоновое сохранение и сохраняет оставшиеся изменения."""
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join(timeout=5)
+            self._thread = None
+        try:
+            self.flush(wait=True)
+        except Exception as e:
+            logger.error(f"[SessionStore] Ошибка сохранения состояний бота {self.bot_id} при остановке: {e}")
+
+    def _flush_loop(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+                self.expire()
+            except Exception as e:
+                logger.error(f"[SessionStore] Ошибка сохранения состояний бота {self.bot_id}: {e}")
+
+
+def _flush_all():
+    for store in list(_live_stores):
+        store.stop()
+
+
+atexit.register(_flush_all)
@@ -0,0 +1,226 @@
+"""
+Модуль upstreams.py
+===================
+
+Защита бота от медленных и неработающих внешних API (ноды api_request).
+
+Для каждого хоста ведётся UpstreamGuard:
+- bulkhead - не больше UPSTREAM_MAX_CONCURRENCY одновременных запросов к хосту;
+  запрос, не получивший слот за UPSTREAM_QUEUE_TIMEOUT, сразу завершается ошибкой;
+- circuit breaker - после BREAKER_FAILURE_THRESHOLD ошибок подряд хост считается
+  недоступным на BREAKER_RESET_TIMEOUT секунд: запросы к нему не выполняются,
+  нода сразу уходит по соединению error. Затем пропускается один пробный запрос:
+  его успех закрывает breaker, ошибка снова открывает;
+- метрики: число запросов, ошибок и отказов, задержки и доля ошибок по последним запросам.
+
+Ошибкой считаются сетевые сбои, таймауты и ответы 5xx/429; остальные 4xx - ответ хоста,
+а не признак его недоступности.
+
+Настройки через переменные окружения:
+    UPSTREAM_MAX_CONCURRENCY   - одновременных запросов к одному хосту (по умолчанию 8)
+    UPSTREAM_QUEUE_TIMEOUT     - ожидание свободного слота в секундах (по умолчанию 0.5)
+    BREAKER_FAILURE_THRESHOLD  - ошибок подряд до размыкания (по умолчанию 5)
+    BREAKER_RESET_TIMEOUT      - время в разомкнутом состоянии в секундах (по умолчанию 30)
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+UPSTREAM_MAX_CONCURRENCY = int(os.environ.get('UPSTREAM_MAX_CONCURRENCY', 8))
+UPSTREAM_QUEUE_TIMEOUT = float(os.environ.get('UPSTREAM_QUEUE_TIMEOUT', 0.5))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 30))
+
+# Сколько последних запросов учитывается в задержках и доле ошибок
+METRICS_WINDOW = 200
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class UpstreamUnavailable(Exception):
+    """Запрос не выполнен: breaker хоста разомкнут или все слоты bulkhead заняты."""
+
+
+def is_failure_status(status):
+    """Является ли HTTP-статус признаком проблем на стороне хоста."""
+    return status >= 500 or status == 429
+
+
+class UpstreamGuard:
+    """
+    Bulkhead, circuit breaker и метрики одного хоста.
+
+    Attributes:
+        host (str): Хост (netloc URL)
+    """
+
+    def __init__(
+        self,
+        host,
+        max_concurrency: int = UPSTREAM_MAX_CONCURRENCY,
+        queue_timeout: float = UPSTREAM_QUEUE_TIMEOUT,
+        failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+        reset_timeout: float = BREAKER_RESET_TIMEOUT
+    ):
+        self.host = host
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._consecutive_failures = 0
+
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+        self.short_circuited = 0
+        self.breaker_trips = 0
+        self._latencies = deque(maxlen=METRICS_WINDOW)
+        self._outcomes = deque(maxlen=METRICS_WINDOW)
+
+    def _admit(self):
+        """Пропускает запрос через breaker. Возвращает True для пробного запроса в half_open."""
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    self.short_circuited += 1
+                    raise UpstreamUnavailable(f'Хост {self.host} временно недоступен (circuit breaker)')
+                self.state = HALF_OPEN
+                self._trial_running = False
+            if self.state == HALF_OPEN:
+                if self._trial_running:
+                    self.short_circuited += 1
+                    raise UpstreamUnavailable(f'Хост {self.host} временно недоступен (circuit breaker)')
+                self._trial_running = True
+                return True
+            return False
+
+    def _record(self, success, latency, trial):
+        with self._lock:
+            self.requests += 1
+            self._latencies.append(latency)
+            self._outcomes.append(success)
+            if trial:
+                self._trial_running = False
+            if success:
+                self._consecutive_failures = 0
+                if self.state != CLOSED:
+                    self.state = CLOSED
+                return
+            self.failures += 1
+            self._consecutive_failures += 1
+            if trial or self._consecutive_failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.breaker_trips += 1
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+
+    @contextmanager
+    def call(self):
+        """
+        Контекст одного запроса к хосту.
+
+        Выдаёт объект с методом failed(), которым запрос отмечается как неуспешный
+        (например, при ответе 5xx). Исключение внутри контекста тоже считается ошибкой.
+
+        Raises:
+            UpstreamUnavailable: Breaker разомкнут или нет свободного слота
+        """
+        trial = self._admit()
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self.rejected += 1
+                if trial:
+                    self._trial_running = False
+            raise UpstreamUnavailable(f'Превышен лимит одновременных запросов к {self.host}')
+
+        outcome = _CallOutcome()
+        with self._lock:
+            self.in_flight += 1
+        started = time.monotonic()
+        try:
+            yield outcome
+        except BaseException:
+            outcome.success = False
+            raise
+        finally:
+            latency = time.monotonic() - started
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+            self._record(outcome.success, latency, trial)
+
+    def stats(self):
+        """Метрики хоста: состояние breaker, счётчики и задержки по последним запросам (мс)."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            outcomes = list(self._outcomes)
+            state = self.state
+            if state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                state = HALF_OPEN
+
+            def percentile(p):
+                if not latencies:
+                    return None
+                return round(latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000, 1)
+
+            return {
+                'host': self.host,
+                'state': state,
+                'in_flight': self.in_flight,
+                'max_concurrency': self.max_concurrency,
+                'requests': self.requests,
+                'failures': self.failures,
+                'rejected': self.rejected,
+                'short_circuited': self.short_circuited,
+                'breaker_trips': self.breaker_trips,
+                'error_rate': round(outcomes.count(False) / len(outcomes), 4) if outcomes else None,
+                'latency_ms': {
+                    'avg': round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None,
+                    'p50': percentile(0.5),
+                    'p95': percentile(0.95),
+                    'max': round(latencies[-1] * 1000, 1) if latencies else None
+                }
+            }
+
+
+class _CallOutcome:
+    __slots__ = ('success',)
+
+    def __init__(self):
+        self.success = True
+
+    def failed(self):
+        self.success = False
+
+
+class UpstreamRegistry:
+    """UpstreamGuard для каждого хоста, к которому обращались ноды api_request."""
+
+    def __init__(self):
+        self._guards = {}
+        self._lock = threading.Lock()
+
+    def get(self, host):
+        guard = self._guards.get(host)
+        if guard is None:
+            with self._lock:
+                guard = self._guards.setdefault(host, UpstreamGuard(host))
+        return guard
+
+    def stats(self):
+        return [guard.stats() for guard in list(self._guards.values())]
+
+
+upstreams = UpstreamRegistry()
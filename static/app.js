@@ -1,6 +1,8 @@
 let bots = [];
 let currentLogsBotId = null;
 
+const STATUS_LABELS = {running: 'Запущен', restarting: 'Перезапуск', stopped: 'Остановлен'};
+
 // Helper function to build API URL with base path
 function apiUrl(path) {
     const baseUrl = window.API_BASE_URL || '';
@@ -29,7 +31,8 @@ function toggleCollapse(collapseId) {
 
 async function loadBots() {
     try {
-        const response = await fetch(apiUrl('api/bots'));
+        // Список отдаёт только сводки ботов; полная запись загружается при открытии настроек
+        const response = await fetch(apiUrl('api/bots?fields=id,name,status,token_preview,base_url,created_at'));
         bots = await response.json();
         renderBots();
     } catch (error) {
@@ -57,12 +60,12 @@ function renderBots() {
             <div class="card bot-card ${bot.status}">
                 <div class="card-header d-flex justify-content-between align-items-center">
                     <h5 class="mb-0">${escapeHtml(bot.name)}</h5>
-                    <span class="status-badge ${bot.status}">${bot.status === 'running' ? 'Запущен' : 'Остановлен'}</span>
+                    <span class="status-badge ${bot.status}">${STATUS_LABELS[bot.status] || 'Остановлен'}</span>
                 </div>
                 <div class="card-body">
                     <div class="mb-2">
                         <small class="text-muted">Токен:</small>
-                        <div class="token-field">${escapeHtml(bot.token.substring(0, 20))}...</div>
+                        <div class="token-field">••••••••${escapeHtml(bot.token_preview || '')}</div>
                     </div>
                     <div class="mb-2">
                         <small class="text-muted">Base URL:</small>
@@ -75,7 +78,7 @@ function renderBots() {
                 </div>
                 <div class="card-footer">
                     <div class="btn-group btn-group-sm w-100">
-                        ${bot.status === 'running'
+                        ${bot.status === 'running' || bot.status === 'restarting'
                             ? `<button class="btn btn-warning" onclick="stopBot(${bot.id})">Остановить</button>`
                             : `<button class="btn btn-success" onclick="startBot(${bot.id})">Запустить</button>`
                         }
@@ -195,8 +198,16 @@ async function deleteBot(botId) {
 }
 
 async function openEditModal(botId) {
-    const bot = bots.find(b => b.id === botId);
-    if (!bot) return;
+    let bot;
+    try {
+        const response = await fetch(apiUrl(`api/bots/${botId}`));
+        if (!response.ok) return;
+        bot = await response.json();
+    } catch (error) {
+        console.error('Error loading bot:', error);
+        alert('Ошибка при загрузке настроек бота');
+        return;
+    }
     
     document.getElementById('editBotId').value = bot.id;
     document.getElementById('editBotName').value = bot.name;
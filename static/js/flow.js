@@ -17,6 +17,8 @@ class FlowEditor {
         this.selectedConnection = null;
         this.currentCommandId = null; // ID текущей редактируемой команды
         this.isEditingCommand = false; // Режим редактирования команды
+        this.flowRevision = null; // Ревизия flow бота, с которой начато редактирование
+        this.savedFlow = null; // Flow бота в сохранённой ревизии (для построения патча)
         this.controlPoints = {}; // Опорные точки для изгиба линий
         this.draggedControlPoint = null;
         this.draggedPointStart = null;
@@ -238,6 +240,7 @@ class FlowEditor {
                 'message': 'Сообщение',
                 'menu': 'Меню',
                 'api_request': 'API запрос',
+                'fan_out': 'Параллельные запросы',
                 'condition': 'Условие',
                 'transform': 'Трансформация'
             };
@@ -353,6 +356,9 @@ class FlowEditor {
             case 'api':
                 this.addApiNode();
                 break;
+            case 'fanout':
+                this.addFanOutNode();
+                break;
             case 'condition':
                 this.addConditionNode();
                 break;
@@ -441,6 +447,10 @@ class FlowEditor {
             const response = await fetch(this.apiUrl(`api/bots/${botId}/flow`));
             const flowData = await response.json();
 
+            // Ревизия и копия загруженного flow: при сохранении отправляются только изменения
+            this.flowRevision = parseInt(response.headers.get('X-Flow-Revision'), 10) || null;
+            this.savedFlow = JSON.parse(JSON.stringify(flowData));
+
             if (flowData && flowData.nodes) {
                 this.nodes = flowData.nodes;
                 this.connections = flowData.connections || [];
@@ -577,6 +587,31 @@ class FlowEditor {
             body: '{}',
             extractVars: '[]',
             ignoreError: false, // Whether to ignore error responses and not create error connections
+            cacheTtl: 0, // Seconds to cache a successful response (0 = no caching)
+            cacheKeyHeaders: '', // Comma-separated headers that vary the cache key (empty = all headers)
+            isStart: false
+        };
+
+        this.nodes.push(node);
+        this.render();
+        this.selectNode(node.id);
+        return node;
+    }
+
+    addFanOutNode() {
+        const node = {
+            id: `node_${this.nodeIdCounter++}`,
+            type: 'fan_out',
+            x: 300,
+            y: 100,
+            // Requests in api_request node format, all started at once
+            requests: JSON.stringify([
+                { method: 'GET', url: 'https://api.example.com/first', extractVars: [] },
+                { method: 'GET', url: 'https://api.example.com/second', extractVars: [] }
+            ], null, 2),
+            waitFor: 0, // Successful responses to wait for (0 = all requests)
+            timeout: 10, // Overall deadline in seconds
+            ignoreError: false,
             isStart: false
         };
 
@@ -911,7 +946,7 @@ class FlowEditor {
                 }
 
                 // Prevent node connections for API and condition nodes - they should only use specific connectors
-                if (node && (node.type === 'api_request' || node.type === 'condition')) {
+                if (node && (node.type === 'api_request' || node.type === 'fan_out' || node.type === 'condition')) {
                     // Don't allow general node connections for API and condition nodes
                     return;
                 }
@@ -1434,7 +1469,7 @@ class FlowEditor {
                 // Handle node connector clicks
                 else if (nodeEl.dataset.nodeConnectable === 'true') {
                     // Prevent node connections for API and condition nodes - they should only use specific connectors
-                    if (node && (node.type === 'api_request' || node.type === 'condition')) {
+                    if (node && (node.type === 'api_request' || node.type === 'fan_out' || node.type === 'condition')) {
                         // Don't allow general node connections for API and condition nodes
                         return;
                     }
@@ -1714,7 +1749,7 @@ class FlowEditor {
         if (!node) return;
         
         // Check if node can be connected from (not API or condition nodes)
-        if (node.type === 'api_request' || node.type === 'condition') {
+        if (node.type === 'api_request' || node.type === 'fan_out' || node.type === 'condition') {
             // For API and condition nodes, just select them
             nodeEl.classList.add('long-press-active');
             
@@ -2494,7 +2529,7 @@ class FlowEditor {
         console.log('=== CONTEXT MENU: CONNECT ===', 'nodeId:', node.id);
 
         // Проверяем, может ли узел быть источником соединения
-        if (node.type === 'api_request' || node.type === 'condition') {
+        if (node.type === 'api_request' || node.type === 'fan_out' || node.type === 'condition') {
             // Для API и condition узлов просто показываем сообщение
             console.log('Use specific connectors for API/Condition nodes');
             return;
@@ -2748,8 +2783,42 @@ class FlowEditor {
                         Игнорировать ошибочные ответы API <span class="tooltip-icon" data-tooltip="Если включено, при ошибке API не будет создаваться отдельное соединение">ℹ️</span>
                     </label>
                 </div>
+                <div class="property-group">
+                    <label>Кэшировать ответ, сек: <span class="tooltip-icon" data-tooltip="Успешный ответ сохраняется на указанное время и переиспользуется для одинаковых запросов всех пользователей. Одновременные одинаковые запросы объединяются в один. 0 - без кэширования.">ℹ️</span></label>
+                    <input type="number" id="apiCacheTtl" min="0" step="1" value="${node.cacheTtl || 0}">
+                </div>
+                <div class="property-group">
+                    <label>Заголовки в ключе кэша: <span class="tooltip-icon" data-tooltip="Через запятую. Запросы, отличающиеся только другими заголовками, получают общий ответ из кэша. Пусто - учитываются все заголовки.">ℹ️</span></label>
+                    <input type="text" id="apiCacheKeyHeaders" value="${node.cacheKeyHeaders || ''}" placeholder="Authorization, Accept-Language">
+                </div>
                 <button class="btn btn-action" onclick="flowEditor.testApiRequest('${node.id}')">🧪 Тестировать запрос <span class="tooltip-icon" data-tooltip="Выполняет запрос к API без сохранения переменных. Полезно для проверки URL, заголовков и ответа сервера перед деплоем бота.">ℹ️</span></button>
             `;
+        } else if (node.type === 'fan_out') {
+            html = `
+                <div class="property-group">
+                    <label>Запросы (JSON): <span class="tooltip-icon" data-tooltip="Список запросов в формате API узла: method, url, headers, body, extractVars, ignoreError, cacheTtl. Все запросы выполняются одновременно, извлечённые переменные объединяются.">ℹ️</span></label>
+                    <textarea id="fanOutRequests" rows="12">${this.escapeHtml(node.requests || '[]')}</textarea>
+                    <div class="help-box" id="fanOutRequestsError" style="display: none;"></div>
+                </div>
+                <div class="help-box">
+                    <div class="help-box-title">Пример запроса:</div>
+                    <div><code>{"method": "GET", "url": "https://api.example.com/users/{{user_id}}", "extractVars": [{"field": "data.name", "var": "user_name"}]}</code></div>
+                </div>
+                <div class="property-group">
+                    <label>Дождаться успешных ответов: <span class="tooltip-icon" data-tooltip="Сколько запросов должно успешно завершиться для перехода по Success. 0 - все запросы. Остальные ответы не ожидаются.">ℹ️</span></label>
+                    <input type="number" id="fanOutWaitFor" min="0" step="1" value="${node.waitFor || 0}">
+                </div>
+                <div class="property-group">
+                    <label>Общий срок ожидания, сек:</label>
+                    <input type="number" id="fanOutTimeout" min="1" step="1" value="${node.timeout || 15}">
+                </div>
+                <div class="property-group">
+                    <label>
+                        <input type="checkbox" id="fanOutIgnoreError" ${node.ignoreError ? 'checked' : ''}>
+                        Игнорировать ошибки <span class="tooltip-icon" data-tooltip="Если включено, при невыполненном условии узел тоже переходит по Success">ℹ️</span>
+                    </label>
+                </div>
+            `;
         } else if (node.type === 'condition') {
             html = `
                 <div class="property-group">
@@ -2934,6 +3003,53 @@ class FlowEditor {
                     this.updateNode(node.id, { ignoreError: e.target.checked });
                 });
             }
+
+            const apiCacheTtl = document.getElementById('apiCacheTtl');
+            if (apiCacheTtl) {
+                apiCacheTtl.addEventListener('input', (e) => {
+                    this.updateNode(node.id, { cacheTtl: Math.max(parseInt(e.target.value, 10) || 0, 0) });
+                });
+            }
+            const apiCacheKeyHeaders = document.getElementById('apiCacheKeyHeaders');
+            if (apiCacheKeyHeaders) {
+                apiCacheKeyHeaders.addEventListener('input', (e) => {
+                    this.updateNode(node.id, { cacheKeyHeaders: e.target.value });
+                });
+            }
+        } else if (node.type === 'fan_out') {
+            const fanOutRequests = document.getElementById('fanOutRequests');
+            const fanOutRequestsError = document.getElementById('fanOutRequestsError');
+            if (fanOutRequests) {
+                fanOutRequests.addEventListener('input', (e) => {
+                    try {
+                        const parsed = JSON.parse(e.target.value);
+                        if (!Array.isArray(parsed)) throw new Error('Ожидается список запросов');
+                        fanOutRequestsError.style.display = 'none';
+                        this.updateNode(node.id, { requests: e.target.value });
+                    } catch (err) {
+                        fanOutRequestsError.textContent = `Некорректный JSON: ${err.message}`;
+                        fanOutRequestsError.style.display = 'block';
+                    }
+                });
+            }
+            const fanOutWaitFor = document.getElementById('fanOutWaitFor');
+            if (fanOutWaitFor) {
+                fanOutWaitFor.addEventListener('input', (e) => {
+                    this.updateNode(node.id, { waitFor: Math.max(parseInt(e.target.value, 10) || 0, 0) });
+                });
+            }
+            const fanOutTimeout = document.getElementById('fanOutTimeout');
+            if (fanOutTimeout) {
+                fanOutTimeout.addEventListener('input', (e) => {
+                    this.updateNode(node.id, { timeout: Math.max(parseFloat(e.target.value) || 15, 1) });
+                });
+            }
+            const fanOutIgnoreError = document.getElementById('fanOutIgnoreError');
+            if (fanOutIgnoreError) {
+                fanOutIgnoreError.addEventListener('change', (e) => {
+                    this.updateNode(node.id, { ignoreError: e.target.checked });
+                });
+            }
         } else if (node.type === 'condition') {
             const nodeCondition = document.getElementById('nodeCondition');
             if (nodeCondition) {
@@ -3036,6 +3152,16 @@ class FlowEditor {
         }
     }
 
+    parseFanOutRequests(requests) {
+        if (Array.isArray(requests)) return requests;
+        try {
+            const parsed = JSON.parse(requests || '[]');
+            return Array.isArray(parsed) ? parsed : [];
+        } catch {
+            return [];
+        }
+    }
+
     addHeader(nodeId) {
         const node = this.nodes.find(n => n.id === nodeId);
         if (!node) return;
@@ -3298,6 +3424,7 @@ class FlowEditor {
             if (node.isStart) icon = '🚀 Начало';
             else if (node.type === 'message' || node.type === 'universal') icon = '💬 Элемент';
             else if (node.type === 'api_request') icon = '🌐 API Запрос';
+            else if (node.type === 'fan_out') icon = '🔱 Параллельные запросы';
             else if (node.type === 'condition') icon = '🔀 Условие';
             else if (node.type === 'transform') icon = '⚙️ Обработка данных';
 
@@ -3306,6 +3433,10 @@ class FlowEditor {
             
             if (node.type === 'api_request') {
                 content = `<div class="node-text">${node.method} ${this.escapeHtml(node.url).substring(0, 40)}...</div>`;
+            } else if (node.type === 'fan_out') {
+                const count = this.parseFanOutRequests(node.requests).length;
+                const waitFor = parseInt(node.waitFor, 10) || 0;
+                content = `<div class="node-text">${count} запросов, ждать ${waitFor > 0 ? waitFor : 'все'} (до ${node.timeout || 15} с)</div>`;
             } else if (node.type === 'condition') {
                 content = `<div class="node-text">${this.escapeHtml(node.condition)}</div>`;
             } else if (node.type === 'transform') {
@@ -3357,7 +3488,7 @@ class FlowEditor {
                             `).join('')}
                         </div>
                     ` : ''}
-                    ${isConnectMode && node.type === 'api_request' ? `
+                    ${isConnectMode && (node.type === 'api_request' || node.type === 'fan_out') ? `
                         <div class="api-connection-options">
                             <div class="api-connector api-success-connector" data-connection-type="success" title="Соединение при успешном ответе">
                                 <div class="connector-badge">✅</div>
@@ -3383,7 +3514,7 @@ class FlowEditor {
                             </div>
                         </div>
                     ` : ''}
-                    ${isConnectMode && !node.isStart && node.type !== 'api_request' && node.type !== 'condition' ? '<div class="node-connector-target" title="Перетащите для соединения"></div>' : ''}
+                    ${isConnectMode && !node.isStart && node.type !== 'api_request' && node.type !== 'fan_out' && node.type !== 'condition' ? '<div class="node-connector-target" title="Перетащите для соединения"></div>' : ''}
                 </div>
                 <!-- Resize handles только для вправо, вниз и право-низ -->
                 <div class="resize-handle resize-handle-s" data-handle="s" title="Изменить размер вниз"></div>
@@ -3709,6 +3840,19 @@ class FlowEditor {
                     apiNodeErrors.push(errorMessage);
                 }
             }
+            // Check fan-out nodes for required connections
+            else if (node.type === 'fan_out') {
+                const fanOutConnections = this.connections.filter(c => c.from === node.id);
+                const hasSuccess = fanOutConnections.some(c => c.type === 'success');
+                const hasError = fanOutConnections.some(c => c.type === 'error');
+
+                if (!hasSuccess || (!node.ignoreError && !hasError)) {
+                    let errorMessage = `Узел параллельных запросов требует подключения ${node.ignoreError ? 'Success' : 'Success и Error'}.`;
+                    if (!hasSuccess) errorMessage += ' Отсутствует Success соединение.';
+                    if (!node.ignoreError && !hasError) errorMessage += ' Отсутствует Error соединение.';
+                    apiNodeErrors.push(errorMessage);
+                }
+            }
             // Check condition nodes for required connections
             else if (node.type === 'condition') {
                 const conditionConnections = this.connections.filter(c => c.from === node.id);
@@ -3773,6 +3917,19 @@ class FlowEditor {
                     apiNodeErrors.push(`API узел "${node.url && typeof node.url === 'string' ? node.url.substring(0, 30) + '...' : 'Без URL'}" требует подключения Success соединения.`);
                 }
             }
+            // Check fan-out nodes for required connections
+            else if (node.type === 'fan_out') {
+                const fanOutConnections = this.connections.filter(c => c.from === node.id);
+                const hasSuccess = fanOutConnections.some(c => c.type === 'success');
+                const hasError = fanOutConnections.some(c => c.type === 'error');
+
+                if (!hasSuccess || (!node.ignoreError && !hasError)) {
+                    let errorMessage = `Узел параллельных запросов требует подключения ${node.ignoreError ? 'Success' : 'Success и Error'}.`;
+                    if (!hasSuccess) errorMessage += ' Отсутствует Success соединение.';
+                    if (!node.ignoreError && !hasError) errorMessage += ' Отсутствует Error соединение.';
+                    apiNodeErrors.push(errorMessage);
+                }
+            }
             // Check condition nodes for required connections
             else if (node.type === 'condition') {
                 const conditionConnections = this.connections.filter(c => c.from === node.id);
@@ -3883,26 +4040,141 @@ class FlowEditor {
                     alert('Ошибка при сохранении flow команды');
                 }
             } else {
-                // Сохраняем flow бота
-                response = await fetch(this.apiUrl(`api/bots/${this.currentBotId}/flow`), {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify(flowData)
-                });
-                
-                if (response.ok) {
-                    alert('Диалог сохранён успешно!');
-                } else {
-                    alert('Ошибка при сохранении диалога');
-                }
+                // Сохраняем flow бота: изменения отправляются патчем относительно загруженной ревизии
+                await this.saveBotFlow(flowData);
             }
         } catch (error) {
             console.error('Error saving flow:', error);
             alert('Ошибка при сохранении: ' + error.message);
         }
     }
+
+    /**
+     * Сохраняет flow бота. Если известна ревизия, с которой начато редактирование,
+     * отправляется JSON Patch (RFC 6902) только с изменениями; сервер отклонит его с 409,
+     * если за это время flow сохранил кто-то другой.
+     */
+    async saveBotFlow(flowData) {
+        const body = JSON.stringify(flowData);
+        let response;
+
+        if (this.flowRevision && this.savedFlow) {
+            const patch = this.createFlowPatch(this.savedFlow, flowData);
+            if (patch.length === 0) {
+                alert('Изменений нет — диалог уже сохранён');
+                return;
+            }
+            const patchBody = JSON.stringify({ base_revision: this.flowRevision, patch });
+            // Патч больше самого flow (например, после импорта) — выгоднее отправить flow целиком
+            if (patchBody.length < body.length) {
+                response = await fetch(this.apiUrl(`api/bots/${this.currentBotId}/flow`), {
+                    method: 'PATCH',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: patchBody
+                });
+            }
+        }
+
+        if (!response) {
+            const query = this.flowRevision ? `?base_revision=${this.flowRevision}` : '';
+            response = await fetch(this.apiUrl(`api/bots/${this.currentBotId}/flow${query}`), {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body
+            });
+        }
+
+        if (response.status === 409) {
+            const overwrite = confirm(
+                'Диалог был изменён в другом окне или другим пользователем.\n\n' +
+                'OK — перезаписать эти изменения вашей версией.\nОтмена — не сохранять.'
+            );
+            if (!overwrite) return;
+            response = await fetch(this.apiUrl(`api/bots/${this.currentBotId}/flow`), {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body
+            });
+        }
+
+        if (response.ok) {
+            const result = await response.json();
+            this.flowRevision = result.revision || null;
+            this.savedFlow = Object.assign({}, this.savedFlow, JSON.parse(body));
+            alert('Диалог сохранён успешно!');
+        } else {
+            alert('Ошибка при сохранении диалога');
+        }
+    }
+
+    /**
+     * Строит JSON Patch, переводящий сохранённый flow в текущий (только nodes и connections).
+     */
+    createFlowPatch(before, after) {
+        const ops = [];
+        ['nodes', 'connections'].forEach(key => {
+            if (before[key] === undefined) {
+                ops.push({ op: 'add', path: `/${key}`, value: after[key] });
+            } else {
+                this.diffJson(before[key], after[key], `/${key}`, ops);
+            }
+        });
+        return ops;
+    }
+
+    diffJson(before, after, path, ops) {
+        if (before === after) return;
+        if (Array.isArray(before) && Array.isArray(after)) {
+            this.diffArrays(before, after, path, ops);
+            return;
+        }
+        const isObject = value => value !== null && typeof value === 'object' && !Array.isArray(value);
+        if (isObject(before) && isObject(after)) {
+            const pointer = key => `${path}/${String(key).replace(/~/g, '~0').replace(/\//g, '~1')}`;
+            Object.keys(before).forEach(key => {
+                if (before[key] !== undefined && after[key] === undefined) {
+                    ops.push({ op: 'remove', path: pointer(key) });
+                }
+            });
+            Object.keys(after).forEach(key => {
+                if (after[key] === undefined) return;
+                if (before[key] === undefined) {
+                    ops.push({ op: 'add', path: pointer(key), value: after[key] });
+                } else {
+                    this.diffJson(before[key], after[key], pointer(key), ops);
+                }
+            });
+            return;
+        }
+        if (JSON.stringify(before) !== JSON.stringify(after)) {
+            ops.push({ op: 'replace', path, value: after });
+        }
+    }
+
+    diffArrays(before, after, path, ops) {
+        const same = (a, b) => a === b || JSON.stringify(a) === JSON.stringify(b);
+
+        // Общие начало и конец не меняются; вставка или удаление в середине дают одну операцию
+        let start = 0;
+        while (start < before.length && start < after.length && same(before[start], after[start])) start++;
+        let endBefore = before.length;
+        let endAfter = after.length;
+        while (endBefore > start && endAfter > start && same(before[endBefore - 1], after[endAfter - 1])) {
+            endBefore--;
+            endAfter--;
+        }
+
+        const paired = Math.min(endBefore, endAfter) - start;
+        for (let i = start; i < start + paired; i++) {
+            this.diffJson(before[i], after[i], `${path}/${i}`, ops);
+        }
+        for (let i = endBefore - 1; i >= start + paired; i--) {
+            ops.push({ op: 'remove', path: `${path}/${i}` });
+        }
+        for (let i = start + paired; i < endAfter; i++) {
+            ops.push({ op: 'add', path: `${path}/${i}`, value: after[i] });
+        }
+    }
     
     exportFlow() {
         const flowData = {
@@ -4315,6 +4587,10 @@ function addApiNode() {
     flowEditor.addApiNode();
 }
 
+function addFanOutNode() {
+    flowEditor.addFanOutNode();
+}
+
 function addConditionNode() {
     flowEditor.addConditionNode();
 }
@@ -0,0 +1,62 @@
+"""
+Общие фикстуры тестов.
+
+Модули сервиса лежат плоско в src/ и импортируют друг друга по имени,
+поэтому src/ добавляется в sys.path до импорта тестов.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+import database  # noqa: E402
+from log_archive import log_archive  # noqa: E402
+
+# Архив логов ботов - синглтон модуля: тесты не пишут в data/logs репозитория
+log_archive.logs_dir = tempfile.mkdtemp(prefix='bot-logs-')
+
+
+def _reset_database():
+    """Закрывает соединения и потоки-писатели модуля database и сбрасывает его кеши."""
+    database._close_all()
+    database._writers.clear()
+    database._pools.clear()
+    database._initialized_shards.clear()
+    database._clear_caches()
+    database._db_initialized = False
+    database._catalog_version = None
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Пустая БД во временном каталоге (схема single); после теста всё закрывается."""
+    _reset_database()
+    monkeypatch.setattr(database, 'DB_FILE', str(tmp_path / 'db' / 'bots_data.db'))
+    monkeypatch.setattr(database, 'LOGS_DIR', str(tmp_path / 'logs'))
+    monkeypatch.setattr(database, 'SHARDS_DIR', str(tmp_path / 'db' / 'bots'))
+    monkeypatch.setattr(database, 'DB_LAYOUT', 'single')
+    database.init_db()
+    yield database
+    _reset_database()
+
+
+@pytest.fixture
+def web(db, monkeypatch):
+    """Модуль app (без раннера) над пустой БД; боты при первом запросе не запускаются."""
+    import app
+    # Без раннера app включает очистку SQLite в фоновом потоке архива логов, в тестах она не нужна
+    log_archive._prune = False
+    monkeypatch.setattr(app, 'started', True)
+    return app
+
+
+def drain_writes():
+    """Дожидается фиксации всех операций, уже поставленных в очередь записи."""
+    for writer in list(database._writers.values()):
+        writer.flush()
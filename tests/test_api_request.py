@@ -0,0 +1,162 @@
+"""Тесты нод api_request: пути extractVars и кэш ответов с объединением одинаковых запросов."""
+
+import threading
+import time
+import types
+
+import pytest
+
+import api_request
+from api_request import ResponseCache, compile_path, extract_path
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(api_request, 'time', types.SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+RESPONSE = {
+    'data': {
+        'items': [{'name': 'первый'}, {'name': 'второй'}, {'name': 'последний'}],
+        'by_id': {'0': 'ноль', '42': {'name': 'ответ'}},
+        'matrix': [[1, 2], [3, 4]],
+        'empty': None
+    }
+}
+
+
+def extract(path, data=RESPONSE, default=None):
+    return extract_path(data, compile_path(path), default)
+
+
+def test_compile_path_steps():
+    assert compile_path('data.items[0].name') == ('data', 'items', 0, 'name')
+    assert compile_path('data.matrix[1][-1]') == ('data', 'matrix', 1, -1)
+    assert compile_path('data..items') == ('data', 'items')
+
+
+@pytest.mark.parametrize('path', ['', '  ', '.', 'items[x]', 'items[1', 'items]', 'items[]'])
+def test_invalid_path_raises(path):
+    with pytest.raises(ValueError):
+        compile_path(path)
+
+
+def test_extract_list_indexes():
+    assert extract('data.items[0].name') == 'первый'
+    assert extract('data.items[-1].name') == 'последний'
+    assert extract('data.items[-3].name') == 'первый'
+    assert extract('data.matrix[1][-2]') == 3
+    # Индекс за пределами списка в обе стороны
+    assert extract('data.items[3].name', default='нет') == 'нет'
+    assert extract('data.items[-4].name', default='нет') == 'нет'
+
+
+def test_extract_numeric_dict_keys():
+    assert extract('data.by_id.0') == 'ноль'
+    # Индекс в квадратных скобках у словаря ищется как строковый ключ
+    assert extract('data.by_id[0]') == 'ноль'
+    assert extract('data.by_id[42].name') == 'ответ'
+    assert extract('data.by_id[7]', default='нет') == 'нет'
+
+
+def test_extract_missing_values():
+    assert extract('data.missing.name', default='нет') == 'нет'
+    # Шаг по скаляру или None - значения нет
+    assert extract('data.items[0].name.first', default='нет') == 'нет'
+    assert extract('data.empty.name', default='нет') == 'нет'
+    # Существующее значение None возвращается как есть
+    assert extract('data.empty', default='нет') is None
+    assert extract('items[0]', data=[{'a': 1}], default='нет') == 'нет'
+    assert extract('[0].a', data=[{'a': 1}]) == 1
+
+
+def ok(value):
+    return lambda: (True, 200, None, {'value': value})
+
+
+def test_concurrent_fetches_share_one_loader_call():
+    cache = ResponseCache()
+    release = threading.Event()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        release.wait(5)
+        return True, 200, None, {'value': 1}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.fetch('key', 60, loader)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    # Все вызовы, кроме первого, должны дождаться запроса, который уже выполняется
+    deadline = time.monotonic() + 5
+    while cache.stats()['coalesced'] < 7 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert calls == [1]
+    assert results == [(True, 200, None, {'value': 1})] * 8
+    stats = cache.stats()
+    assert (stats['misses'], stats['coalesced'], stats['inflight']) == (1, 7, 0)
+
+
+def test_failed_results_are_shared_but_not_cached():
+    cache = ResponseCache()
+    calls = []
+
+    def failing():
+        calls.append(1)
+        return False, 500, 'HTTP 500', {}
+
+    assert cache.fetch('key', 60, failing) == (False, 500, 'HTTP 500', {})
+    assert cache.fetch('key', 60, failing)[0] is False
+    assert len(calls) == 2
+    assert cache.stats()['size'] == 0
+
+
+def test_loader_exception_becomes_failed_result():
+    cache = ResponseCache()
+
+    def broken():
+        raise RuntimeError('сбой')
+
+    assert cache.fetch('key', 60, broken) == (False, None, 'сбой', {})
+    assert cache.stats()['size'] == 0
+    assert cache.fetch('key', 60, ok(2)) == (True, 200, None, {'value': 2})
+
+
+def test_entry_expires_after_ttl(clock):
+    cache = ResponseCache()
+    cache.fetch('key', 10, ok(1))
+    clock.now += 9.9
+    assert cache.fetch('key', 10, ok(2))[3] == {'value': 1}
+    clock.now += 0.2
+    assert cache.fetch('key', 10, ok(2))[3] == {'value': 2}
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['expirations']) == (1, 2, 1)
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(max_entries=2)
+    cache.fetch('a', 60, ok('a'))
+    cache.fetch('b', 60, ok('b'))
+    # Обращение к a делает вытесняемым b
+    cache.fetch('a', 60, ok('другое'))
+    cache.fetch('c', 60, ok('c'))
+
+    assert cache.fetch('a', 60, ok('новое'))[3] == {'value': 'a'}
+    assert cache.fetch('b', 60, ok('новое'))[3] == {'value': 'новое'}
+    assert cache.stats()['evictions'] == 2
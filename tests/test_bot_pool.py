@@ -0,0 +1,149 @@
+"""Тесты пула рабочих процессов: консистентное хеширование и проверка здоровья процессов."""
+
+from collections import Counter
+
+import pytest
+
+import bot_pool
+from bot_pool import HashRing, PoolBotManager
+from runner_ipc import RunnerUnavailable
+
+KEYS = range(10000)
+
+
+class FakeProcess:
+    def __init__(self, pid):
+        self.pid = pid
+        self.alive = True
+        self.exitcode = None
+
+    def is_alive(self):
+        return self.alive
+
+    def kill(self):
+        self.alive = False
+        self.exitcode = -9
+
+    def join(self, timeout=None):
+        pass
+
+
+class FakeClient:
+    """Канал управления процессом: запоминает запущенных ботов, ping может отказывать."""
+
+    def __init__(self):
+        self.started = []
+        self.ping_ok = True
+
+    def start_bot(self, bot_id, *args):
+        self.started.append((bot_id,) + args)
+        return True
+
+    def ping(self):
+        if not self.ping_ok:
+            raise RunnerUnavailable('нет ответа')
+        return {'bots': len(self.started)}
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot_pool, 'BOT_POOL_PING_FAILURES', 2)
+    pool = PoolBotManager(3, str(tmp_path))
+    pids = iter(range(100, 200))
+
+    def spawn(worker):
+        worker.process = FakeProcess(next(pids))
+        worker.ping_failures = 0
+        # Новый процесс: клиент видит пустой BotManager
+        worker.client = worker.probe = FakeClient()
+
+    monkeypatch.setattr(pool, '_spawn', spawn)
+    monkeypatch.setattr(pool, '_wait_ready', lambda worker: True)
+    for worker in pool.workers:
+        spawn(worker)
+    return pool
+
+
+def bots_of(pool, worker, count=30):
+    return [bot_id for bot_id in range(count) if pool._owner(bot_id) is worker]
+
+
+def test_ring_spreads_keys_evenly():
+    ring = HashRing(range(4))
+    counts = Counter(ring.node_for(key) for key in KEYS)
+    assert set(counts) == {0, 1, 2, 3}
+    mean = len(KEYS) / 4
+    assert all(0.75 * mean < count < 1.25 * mean for count in counts.values())
+    # Распределение зависит только от состава узлов
+    assert all(HashRing(range(4)).node_for(key) == ring.node_for(key) for key in range(100))
+
+
+def test_adding_node_moves_only_keys_to_it():
+    before, after = HashRing(range(4)), HashRing(range(5))
+    moved = [key for key in KEYS if before.node_for(key) != after.node_for(key)]
+    assert {after.node_for(key) for key in moved} == {4}
+    # Около 1/5 ключей, а не большая часть, как при остатке от деления
+    assert len(moved) < 1.5 * len(KEYS) / 5
+
+
+def test_removing_node_moves_only_its_keys():
+    before, after = HashRing(range(4)), HashRing(range(3))
+    moved = [key for key in KEYS if before.node_for(key) != after.node_for(key)]
+    assert {before.node_for(key) for key in moved} == {3}
+    assert len(moved) == sum(1 for key in KEYS if before.node_for(key) == 3)
+
+
+def test_dead_worker_is_restarted_with_its_bots(pool):
+    for bot_id in range(30):
+        pool.start_bot(bot_id, bot_id * 10)
+    worker = pool.workers[1]
+    others = {other.index: list(other.client.started) for other in pool.workers if other is not worker}
+    worker.process.alive = False
+    worker.process.exitcode = 1
+
+    pool.check_workers()
+
+    assert worker.restarts == 1 and worker.last_exit == 1
+    assert worker.process.is_alive()
+    # Запущены снова только боты этого процесса и с прежними аргументами (токен аренды)
+    assert worker.client.started == [(bot_id, bot_id * 10) for bot_id in bots_of(pool, worker)]
+    assert {other.index: other.client.started for other in pool.workers if other is not worker} == others
+
+
+def test_stopped_bot_is_not_restarted(pool):
+    worker = pool.workers[0]
+    bot_ids = bots_of(pool, worker)
+    for bot_id in bot_ids:
+        pool.start_bot(bot_id)
+    pool._running.pop(bot_ids[0])
+    worker.process.alive = False
+    pool.check_workers()
+    assert worker.client.started == [(bot_id,) for bot_id in bot_ids[1:]]
+
+
+def test_unresponsive_worker_is_restarted_after_consecutive_failures(pool):
+    worker = pool.workers[2]
+    hung = worker.process
+    worker.probe.ping_ok = False
+
+    pool.check_workers()
+    assert worker.ping_failures == 1 and worker.restarts == 0
+
+    # Успешная проверка обнуляет счётчик
+    worker.probe.ping_ok = True
+    pool.check_workers()
+    assert worker.ping_failures == 0
+
+    worker.probe.ping_ok = False
+    pool.check_workers()
+    pool.check_workers()
+    assert worker.restarts == 1
+    assert not hung.is_alive() and worker.process is not hung
+    assert worker.ping_failures == 0
+
+
+def test_no_restarts_after_shutdown(pool):
+    pool._stopping.set()
+    pool.workers[0].process.alive = False
+    pool.check_workers()
+    assert pool.workers[0].restarts == 0
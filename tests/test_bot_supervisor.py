@@ -0,0 +1,163 @@
+"""Тесты самовосстановления ботов: задержки перезапуска, цикл падений и замена экземпляра."""
+
+import threading
+import time
+
+import pytest
+
+import bot_manager
+from bot_manager import BotManager, _BotHealth
+
+
+@pytest.fixture
+def fast_supervisor(monkeypatch):
+    monkeypatch.setattr(bot_manager, 'BOT_SUPERVISOR_INTERVAL', 0.02)
+    monkeypatch.setattr(bot_manager, 'BOT_RESTART_BACKOFF_BASE', 0.05)
+    monkeypatch.setattr(bot_manager, 'BOT_RESTART_BACKOFF_MAX', 0.2)
+    monkeypatch.setattr(bot_manager, 'BOT_CRASH_LOOP_THRESHOLD', 3)
+    monkeypatch.setattr(bot_manager, 'BOT_CRASH_LOOP_WINDOW', 10)
+    monkeypatch.setattr(bot_manager, 'BOT_RESTART_RESET_AFTER', 60)
+
+
+def test_backoff_doubles_up_to_max(fast_supervisor):
+    health = _BotHealth()
+    delays = []
+    for _ in range(6):
+        health.record_failure('сбой', 100.0)
+        delays.append(round(health.next_restart_at - 100.0, 3))
+    assert delays == [0.05, 0.1, 0.2, 0.2, 0.2, 0.2]
+    assert health.to_dict(100.0)['restart_in'] == 0.2
+
+
+def test_crash_loop_is_entered_once_per_window(fast_supervisor):
+    health = _BotHealth()
+    assert not health.record_failure('сбой', 0.0)
+    assert not health.record_failure('сбой', 20.0)
+    # Три сбоя, но не за BOT_CRASH_LOOP_WINDOW секунд
+    assert not health.record_failure('сбой', 25.0)
+    assert health.record_failure('сбой', 26.0)
+    assert not health.record_failure('сбой', 27.0)
+    assert health.in_crash_loop and health.crash_loops == 1
+
+
+def test_healthy_bot_resets_failures(fast_supervisor):
+    health = _BotHealth()
+    health.record_failure('сбой', 0.0)
+    health.record_restart(1.0)
+    health.record_healthy(30.0)
+    assert health.consecutive_failures == 1
+    health.record_healthy(61.0)
+    assert health.consecutive_failures == 0
+    assert not health.in_crash_loop
+    assert health.restarts == 1
+
+
+class FakeInstance:
+    """Экземпляр бота: поток опроса падает сразу, пока crashing=True; остановка занимает stop_delay."""
+
+    crashing = True
+    stop_delay = 0.0
+    created = []
+
+    def __init__(self, bot_id):
+        self.bot_id = bot_id
+        self.bot_name = f'Bot_{bot_id}'
+        self.running = False
+        self.thread = None
+        self.crash_error = None
+        self.last_poll_at = None
+        self.lease_token = None
+        self._stopped = threading.Event()
+        FakeInstance.created.append(self)
+
+    def set_lease_token(self, token):
+        self.lease_token = token
+
+    def start(self):
+        self.running = True
+        self.last_poll_at = time.monotonic()
+        crash = FakeInstance.crashing
+        self.thread = threading.Thread(target=self._run, args=(crash,), daemon=True)
+        self.thread.start()
+
+    def _run(self, crash):
+        if crash:
+            self.crash_error = RuntimeError('boom')
+            return
+        self._stopped.wait()
+
+    def stop(self, persist=True):
+        time.sleep(FakeInstance.stop_delay)
+        self.running = False
+        self._stopped.set()
+
+    def log(self, level, message, event=None, **kwargs):
+        pass
+
+
+@pytest.fixture
+def manager(db, fast_supervisor, monkeypatch):
+    FakeInstance.crashing = True
+    FakeInstance.stop_delay = 0.0
+    FakeInstance.created = []
+    monkeypatch.setattr(bot_manager, 'BotInstance', FakeInstance)
+    monkeypatch.setattr(bot_manager, 'flow_is_startable', lambda bot_id: True)
+    manager = BotManager()
+    yield manager
+    manager._supervisor_stopped.set()
+    for bot_id in list(manager.bots):
+        manager.stop_bot(bot_id, False)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_crashing_bot_is_restarted_with_same_token(db, manager):
+    bot_id = db.add_bot('bot', 'token')
+    assert manager.start_bot(bot_id, lease_token=7)
+
+    assert wait_for(lambda: (manager.get_bot_health(bot_id) or {}).get('in_crash_loop'))
+    FakeInstance.crashing = False
+    assert wait_for(lambda: manager.get_bot_status(bot_id) == 'running'
+                    and manager.bots[bot_id].thread.is_alive())
+
+    health = manager.get_bot_health(bot_id)
+    assert health['restarts'] >= 3
+    assert health['crash_loops'] == 1
+    assert 'boom' in health['last_failure']
+    assert {instance.lease_token for instance in FakeInstance.created} == {7}
+
+
+def test_stopped_bot_is_not_restarted(db, manager):
+    bot_id = db.add_bot('bot', 'token')
+    manager.start_bot(bot_id)
+    assert wait_for(lambda: manager.get_bot_status(bot_id) == 'restarting')
+    manager.stop_bot(bot_id, False)
+
+    created = len(FakeInstance.created)
+    time.sleep(0.3)
+    assert len(FakeInstance.created) == created
+    assert manager.get_bot_health(bot_id) is None
+
+
+def test_slow_replacement_does_not_block_commands(db, manager):
+    bot_id = db.add_bot('bot', 'token')
+    FakeInstance.stop_delay = 0.5
+    manager.start_bot(bot_id)
+    assert wait_for(lambda: bot_id in manager._replacing)
+
+    started = time.monotonic()
+    assert manager.get_bot_status(bot_id) == 'restarting'
+    assert manager.get_bot_health(bot_id) is not None
+    assert time.monotonic() - started < 0.1
+
+    FakeInstance.crashing = False
+    FakeInstance.stop_delay = 0.0
+    assert wait_for(lambda: bot_id not in manager._replacing and bot_id in manager.bots)
+    assert manager.get_bot_health(bot_id)['restarts'] == 1
@@ -0,0 +1,113 @@
+"""Тесты кеша каталога: сброс при записи через модуль, при записи другим соединением и версии ключей."""
+
+import json
+import sqlite3
+
+import pytest
+
+from conftest import drain_writes
+
+
+def flow(text):
+    return {'nodes': [{'id': 'start', 'isStart': True, 'data': {'text': text}}], 'connections': []}
+
+
+@pytest.fixture
+def bot_id(db):
+    bot_id = db.add_bot('bot', 'token')
+    db.save_bot_flow(bot_id, flow('первый'))
+    return bot_id
+
+
+def external(db, sql, params=()):
+    """Запись другим соединением - как из другого процесса или из консоли sqlite3."""
+    with sqlite3.connect(db.DB_FILE) as conn:
+        conn.execute(sql, params)
+
+
+def test_update_bot_invalidates(db, bot_id):
+    assert db.get_bot(bot_id)['name'] == 'bot'
+    assert db.get_bot(bot_id) is db.get_bot(bot_id)
+    db.update_bot(bot_id, name='renamed')
+    assert db.get_bot(bot_id)['name'] == 'renamed'
+    assert [bot['name'] for bot in db.get_all_bots()] == ['renamed']
+    assert [bot['name'] for bot in db.get_bot_summaries()] == ['renamed']
+
+
+def test_save_bot_flow_invalidates(db, bot_id):
+    assert db.get_bot_flow(bot_id) == flow('первый')
+    etag = db.get_bot_flow_etag(bot_id)
+    db.save_bot_flow(bot_id, flow('второй'))
+    assert db.get_bot_flow(bot_id) == flow('второй')
+    assert db.get_bot_flow_etag(bot_id) != etag
+    assert db.get_bot_flow_revision(bot_id) == 2
+
+
+def test_delete_custom_command_invalidates(db, bot_id):
+    command_id = db.add_custom_command(bot_id, '/help', 'Помощь', flow('помощь'))
+    assert db.get_custom_command(bot_id, '/help')['id'] == command_id
+    assert db.get_custom_command_by_id(command_id) is not None
+    db.delete_custom_command(command_id)
+    assert db.get_custom_command(bot_id, '/help') is None
+    assert db.get_custom_command_by_id(command_id) is None
+    assert db.get_custom_commands(bot_id) == []
+
+
+def test_write_on_another_connection_is_seen_immediately(db, bot_id):
+    command_id = db.add_custom_command(bot_id, '/help', 'Помощь', flow('помощь'))
+    assert db.get_bot(bot_id)['status'] == 'stopped'
+    assert db.get_bot_flow(bot_id) == flow('первый')
+    assert db.get_custom_commands(bot_id)[0]['description'] == 'Помощь'
+
+    external(db, "UPDATE bots SET status = 'running' WHERE id = ?", (bot_id,))
+    assert db.get_bot(bot_id)['status'] == 'running'
+    assert db.get_bot_summaries()[0]['status'] == 'running'
+
+    external(db, 'UPDATE bot_flows SET flow_data = ? WHERE bot_id = ?', (json.dumps(flow('снаружи')), bot_id))
+    assert db.get_bot_flow(bot_id) == flow('снаружи')
+
+    external(db, "UPDATE custom_commands SET description = 'Справка' WHERE id = ?", (command_id,))
+    assert db.get_custom_commands(bot_id)[0]['description'] == 'Справка'
+
+    external(db, 'DELETE FROM custom_commands WHERE id = ?', (command_id,))
+    assert db.get_custom_command_by_id(command_id) is None
+
+
+def test_non_catalog_writes_keep_cache(db, bot_id):
+    record = db.get_bot(bot_id)
+    db.add_bot_log(bot_id, 'INFO', 'лог')
+    db.save_chat_sessions(bot_id, [(1, '{}')]).result()
+    drain_writes()
+    external(db, "INSERT INTO bot_logs (bot_id, level, message, timestamp) VALUES (?, 'INFO', 'снаружи', '2024')",
+             (bot_id,))
+    assert db.get_bot(bot_id) is record
+
+
+def test_stale_load_is_not_cached(db):
+    cache = db._EntityCache()
+    version = cache.version('key')
+    cache.invalidate('key')
+    cache.put('key', 'устаревшее', version)
+    assert cache.get('key') is db._MISSING
+
+    version = cache.version('key')
+    cache.clear()
+    cache.put('key', 'устаревшее', version)
+    assert cache.get('key') is db._MISSING
+
+    cache.put('key', 'свежее', cache.version('key'))
+    assert cache.get('key') == 'свежее'
+
+
+def test_write_during_load_is_not_overwritten(db, bot_id):
+    loads = []
+
+    def load():
+        # Запись завершилась, пока шло чтение: прочитанное значение уже устарело
+        if not loads:
+            db.update_bot(bot_id, name='во время чтения')
+        loads.append(1)
+        return 'устаревшее'
+
+    assert db._cached(db._bot_cache, bot_id, load) == 'устаревшее'
+    assert db.get_bot(bot_id)['name'] == 'во время чтения'
@@ -0,0 +1,126 @@
+"""Тесты нод fan_out: условие waitFor, общий срок ожидания и частичные сбои."""
+
+import threading
+import time
+
+import pytest
+
+from fan_out import FanOutSpec
+
+
+class StubRequest:
+    """Запрос ветки без сети: возвращает заданный результат, при необходимости ждёт release."""
+
+    def __init__(self, ok=True, values=None, error=None, release=None, ignore_error=False):
+        self.result = (ok, 200 if ok else 500, error, values or {})
+        self.release = release
+        self.ignore_error = ignore_error
+        self.snapshots = []
+
+    def run(self, variables, timeout):
+        self.snapshots.append(variables)
+        if self.release is not None:
+            self.release.wait(5)
+        return self.result
+
+
+@pytest.fixture
+def release():
+    # Отпускает зависшие ветки после теста, чтобы не занимать потоки пула
+    release = threading.Event()
+    yield release
+    release.set()
+
+
+def make_spec(branches, **node):
+    spec = FanOutSpec(dict(node, requests=[{'url': f'https://api.example.com/{i}'} for i in range(len(branches))]))
+    spec.branches = tuple(branches)
+    return spec
+
+
+def test_all_requests_merge_in_node_order():
+    first = StubRequest(values={'name': 'first', 'a': 1})
+    second = StubRequest(values={'name': 'second', 'b': 2})
+    spec = make_spec([first, second])
+    variables = {'user': 'u'}
+    result = spec.execute(variables)
+
+    assert (result.ok, result.succeeded, result.total, result.errors) == (True, 2, 2, [])
+    # При совпадении имён побеждает запрос, указанный позже
+    assert variables == {'user': 'u', 'name': 'second', 'a': 1, 'b': 2}
+    assert first.snapshots == [{'user': 'u'}]
+
+
+def test_wait_for_returns_without_slow_requests(release):
+    slow = StubRequest(values={'slow': True}, release=release)
+    fast = StubRequest(values={'fast': True})
+    spec = make_spec([slow, fast], waitFor=1, timeout=5)
+    variables = {}
+    started = time.monotonic()
+    result = spec.execute(variables)
+
+    assert time.monotonic() - started < 1
+    assert (result.ok, result.succeeded) == (True, 1)
+    assert result.errors == [(0, 'Результат не дождались')]
+    assert variables == {'fast': True}
+
+
+def test_deadline_ends_waiting(release):
+    spec = make_spec([StubRequest(values={'a': 1}), StubRequest(release=release)], timeout=0.2)
+    variables = {}
+    started = time.monotonic()
+    result = spec.execute(variables)
+
+    assert 0.15 < time.monotonic() - started < 1
+    assert (result.ok, result.succeeded) == (False, 1)
+    assert result.errors == [(1, 'Результат не дождались')]
+    # Успевшие запросы всё равно записывают свои переменные
+    assert variables == {'a': 1}
+
+
+def test_partial_failure_meets_wait_for():
+    spec = make_spec([StubRequest(values={'a': 1}), StubRequest(ok=False, error='HTTP 500'),
+                      StubRequest(values={'c': 3})], waitFor=2)
+    result = spec.execute({})
+    assert (result.ok, result.succeeded) == (True, 2)
+    # Ошибка второго запроса могла и не понадобиться: тогда его результат просто не дождались
+    assert [position for position, error in result.errors] == [1]
+
+
+def test_partial_failure_without_wait_for_fails():
+    spec = make_spec([StubRequest(values={'a': 1}), StubRequest(ok=False, error='HTTP 500')])
+    variables = {}
+    result = spec.execute(variables)
+    assert (result.ok, result.succeeded, result.errors) == (False, 1, [(1, 'HTTP 500')])
+    assert variables == {'a': 1}
+
+
+def test_stops_waiting_once_wait_for_is_unreachable(release):
+    spec = make_spec([StubRequest(ok=False, error='HTTP 500'), StubRequest(ok=False, error='HTTP 502'),
+                      StubRequest(release=release)], waitFor=2, timeout=5)
+    started = time.monotonic()
+    result = spec.execute({})
+
+    assert time.monotonic() - started < 1
+    assert not result.ok
+    assert result.errors == [(0, 'HTTP 500'), (1, 'HTTP 502'), (2, 'Результат не дождались')]
+
+
+def test_ignore_error_counts_as_success():
+    spec = make_spec([StubRequest(ok=False, error='HTTP 500', ignore_error=True), StubRequest(values={'b': 2})])
+    variables = {}
+    result = spec.execute(variables)
+    assert (result.ok, result.succeeded, result.errors) == (True, 2, [])
+    assert variables == {'b': 2}
+
+
+def test_wait_for_is_validated():
+    requests = [{'url': 'https://api.example.com/'}] * 2
+    assert FanOutSpec({'requests': requests, 'waitFor': 5}).required == 2
+    assert FanOutSpec({'requests': requests}).required == 2
+    with pytest.raises(ValueError):
+        FanOutSpec({'requests': requests, 'waitFor': -1})
+    with pytest.raises(ValueError):
+        FanOutSpec({'requests': requests, 'timeout': -1})
+    with pytest.raises(ValueError):
+        FanOutSpec({'requests': []})
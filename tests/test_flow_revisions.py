@@ -0,0 +1,112 @@
+"""Тесты истории ревизий flow: запись снимками и дельтами, патчи, откат и конфликты."""
+
+import copy
+import json
+
+import pytest
+
+from database import FlowConflictError
+from json_patch import apply_patch
+
+
+def _flow(texts):
+    nodes = [{'id': 'start', 'isStart': True, 'data': {'text': 'Старт'}}]
+    nodes += [{'id': f'node{i}', 'data': {'text': text}} for i, text in enumerate(texts)]
+    return {'nodes': nodes, 'connections': [{'from': 'start', 'to': 'node0'}]}
+
+
+@pytest.fixture
+def bot_id(db):
+    return db.add_bot('test', 'token')
+
+
+def test_every_revision_is_restored_across_snapshots(db, bot_id, monkeypatch):
+    monkeypatch.setattr(db, 'FLOW_SNAPSHOT_INTERVAL', 3)
+    texts = [f'Текст {i}' * 20 for i in range(10)]
+    saved = {}
+    for step in range(10):
+        texts[step % len(texts)] = f'Правка {step}'
+        flow = _flow(texts)
+        saved[db.save_bot_flow(bot_id, flow)] = copy.deepcopy(flow)
+
+    assert sorted(saved) == list(range(1, 11))
+    history = {row['revision']: row['kind'] for row in db.get_flow_revisions(bot_id, limit=100)}
+    assert history[1] == 'snapshot'
+    assert 'delta' in history.values()
+    # Между снимками не больше FLOW_SNAPSHOT_INTERVAL - 1 дельт
+    snapshots = [revision for revision, kind in sorted(history.items()) if kind == 'snapshot']
+    assert all(b - a <= 3 for a, b in zip(snapshots, snapshots[1:] + [11]))
+
+    for revision, flow in saved.items():
+        assert db.get_flow_revision(bot_id, revision) == flow
+    assert db.get_flow_revision(bot_id, 11) is None
+
+
+def test_patch_then_rollback_round_trip(db, bot_id):
+    original = _flow(['Первый'])
+    assert db.save_bot_flow(bot_id, original) == 1
+
+    patch = [{'op': 'replace', 'path': '/nodes/1/data/text', 'value': 'Второй'},
+             {'op': 'add', 'path': '/nodes/-', 'value': {'id': 'extra'}}]
+    assert db.patch_bot_flow(bot_id, patch, base_revision=1) == 2
+    patched = apply_patch(original, patch)
+    assert db.get_bot_flow(bot_id) == patched
+    assert db.get_flow_revision(bot_id, 2) == patched
+
+    assert apply_patch(original, db.diff_flow_revisions(bot_id, 1, 2)) == patched
+    assert apply_patch(patched, db.diff_flow_revisions(bot_id, 2, 1)) == original
+
+    assert db.rollback_bot_flow(bot_id, 1) == 3
+    assert db.get_bot_flow(bot_id) == original
+    assert db.get_bot_flow_revision(bot_id) == 3
+    # История не переписывается: откатываемая ревизия остаётся доступной
+    assert db.get_flow_revision(bot_id, 2) == patched
+    assert db.diff_flow_revisions(bot_id, 1, 3) == []
+
+
+def test_rollback_to_unknown_revision(db, bot_id):
+    db.save_bot_flow(bot_id, _flow(['Первый']))
+    with pytest.raises(LookupError):
+        db.rollback_bot_flow(bot_id, 7)
+    with pytest.raises(LookupError):
+        db.diff_flow_revisions(bot_id, 1, 7)
+
+
+def test_stale_base_revision_is_rejected(db, bot_id):
+    db.save_bot_flow(bot_id, _flow(['Первый']))
+    db.save_bot_flow(bot_id, _flow(['Второй']), base_revision=1)
+
+    with pytest.raises(FlowConflictError) as conflict:
+        db.save_bot_flow(bot_id, _flow(['Третий']), base_revision=1)
+    assert conflict.value.revision == 2
+    with pytest.raises(FlowConflictError):
+        db.patch_bot_flow(bot_id, [{'op': 'remove', 'path': '/connections/0'}], base_revision=1)
+
+    assert db.get_bot_flow(bot_id) == _flow(['Второй'])
+    assert db.get_bot_flow_revision(bot_id) == 2
+
+
+def test_invalid_patch_result_is_not_saved(db, bot_id):
+    db.save_bot_flow(bot_id, _flow(['Первый']))
+    with pytest.raises(ValueError):
+        db.patch_bot_flow(bot_id, [{'op': 'remove', 'path': '/nodes/0/isStart'}], base_revision=1)
+    assert db.get_bot_flow_revision(bot_id) == 1
+
+
+def test_snapshot_matches_revision(db, bot_id):
+    assert db.get_bot_flow_snapshot(bot_id) == (None, None, None)
+    db.save_bot_flow(bot_id, _flow(['Первый']))
+    db.save_bot_flow(bot_id, _flow(['Второй']))
+
+    flow_json, etag, revision = db.get_bot_flow_snapshot(bot_id)
+    assert revision == 2
+    assert json.loads(flow_json) == db.get_flow_revision(bot_id, 2)
+    assert etag == db.get_bot_flow_etag(bot_id)
+
+
+def test_returned_flows_do_not_share_cached_objects(db, bot_id):
+    db.save_bot_flow(bot_id, _flow(['Первый']))
+    for flow in (db.get_bot_flow(bot_id), db.get_flow_revision(bot_id, 1)):
+        flow['nodes'].clear()
+    assert db.get_bot_flow(bot_id) == _flow(['Первый'])
+    assert db.get_flow_revision(bot_id, 1) == _flow(['Первый'])
@@ -0,0 +1,119 @@
+"""Тесты условных GET и gzip-сжатия JSON-ответов (http_cache)."""
+
+import gzip
+import json
+from collections import OrderedDict
+
+import pytest
+from flask import Flask
+
+import http_cache
+from http_cache import cached_json_response, content_etag
+
+SMALL = json.dumps({'nodes': []})
+LARGE = json.dumps({'nodes': [{'id': i, 'text': 'текст ноды'} for i in range(200)]})
+
+
+@pytest.fixture
+def compress_calls(monkeypatch):
+    monkeypatch.setattr(http_cache, '_gzip_cache', OrderedDict())
+    monkeypatch.setattr(http_cache, 'GZIP_CACHE_MAX_ENTRIES', 2)
+    calls = []
+    compress = gzip.compress
+
+    def counting_compress(data, compresslevel):
+        calls.append(data)
+        return compress(data, compresslevel=compresslevel)
+
+    monkeypatch.setattr(http_cache.gzip, 'compress', counting_compress)
+    return calls
+
+
+@pytest.fixture
+def client(compress_calls):
+    app = Flask(__name__)
+    bodies = {'small': SMALL, 'large': LARGE}
+    built = []
+
+    @app.route('/<name>')
+    def body(name):
+        return cached_json_response(bodies[name])
+
+    @app.route('/lazy')
+    def lazy():
+        # ETag известен заранее: тело формируется, только если оно нужно клиенту
+        def build():
+            built.append(1)
+            return LARGE
+        return cached_json_response(build, etag=content_etag(LARGE))
+
+    client = app.test_client()
+    client.built = built
+    client.bodies = bodies
+    return client
+
+
+def test_etag_and_not_modified(client):
+    response = client.get('/small')
+    assert response.status_code == 200
+    assert response.get_json() == {'nodes': []}
+    etag = response.headers['ETag']
+    assert etag == f'"{content_etag(SMALL)}"'
+    assert response.headers['Cache-Control'] == 'no-cache'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+
+    response = client.get('/small', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == etag
+
+    # Изменившееся тело даёт новый ETag и полный ответ
+    client.bodies['small'] = json.dumps({'nodes': [1]})
+    assert client.get('/small', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_not_modified_skips_building_body(client):
+    etag = f'"{content_etag(LARGE)}"'
+    response = client.get('/lazy', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert client.built == []
+    assert client.get('/lazy').status_code == 200
+    assert client.built == [1]
+
+
+def test_gzip_is_negotiated(client):
+    response = client.get('/large', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.data).decode('utf-8') == LARGE
+    # У сжатого представления свой ETag, и он тоже подходит для If-None-Match
+    etag = response.headers['ETag']
+    assert etag == f'"{content_etag(LARGE)}-gzip"'
+    assert client.get('/large', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag}).status_code == 304
+
+    plain = client.get('/large')
+    assert 'Content-Encoding' not in plain.headers
+    assert plain.data.decode('utf-8') == LARGE
+
+    # Маленькие ответы не сжимаются
+    small = client.get('/small', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in small.headers
+
+
+def test_compressed_bodies_are_reused_and_evicted(client, compress_calls):
+    gzip_headers = {'Accept-Encoding': 'gzip'}
+    bodies = {name: json.dumps({'name': name, 'nodes': list(range(500))}) for name in 'abc'}
+    client.bodies.update(bodies)
+
+    client.get('/a', headers=gzip_headers)
+    client.get('/a', headers=gzip_headers)
+    assert len(compress_calls) == 1
+
+    client.get('/b', headers=gzip_headers)
+    # Обращение к a делает вытесняемым b
+    client.get('/a', headers=gzip_headers)
+    client.get('/c', headers=gzip_headers)
+    assert list(http_cache._gzip_cache) == [content_etag(bodies['a']), content_etag(bodies['c'])]
+
+    client.get('/b', headers=gzip_headers)
+    assert len(compress_calls) == 4
+    assert list(http_cache._gzip_cache) == [content_etag(bodies['c']), content_etag(bodies['b'])]
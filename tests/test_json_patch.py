@@ -0,0 +1,142 @@
+"""Тесты JSON Patch (RFC 6902) и построения патча между версиями flow."""
+
+import copy
+
+import pytest
+
+from json_patch import JsonPatchError, apply_patch, make_patch, parse_pointer
+
+DOCUMENT = {
+    'nodes': [
+        {'id': 'start', 'data': {'text': 'Привет'}},
+        {'id': 'menu', 'data': {'buttons': ['a', 'b']}},
+    ],
+    'meta': {'a/b': 1, 'm~n': 2},
+}
+
+
+def test_parse_pointer_unescapes_tokens():
+    assert parse_pointer('') == []
+    assert parse_pointer('/nodes/0') == ['nodes', '0']
+    assert parse_pointer('/a~1b/m~0n/~01') == ['a/b', 'm~n', '~1']
+
+
+@pytest.mark.parametrize('pointer', ['nodes', 5])
+def test_parse_pointer_rejects_invalid(pointer):
+    with pytest.raises(JsonPatchError):
+        parse_pointer(pointer)
+
+
+@pytest.mark.parametrize('operation, check', [
+    ({'op': 'add', 'path': '/nodes/-', 'value': {'id': 'end'}},
+     lambda doc: doc['nodes'][-1] == {'id': 'end'} and len(doc['nodes']) == 3),
+    ({'op': 'add', 'path': '/nodes/0', 'value': {'id': 'first'}},
+     lambda doc: [node['id'] for node in doc['nodes']] == ['first', 'start', 'menu']),
+    ({'op': 'add', 'path': '/meta/new', 'value': None},
+     lambda doc: doc['meta']['new'] is None),
+    ({'op': 'remove', 'path': '/nodes/1/data/buttons/0'},
+     lambda doc: doc['nodes'][1]['data']['buttons'] == ['b']),
+    ({'op': 'remove', 'path': '/meta/a~1b'},
+     lambda doc: doc['meta'] == {'m~n': 2}),
+    ({'op': 'replace', 'path': '/meta/m~0n', 'value': 3},
+     lambda doc: doc['meta']['m~n'] == 3),
+    ({'op': 'replace', 'path': '', 'value': {'empty': True}},
+     lambda doc: doc == {'empty': True}),
+    ({'op': 'move', 'from': '/nodes/0', 'path': '/nodes/-'},
+     lambda doc: [node['id'] for node in doc['nodes']] == ['menu', 'start']),
+    ({'op': 'copy', 'from': '/nodes/0/data', 'path': '/nodes/1/data'},
+     lambda doc: doc['nodes'][1]['data'] == {'text': 'Привет'}),
+    ({'op': 'test', 'path': '/nodes/1/data/buttons', 'value': ['a', 'b']},
+     lambda doc: doc == DOCUMENT),
+])
+def test_operations(operation, check):
+    assert check(apply_patch(DOCUMENT, [operation]))
+
+
+def test_source_is_not_modified_and_untouched_subtrees_are_shared():
+    document = copy.deepcopy(DOCUMENT)
+    original = copy.deepcopy(document)
+
+    result = apply_patch(document, [{'op': 'replace', 'path': '/nodes/0/data/text', 'value': 'Пока'}])
+
+    assert document == original
+    assert result['nodes'][0]['data']['text'] == 'Пока'
+    assert result['nodes'][0] is not document['nodes'][0]
+    assert result['nodes'][1] is document['nodes'][1]
+    assert result['meta'] is document['meta']
+
+
+def test_copied_value_is_independent_of_source():
+    result = apply_patch(DOCUMENT, [
+        {'op': 'copy', 'from': '/nodes/1/data', 'path': '/meta/data'},
+        {'op': 'add', 'path': '/meta/data/buttons/-', 'value': 'c'},
+    ])
+    assert result['meta']['data']['buttons'] == ['a', 'b', 'c']
+    assert result['nodes'][1]['data']['buttons'] == ['a', 'b']
+    assert DOCUMENT['nodes'][1]['data']['buttons'] == ['a', 'b']
+
+
+def test_failed_patch_is_not_applied_partially():
+    document = copy.deepcopy(DOCUMENT)
+    original = copy.deepcopy(document)
+    with pytest.raises(JsonPatchError):
+        apply_patch(document, [
+            {'op': 'remove', 'path': '/nodes/0'},
+            {'op': 'test', 'path': '/meta/a~1b', 'value': 2},
+        ])
+    assert document == original
+
+
+def test_test_operation_distinguishes_bool_from_number():
+    with pytest.raises(JsonPatchError):
+        apply_patch({'flag': True}, [{'op': 'test', 'path': '/flag', 'value': 1}])
+    with pytest.raises(JsonPatchError):
+        apply_patch({'count': 1}, [{'op': 'test', 'path': '/count', 'value': True}])
+    assert apply_patch({'count': 1}, [{'op': 'test', 'path': '/count', 'value': 1.0}]) == {'count': 1}
+
+
+@pytest.mark.parametrize('patch', [
+    {'op': 'add', 'path': '/x', 'value': 1},
+    [{'op': 'rename', 'path': '/meta'}],
+    [{'op': 'add', 'value': 1}],
+    [{'op': 'replace', 'path': '/meta/a~1b'}],
+    [{'op': 'move', 'path': '/meta/x'}],
+    [{'op': 'remove', 'path': '/missing'}],
+    [{'op': 'replace', 'path': '/nodes/5', 'value': 1}],
+    [{'op': 'add', 'path': '/nodes/01', 'value': 1}],
+    [{'op': 'add', 'path': '/nodes/-1', 'value': 1}],
+    [{'op': 'remove', 'path': '/nodes/-'}],
+    [{'op': 'move', 'from': '/nodes', 'path': '/nodes/0/child'}],
+    [{'op': 'remove', 'path': ''}],
+    ['add'],
+])
+def test_invalid_patches_are_rejected(patch):
+    with pytest.raises(JsonPatchError):
+        apply_patch(DOCUMENT, patch)
+
+
+@pytest.mark.parametrize('after', [
+    DOCUMENT,
+    {**DOCUMENT, 'meta': {'a/b': 1}},
+    {**DOCUMENT, 'meta': {'a/b': 1, 'm~n': 2, 'new/key~': [1, 2]}},
+    {'nodes': [DOCUMENT['nodes'][0], {'id': 'new'}, DOCUMENT['nodes'][1]], 'meta': DOCUMENT['meta']},
+    {'nodes': [DOCUMENT['nodes'][1]], 'meta': DOCUMENT['meta']},
+    {'nodes': {'id': 'start'}, 'meta': DOCUMENT['meta']},
+    {'nodes': [{'id': 'start', 'data': {'text': True}}, DOCUMENT['nodes'][1]], 'meta': DOCUMENT['meta']},
+    [],
+])
+def test_make_patch_round_trip(after):
+    patch = make_patch(DOCUMENT, after)
+    assert apply_patch(DOCUMENT, patch) == after
+
+
+def test_make_patch_is_minimal_for_small_edits():
+    assert make_patch(DOCUMENT, copy.deepcopy(DOCUMENT)) == []
+
+    inserted = copy.deepcopy(DOCUMENT)
+    inserted['nodes'].insert(1, {'id': 'new'})
+    assert make_patch(DOCUMENT, inserted) == [{'op': 'add', 'path': '/nodes/1', 'value': {'id': 'new'}}]
+
+    edited = copy.deepcopy(DOCUMENT)
+    edited['nodes'][0]['data']['text'] = 'Пока'
+    assert make_patch(DOCUMENT, edited) == [{'op': 'replace', 'path': '/nodes/0/data/text', 'value': 'Пока'}]
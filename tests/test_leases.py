@@ -0,0 +1,283 @@
+"""Тесты аренды ботов узлами раннеров: fencing-токены, распределение и передача ботов."""
+
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import bot_manager
+import leases
+from bot_manager import BotInstance
+from database import LeaseLostError
+from leases import LeaseBotManager, rendezvous_owner
+
+
+class Cluster:
+    """Общий для узлов учёт запущенных ботов: фиксирует одновременную работу бота на двух узлах."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.overlaps = []
+
+
+class FakeLocal:
+    """Локальный менеджер узла: запуск мгновенный, остановка занимает stop_delay секунд."""
+
+    def __init__(self, node_id, cluster, stop_delay=0.0):
+        self.node_id = node_id
+        self.cluster = cluster
+        self.stop_delay = stop_delay
+        self.bots = {}
+
+    def start_bot(self, bot_id, lease_token=None):
+        with self.cluster.lock:
+            owner = self.cluster.running.get(bot_id)
+            if owner is not None and owner != self.node_id:
+                self.cluster.overlaps.append((bot_id, owner, self.node_id))
+            self.cluster.running[bot_id] = self.node_id
+        self.bots[bot_id] = lease_token
+        return True
+
+    def stop_bot(self, bot_id, persist=True):
+        if self.bots.pop(bot_id, None) is None:
+            return False
+        time.sleep(self.stop_delay)
+        with self.cluster.lock:
+            if self.cluster.running.get(bot_id) == self.node_id:
+                del self.cluster.running[bot_id]
+        return True
+
+    def shutdown(self):
+        for bot_id in list(self.bots):
+            self.stop_bot(bot_id, False)
+
+    def ping(self):
+        return {'bots': len(self.bots)}
+
+
+@pytest.fixture
+def fast_leases(monkeypatch):
+    monkeypatch.setattr(leases, 'BOT_LEASE_TTL', 1.0)
+    monkeypatch.setattr(leases, 'BOT_LEASE_RENEW_INTERVAL', 0.1)
+
+
+def running_bots(db, count):
+    bot_ids = [db.add_bot(f'bot{i}', f'token{i}') for i in range(count)]
+    for bot_id in bot_ids:
+        db.update_bot_status(bot_id, 'running')
+    return bot_ids
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_rendezvous_owner_moves_only_affected_bots():
+    nodes = ['a', 'b', 'c']
+    owners = {bot_id: rendezvous_owner(bot_id, nodes) for bot_id in range(300)}
+    assert owners == {bot_id: rendezvous_owner(bot_id, list(reversed(nodes))) for bot_id in range(300)}
+    assert set(owners.values()) == set(nodes)
+
+    remaining = {bot_id: rendezvous_owner(bot_id, ['a', 'c']) for bot_id in range(300)}
+    for bot_id, owner in owners.items():
+        if owner != 'b':
+            assert remaining[bot_id] == owner
+
+
+def test_lease_acquire_expire_and_fencing(db):
+    bot_id = db.add_bot('bot', 'token')
+    now = time.time()
+    first = db.acquire_bot_lease(bot_id, 'a', now + 5, now)
+    assert first is not None
+    assert db.acquire_bot_lease(bot_id, 'a', now + 5, now) == first
+    assert db.acquire_bot_lease(bot_id, 'b', now + 5, now) is None
+
+    # Аренда узла a истекла: узел b получает её с новым токеном
+    later = now + 10
+    second = db.acquire_bot_lease(bot_id, 'b', later + 5, later)
+    assert second > first
+    assert db.renew_bot_leases('a', {bot_id: first}, later + 5) == set()
+    assert not db.is_bot_lease_valid(bot_id, first, later)
+    assert db.is_bot_lease_valid(bot_id, second, later)
+
+    with pytest.raises(LeaseLostError):
+        db.save_chat_sessions(bot_id, [(1, '{}')], first).result()
+    db.save_chat_sessions(bot_id, [(1, '{"node": "b"}')], second).result()
+    assert db.get_chat_session(bot_id, 1) == {'node': 'b'}
+
+    db.release_bot_lease(bot_id, 'b', second)
+    # Продление, начатое до освобождения, не возвращает аренду узлу
+    assert db.renew_bot_leases('b', {bot_id: second}, later + 5) == set()
+    assert db.acquire_bot_lease(bot_id, 'a', later + 5, later) > second
+
+
+def test_deleted_bot_leaves_no_lease(db):
+    bot_id = db.add_bot('bot', 'token')
+    now = time.time()
+    db.acquire_bot_lease(bot_id, 'a', now + 5, now)
+    db.delete_bot(bot_id)
+    assert bot_id not in db.get_bot_leases()
+
+
+def test_lost_lease_stops_bot(db, fast_leases):
+    bot_id, = running_bots(db, 1)
+    node = LeaseBotManager(FakeLocal('a', Cluster()), 'a')
+    node.renew()
+    node.reconcile()
+    assert set(node.held) == {bot_id}
+
+    now = time.time() + 100
+    assert db.acquire_bot_lease(bot_id, 'b', now + 5, now) is not None
+    node.renew()
+    assert wait_for(lambda: not node._draining)
+    assert node.held == {}
+    assert node.local.bots == {}
+    assert node.lost == 1
+
+
+def test_handover_with_slow_stop_keeps_single_owner(db, fast_leases):
+    bot_ids = running_bots(db, 8)
+    cluster = Cluster()
+    # Остановка бота дольше срока аренды: аренда должна продлеваться, пока бот не остановлен
+    first = LeaseBotManager(FakeLocal('a', cluster, stop_delay=1.5), 'a')
+    second = LeaseBotManager(FakeLocal('b', cluster), 'b')
+    try:
+        assert first.start_saved_bots() == bot_ids
+        second.start_saved_bots()
+
+        moving = {bot_id for bot_id in bot_ids if rendezvous_owner(bot_id, ['a', 'b']) == 'b'}
+        assert moving and moving != set(bot_ids)
+        assert wait_for(lambda: set(second.held) == moving and set(first.held) == set(bot_ids) - moving
+                        and not first._draining)
+
+        assert cluster.overlaps == []
+        assert first.lost == 0 and second.lost == 0
+        assert first.handed_over == len(moving)
+        assert cluster.running == {bot_id: rendezvous_owner(bot_id, ['a', 'b']) for bot_id in bot_ids}
+    finally:
+        second.shutdown()
+        first.shutdown()
+
+    assert cluster.running == {}
+    assert all(lease['expires_at'] == 0 for lease in db.get_bot_leases().values())
+
+
+def test_stopped_bot_is_released_to_no_one(db, fast_leases):
+    bot_ids = running_bots(db, 2)
+    node = LeaseBotManager(FakeLocal('a', Cluster(), stop_delay=0.2), 'a')
+    try:
+        node.start_saved_bots()
+        assert node.stop_bot(bot_ids[0])
+        # stop_bot дожидается остановки и освобождения аренды
+        assert bot_ids[0] not in node.local.bots
+        assert db.get_bot_leases()[bot_ids[0]]['expires_at'] == 0
+        time.sleep(0.3)
+        assert set(node.held) == {bot_ids[1]}
+    finally:
+        node.shutdown()
+
+
+class Clock:
+    """Модуль time для bot_manager: time() управляется тестом, остальное - настоящее."""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bot_manager, 'time', clock)
+    monkeypatch.setattr(bot_manager, 'BOT_LEASE_FENCE_MARGIN', 1.0)
+    return clock
+
+
+def leased_instance(db, clock):
+    """Экземпляр бота без flow, арендованный узлом a на 5 секунд."""
+    bot_id = db.add_bot('bot', 'token')
+    db.update_bot_status(bot_id, 'running')
+    instance = BotInstance.__new__(BotInstance)
+    instance.bot_id = bot_id
+    instance.bot_name = 'bot'
+    instance.bot_token = 'token'
+    instance.base_url = 'http://bot.invalid'
+    instance.recent_logs = deque(maxlen=bot_manager.RECENT_LOGS_CAPACITY)
+    instance.recent_logs_lock = threading.Lock()
+    instance.user_states = SimpleNamespace(lease_token=None)
+    instance.running = True
+    instance.persist_stop = True
+    instance.set_lease_token(db.acquire_bot_lease(bot_id, 'a', clock.now + 5, clock.now))
+    return instance
+
+
+def test_lease_expiry_is_cached_until_margin(db, clock, monkeypatch):
+    instance = leased_instance(db, clock)
+    assert instance.holds_lease()
+
+    reads = []
+    monkeypatch.setattr(bot_manager, 'get_bot_lease_expiry', lambda *args: reads.append(args) or clock.now + 5)
+    clock.now += 3.9
+    assert instance.holds_lease()
+    assert reads == []
+    # Меньше запаса до известного срока: срок перечитывается (аренду продлили)
+    clock.now += 0.2
+    assert instance.holds_lease()
+    assert len(reads) == 1
+
+
+def test_batch_stops_when_lease_runs_out(db, clock, monkeypatch):
+    instance = leased_instance(db, clock)
+    batches = [{'updates': [{'n': 1}, {'n': 2}, {'n': 3}], 'marker': 3}]
+    processed = []
+
+    def get_updates(marker):
+        if not batches:
+            instance.running = False
+            return {'updates': []}
+        return batches.pop(0)
+
+    def process_update(update, marker):
+        processed.append(update['n'])
+        # Обработка затянулась, и аренда не продлевалась: до её конца меньше запаса
+        clock.now += 4.5
+        return update['n']
+
+    def offline(*args, **kwargs):
+        raise requests.ConnectionError('нет сети')
+
+    instance.get_updates = get_updates
+    instance.process_update = process_update
+    monkeypatch.setattr(bot_manager.requests, 'get', offline)
+    instance.run()
+
+    assert processed == [1]
+    assert not instance.running
+    # Статус остаётся running: бота продолжит узел, получивший аренду
+    assert not instance.persist_stop
+    assert db.get_bot(instance.bot_id)['status'] == 'running'
+    assert any(log['message'].startswith('Аренда бота') for log in instance.get_recent_logs())
+
+
+def test_no_reply_without_lease(db, clock, monkeypatch):
+    instance = leased_instance(db, clock)
+    sent = []
+    monkeypatch.setattr(bot_manager.requests, 'post', lambda *args, **kwargs: sent.append(args))
+    clock.now += 10
+    assert instance.send_message(1, 'текст') == {}
+    assert instance.answer_callback('cb') == {}
+    assert sent == []
@@ -0,0 +1,102 @@
+"""Тесты полнотекстового поиска по логам: индекс FTS5, пагинация и поиск по файлам всех ботов."""
+
+import sqlite3
+
+import pytest
+
+from conftest import drain_writes
+
+
+def add_logs(db, bot_id, messages, level='INFO', day='2024-01-01'):
+    for second, message in enumerate(messages):
+        db.add_bot_log(bot_id, level, message, f'{day}T00:00:{second:02d}')
+    drain_writes()
+
+
+def found(db, bot_id, query, **kwargs):
+    return [log['message'] for log in db.search_bot_logs(bot_id, query, **kwargs)['results']]
+
+
+def check_index(path):
+    """Индекс FTS5 совпадает с содержимым bot_logs (иначе integrity-check бросает исключение)."""
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("INSERT INTO bot_logs_fts (bot_logs_fts, rank) VALUES ('integrity-check', 1)")
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def bot_id(db):
+    return db.add_bot('bot', 'token')
+
+
+def test_index_follows_insert_prune_and_clear(db, bot_id):
+    add_logs(db, bot_id, ['Ошибка чата 101', 'Сообщение отправлено в чат 101'], day='2024-01-01')
+    add_logs(db, bot_id, ['Ошибка чата 202'], day='2024-02-01')
+    other = db.add_bot('other', 'token')
+    add_logs(db, other, ['Ошибка чата 303'], day='2024-02-01')
+    check_index(db.DB_FILE)
+
+    assert sorted(found(db, bot_id, 'ошибка')) == ['Ошибка чата 101', 'Ошибка чата 202']
+    assert found(db, bot_id, '101 отправлено') == ['Сообщение отправлено в чат 101']
+
+    assert db.prune_bot_logs('2024-01-15') == 2
+    check_index(db.DB_FILE)
+    assert found(db, bot_id, '101') == []
+    assert found(db, bot_id, 'ошибка') == ['Ошибка чата 202']
+
+    db.clear_bot_logs(bot_id)
+    drain_writes()
+    check_index(db.DB_FILE)
+    assert found(db, bot_id, 'ошибка') == []
+    # Логи других ботов не затронуты
+    assert found(db, other, 'ошибка') == ['Ошибка чата 303']
+
+
+def test_query_syntax_is_searched_as_text(db, bot_id):
+    add_logs(db, bot_id, ['Нода node-1: ошибка (HTTP 500)', 'Нода node-2 выполнена'])
+    assert found(db, bot_id, 'node-1:') == ['Нода node-1: ошибка (HTTP 500)']
+    # Кавычки и скобки не ломают запрос FTS5, а знаки препинания токенизатор отбрасывает
+    assert found(db, bot_id, '"(HTTP') == ['Нода node-1: ошибка (HTTP 500)']
+    assert found(db, bot_id, '   ') == []
+
+
+def test_filters_by_level_and_interval(db, bot_id):
+    add_logs(db, bot_id, ['чат 1 открыт', 'чат 1 закрыт'])
+    add_logs(db, bot_id, ['чат 1 сбой'], level='ERROR', day='2024-01-02')
+    assert found(db, bot_id, 'чат', level='ERROR') == ['чат 1 сбой']
+    assert sorted(found(db, bot_id, 'чат', level=['INFO'])) == ['чат 1 закрыт', 'чат 1 открыт']
+    assert found(db, bot_id, 'чат', since='2024-01-01T00:00:01', until='2024-01-01T23:59:59') == ['чат 1 закрыт']
+
+
+def test_pagination(db, bot_id):
+    add_logs(db, bot_id, [f'запрос {i} выполнен' for i in range(5)] + ['другое'])
+    pages = [db.search_bot_logs(bot_id, 'запрос', limit=2, offset=offset) for offset in (0, 2, 4)]
+    assert [page['has_more'] for page in pages] == [True, True, False]
+    ids = [log['id'] for page in pages for log in page['results']]
+    assert len(ids) == len(set(ids)) == 5
+
+
+def test_search_all_shards_merges_by_time(db, monkeypatch):
+    monkeypatch.setattr(db, 'DB_LAYOUT', 'per_bot')
+    first, second = db.add_bot('first', 'token'), db.add_bot('second', 'token')
+    for second_of_minute in range(6):
+        bot_id = first if second_of_minute % 2 else second
+        db.add_bot_log(bot_id, 'INFO', f'событие {second_of_minute}', f'2024-01-01T00:00:{second_of_minute:02d}')
+    db.add_bot_log(first, 'INFO', 'постороннее', '2024-01-01T00:00:10')
+    drain_writes()
+    for bot_id in (first, second):
+        check_index(db._shard_path(bot_id))
+
+    result = db.search_bot_logs(None, 'событие', limit=4)
+    assert [log['message'] for log in result['results']] == ['событие 5', 'событие 4', 'событие 3', 'событие 2']
+    assert [log['bot_id'] for log in result['results']] == [first, second, first, second]
+    assert result['has_more']
+
+    rest = db.search_bot_logs(None, 'событие', limit=4, offset=4)
+    assert [log['message'] for log in rest['results']] == ['событие 1', 'событие 0']
+    assert not rest['has_more']
+
+    # Поиск по одному боту читает только его файл
+    assert sorted(found(db, second, 'событие')) == ['событие 0', 'событие 2', 'событие 4']
@@ -0,0 +1,120 @@
+"""Тесты буфера последних логов бота и эндпоинта логов, дочитывающего старую историю из SQLite."""
+
+import threading
+from collections import deque
+
+import pytest
+
+import bot_manager
+from bot_manager import BotInstance
+from conftest import drain_writes
+from runner_ipc import RunnerUnavailable
+
+
+class Archive:
+    def __init__(self):
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def archive(monkeypatch):
+    archive = Archive()
+    monkeypatch.setattr(bot_manager, 'log_archive', archive)
+    return archive
+
+
+@pytest.fixture
+def bot_id(db):
+    return db.add_bot('bot', 'token')
+
+
+def make_instance(bot_id):
+    """Экземпляр бота без flow и потока опроса: для log() нужны только буфер и bot_id."""
+    instance = BotInstance.__new__(BotInstance)
+    instance.bot_id = bot_id
+    instance.recent_logs = deque(maxlen=bot_manager.RECENT_LOGS_CAPACITY)
+    instance.recent_logs_lock = threading.Lock()
+    return instance
+
+
+def test_buffer_records_match_sqlite_rows(db, bot_id, archive):
+    instance = make_instance(bot_id)
+    instance.log('INFO', 'первый')
+    instance.log('ERROR', 'второй', chat_id=42, event='update_error', latency_ms=12)
+    drain_writes()
+
+    assert instance.get_recent_logs(10) == db.get_bot_logs(bot_id, 10)
+    assert [log['message'] for log in instance.get_recent_logs(10)] == ['второй', 'первый']
+    assert all(log['id'] is not None for log in instance.get_recent_logs(10))
+    # Архив получает структурированную запись с необязательными полями
+    assert archive.records[1]['chat_id'] == 42
+    assert archive.records[1]['event'] == 'update_error'
+
+
+def test_buffer_returns_what_it_has(db, bot_id, archive, monkeypatch):
+    monkeypatch.setattr(bot_manager, 'RECENT_LOGS_CAPACITY', 3)
+    instance = make_instance(bot_id)
+    assert instance.get_recent_logs(10) == []
+    for i in range(5):
+        instance.log('INFO', f'лог {i}')
+
+    assert [log['message'] for log in instance.get_recent_logs(10)] == ['лог 4', 'лог 3', 'лог 2']
+    assert [log['message'] for log in instance.get_recent_logs(2)] == ['лог 4', 'лог 3']
+
+    # Вызывающий код получает копии записей буфера
+    instance.get_recent_logs(1)[0]['message'] = 'изменено'
+    assert instance.get_recent_logs(1)[0]['message'] == 'лог 4'
+
+
+class Manager:
+    def __init__(self, logs):
+        self.logs = logs
+
+    def get_recent_logs(self, bot_id, limit=100):
+        if isinstance(self.logs, Exception):
+            raise self.logs
+        return None if self.logs is None else [dict(log) for log in self.logs[:limit]]
+
+
+def buffered(bot_id, timestamps):
+    return [{'id': None, 'bot_id': bot_id, 'level': 'INFO', 'message': f'буфер {ts}', 'timestamp': ts}
+            for ts in timestamps]
+
+
+@pytest.fixture
+def history(db, bot_id):
+    for i in range(1, 7):
+        db.add_bot_log(bot_id, 'INFO', f'sqlite {i}', timestamp=f'2024-01-01T00:00:0{i}')
+    drain_writes()
+
+
+def get_messages(web, bot_id, limit):
+    response = web.app.test_client().get(f'/api/bots/{bot_id}/logs?limit={limit}')
+    assert response.status_code == 200
+    return [log['message'] for log in response.get_json()]
+
+
+def test_endpoint_reads_only_older_rows_from_sqlite(web, bot_id, history, monkeypatch):
+    # В буфере последние записи, часть из которых уже есть в SQLite
+    monkeypatch.setattr(web, 'bot_manager', Manager(buffered(bot_id, ['2024-01-01T00:00:06', '2024-01-01T00:00:05'])))
+    assert get_messages(web, bot_id, 4) == ['буфер 2024-01-01T00:00:06', 'буфер 2024-01-01T00:00:05',
+                                            'sqlite 4', 'sqlite 3']
+
+
+def test_endpoint_does_not_query_sqlite_when_buffer_is_enough(web, bot_id, monkeypatch):
+    monkeypatch.setattr(web, 'bot_manager', Manager(buffered(bot_id, ['2024-01-01T00:00:03', '2024-01-01T00:00:02'])))
+
+    def fail(*args, **kwargs):
+        raise AssertionError('SQLite не должен читаться')
+
+    monkeypatch.setattr(web, 'get_bot_logs', fail)
+    assert get_messages(web, bot_id, 2) == ['буфер 2024-01-01T00:00:03', 'буфер 2024-01-01T00:00:02']
+
+
+@pytest.mark.parametrize('logs', [None, RunnerUnavailable('раннер недоступен'), []])
+def test_endpoint_falls_back_to_sqlite(web, bot_id, history, monkeypatch, logs):
+    monkeypatch.setattr(web, 'bot_manager', Manager(logs))
+    assert get_messages(web, bot_id, 3) == ['sqlite 6', 'sqlite 5', 'sqlite 4']
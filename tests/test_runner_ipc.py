@@ -0,0 +1,242 @@
+"""Тесты канала управления раннером: протокол, повтор запросов и переподключение после перезапуска."""
+
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+import runner_ipc
+from runner_ipc import RemoteBotManager, RunnerServer, RunnerUnavailable
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+# Раннер в отдельном процессе: пишет вызванные команды в файл, чтобы тест мог их посчитать
+RUNNER_SCRIPT = """
+import sys
+import runner_ipc
+
+class Manager:
+    def __init__(self, calls_path):
+        self.calls_path = calls_path
+
+    def _record(self, method, *args):
+        with open(self.calls_path, 'a') as f:
+            f.write(method + '\\n')
+
+    def ping(self):
+        return True
+
+    def start_bot(self, bot_id):
+        self._record('start_bot', bot_id)
+        return True
+
+    def get_bot_status(self, bot_id):
+        self._record('get_bot_status', bot_id)
+        return 'running'
+
+    def shutdown(self):
+        pass
+
+runner_ipc.serve_until_stopped(sys.argv[1], Manager(sys.argv[2]))
+"""
+
+
+class FakeManager:
+    def __init__(self):
+        self.calls = []
+
+    def ping(self):
+        return True
+
+    def start_bot(self, bot_id):
+        self.calls.append(('start_bot', bot_id))
+        return True
+
+    def stop_bot(self, bot_id):
+        raise LookupError(f'Бот {bot_id} не найден')
+
+    def reload_flow(self, bot_id):
+        raise RuntimeError('сбой')
+
+    def get_bot_statuses(self, items):
+        return {bot_id: status.upper() for bot_id, status in items}
+
+
+@pytest.fixture
+def socket_dir():
+    # Путь к Unix-сокету ограничен ~100 символами, поэтому не tmp_path
+    path = tempfile.mkdtemp(prefix='ipc-')
+    yield path
+    shutil.rmtree(path, ignore_errors=True)
+
+
+@pytest.fixture
+def server(socket_dir):
+    path = os.path.join(socket_dir, 'runner.sock')
+    server = RunnerServer(path, FakeManager())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class DroppingRunner:
+    """Сервер, который закрывает соединение, не ответив на первый запрос каждого метода из drop."""
+
+    def __init__(self, path, drop):
+        self.drop = set(drop)
+        self.calls = []
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn, conn.makefile('rb') as reader:
+            for line in reader:
+                method = json.loads(line)['method']
+                self.calls.append(method)
+                if method in self.drop:
+                    self.drop.discard(method)
+                    return
+                conn.sendall(json.dumps({'result': method}).encode('utf-8') + b'\n')
+
+    def close(self):
+        self.listener.close()
+
+
+def start_runner(path, calls_path):
+    process = subprocess.Popen(
+        [sys.executable, '-c', RUNNER_SCRIPT, path, calls_path],
+        env=dict(os.environ, PYTHONPATH=SRC_DIR)
+    )
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            return process
+        except OSError:
+            time.sleep(0.02)
+        finally:
+            probe.close()
+    process.kill()
+    pytest.fail('раннер не открыл сокет')
+
+
+def stop_runner(process):
+    process.terminate()
+    process.wait(timeout=10)
+
+
+def read_calls(calls_path):
+    with open(calls_path) as f:
+        return f.read().split()
+
+
+def test_results_and_errors_round_trip(server):
+    client = RemoteBotManager(server.server_address, timeout=5)
+    assert client.ping() is True
+    assert client.start_bot(7) is True
+    assert server.manager.calls == [('start_bot', 7)]
+    # Ключи-числа переживают JSON
+    assert client.get_bot_statuses({1: 'running', 2: 'stopped'}) == {1: 'RUNNING', 2: 'STOPPED'}
+    # Известные типы ошибок воспроизводятся, остальные становятся RuntimeError
+    with pytest.raises(LookupError, match='не найден'):
+        client.stop_bot(3)
+    with pytest.raises(RuntimeError, match='сбой'):
+        client.reload_flow(3)
+
+
+def test_unknown_method_is_rejected(server):
+    client = RemoteBotManager(server.server_address, timeout=5)
+    with pytest.raises(ValueError, match='Неизвестная команда'):
+        client._call('shutdown', ())
+    # Соединение остаётся рабочим после ошибки
+    assert client.ping() is True
+
+
+def test_runner_down_raises_unavailable(socket_dir):
+    client = RemoteBotManager(os.path.join(socket_dir, 'missing.sock'), timeout=5)
+    with pytest.raises(RunnerUnavailable):
+        client.ping()
+
+
+def test_command_is_not_repeated_after_lost_reply(socket_dir):
+    runner = DroppingRunner(os.path.join(socket_dir, 'runner.sock'), drop=['restart_bot'])
+    try:
+        client = RemoteBotManager(os.path.join(socket_dir, 'runner.sock'), timeout=5)
+        client.ping()
+        # Запрос дошёл до раннера, ответ потерян: повтор перезапустил бы бота второй раз
+        with pytest.raises(RunnerUnavailable):
+            client.restart_bot(1)
+        assert runner.calls.count('restart_bot') == 1
+        # Следующий вызов открывает новое соединение
+        assert client.ping() == 'ping'
+    finally:
+        runner.close()
+
+
+def test_read_only_method_is_repeated_after_lost_reply(socket_dir):
+    runner = DroppingRunner(os.path.join(socket_dir, 'runner.sock'), drop=['get_bot_status'])
+    try:
+        client = RemoteBotManager(os.path.join(socket_dir, 'runner.sock'), timeout=5)
+        client.ping()
+        assert client.get_bot_status(1) == 'get_bot_status'
+        assert runner.calls.count('get_bot_status') == 2
+    finally:
+        runner.close()
+
+
+def test_reconnects_after_runner_restart(socket_dir):
+    path = os.path.join(socket_dir, 'runner.sock')
+    first_calls = os.path.join(socket_dir, 'first.calls')
+    second_calls = os.path.join(socket_dir, 'second.calls')
+    runner = start_runner(path, first_calls)
+    try:
+        client = RemoteBotManager(path, timeout=5)
+        assert client.start_bot(1) is True
+        stop_runner(runner)
+        runner = start_runner(path, second_calls)
+        # Старое соединение закрыто раннером: отправка не удаётся, и команда уходит
+        # по новому соединению ровно один раз
+        assert client.start_bot(2) is True
+        assert client.get_bot_status(2) == 'running'
+        assert read_calls(first_calls) == ['start_bot']
+        assert read_calls(second_calls) == ['start_bot', 'get_bot_status']
+    finally:
+        stop_runner(runner)
+
+
+def test_clear_logs_survives_unavailable_runner(web, db, monkeypatch):
+    bot_id = db.add_bot('bot', 'token')
+    cleared = []
+
+    class Manager:
+        def clear_recent_logs(self, bot_id):
+            raise RunnerUnavailable('раннер остановлен')
+
+    monkeypatch.setattr(web, 'bot_manager', Manager())
+    monkeypatch.setattr(web, 'clear_bot_logs', cleared.append)
+    response = web.app.test_client().delete(f'/api/bots/{bot_id}/logs')
+    assert response.status_code == 200
+    assert cleared == [bot_id]
+
+
+def test_read_only_methods_are_control_methods():
+    assert runner_ipc.READ_ONLY_METHODS <= set(runner_ipc.CONTROL_METHODS)
@@ -0,0 +1,207 @@
+"""Тесты отложенной записи состояний чатов (SessionStore): сброс, вытеснение и ошибки записи."""
+
+import json
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+import session_store
+from conftest import drain_writes
+from database import LeaseLostError
+from session_store import SessionStore
+
+
+class State:
+    """Минимальное состояние чата: SessionStore нужен только to_dict()."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def to_dict(self):
+        return {'value': self.value}
+
+
+def restore(data):
+    return State(data['value'])
+
+
+def saved_value(db, bot_id, chat_id):
+    data = db.get_chat_session(bot_id, chat_id)
+    return data['value'] if data is not None else None
+
+
+@pytest.fixture
+def bot_id(db):
+    return db.add_bot('test', 'token')
+
+
+class FakeSave:
+    """Подмена save_chat_sessions: запоминает записи и отдаёт незавершённые Future."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, bot_id, rows, lease_token=None):
+        future = Future()
+        self.calls.append((dict(rows), future))
+        return future
+
+
+def test_flush_persists_dirty_states(db, bot_id):
+    store = SessionStore(bot_id, restore, ttl=0)
+    store[1] = State('a')
+    store[2] = State('b')
+
+    assert store.flush(wait=True) == 2
+    assert store.flush(wait=True) == 0
+    assert saved_value(db, bot_id, 1) == 'a'
+
+    store[1].value = 'c'
+    store.mark_dirty(1)
+    assert store.flush(wait=True) == 1
+    assert saved_value(db, bot_id, 1) == 'c'
+    assert saved_value(db, bot_id, 2) == 'b'
+
+
+def test_evicted_state_is_saved_and_loaded_back(db, bot_id):
+    store = SessionStore(bot_id, restore, max_entries=2, ttl=0)
+    for chat_id in range(5):
+        store[chat_id] = State(f'v{chat_id}')
+    assert len(store) == 2
+    assert store.stats()['evictions'] == 3
+
+    drain_writes()
+    assert saved_value(db, bot_id, 0) == 'v0'
+    assert store[0].value == 'v0'
+    assert store.get(100) is None
+    assert 100 not in store
+
+
+def test_expired_state_is_saved(db, bot_id):
+    store = SessionStore(bot_id, restore, ttl=0.01)
+    store[1] = State('a')
+    time.sleep(0.02)
+
+    assert store.expire() == 1
+    assert len(store) == 0
+    drain_writes()
+    assert saved_value(db, bot_id, 1) == 'a'
+    assert store[1].value == 'a'
+
+
+def test_failed_write_is_retried_on_next_flush(db, bot_id, monkeypatch):
+    fake = FakeSave()
+    monkeypatch.setattr(session_store, 'save_chat_sessions', fake)
+    store = SessionStore(bot_id, restore, ttl=0)
+    store[1] = State('a')
+
+    store.flush()
+    fake.calls[0][1].set_exception(RuntimeError('database is locked'))
+    assert store.stats()['dirty'] == 1
+
+    store.flush()
+    assert fake.calls[1][0] == {1: json.dumps({'value': 'a'})}
+
+
+def test_lease_lost_is_not_retried(db, bot_id, monkeypatch):
+    fake = FakeSave()
+    monkeypatch.setattr(session_store, 'save_chat_sessions', fake)
+    store = SessionStore(bot_id, restore, max_entries=1, ttl=0)
+    store[1] = State('a')
+    store[2] = State('b')
+
+    fake.calls[0][1].set_exception(LeaseLostError(bot_id))
+    assert 1 not in store._spilling
+    assert store.stats()['dirty'] == 1
+    store.flush()
+    assert [set(rows) for rows, _ in fake.calls] == [{1}, {2}]
+
+
+def test_state_evicted_during_write_is_served_from_memory(db, bot_id, monkeypatch):
+    fake = FakeSave()
+    monkeypatch.setattr(session_store, 'save_chat_sessions', fake)
+    store = SessionStore(bot_id, restore, max_entries=1, ttl=0)
+    first = State('a')
+    store[1] = first
+    store[2] = State('b')
+
+    # Запись вытесненного чата ещё не зафиксирована: в БД его нет, но состояние не теряется
+    assert store[1] is first
+    fake.calls[0][1].set_result(None)
+    assert 1 not in store._spilling
+
+
+def test_failed_write_of_evicted_state_keeps_it_in_memory(db, bot_id, monkeypatch):
+    fake = FakeSave()
+    monkeypatch.setattr(session_store, 'save_chat_sessions', fake)
+    store = SessionStore(bot_id, restore, max_entries=1, ttl=0)
+    first = State('a')
+    store[1] = first
+    store[2] = State('b')
+
+    fake.calls[0][1].set_exception(RuntimeError('disk I/O error'))
+    assert store._sessions[1][0] is first
+    store.flush()
+    assert 1 in fake.calls[-1][0]
+
+
+def test_newer_write_is_not_undone_by_older_failure(db, bot_id, monkeypatch):
+    fake = FakeSave()
+    monkeypatch.setattr(session_store, 'save_chat_sessions', fake)
+    store = SessionStore(bot_id, restore, ttl=0)
+    store[1] = State('a')
+    store.flush()
+    store[1] = State('b')
+    store.flush()
+
+    fake.calls[1][1].set_result(None)
+    fake.calls[0][1].set_exception(RuntimeError('database is locked'))
+    assert store.stats()['dirty'] == 0
+    assert 1 not in store._spilling
+
+
+def test_unserializable_state_does_not_block_others(db, bot_id):
+    store = SessionStore(bot_id, restore, ttl=0)
+    store[1] = State({1, 2})
+    store[2] = State('b')
+
+    assert store.flush(wait=True) == 1
+    assert saved_value(db, bot_id, 2) == 'b'
+    assert saved_value(db, bot_id, 1) is None
+
+
+def test_concurrent_updates_and_flushes(db, bot_id):
+    store = SessionStore(bot_id, restore, max_entries=20, ttl=0)
+    stop = threading.Event()
+    errors = []
+
+    def worker(offset):
+        count = 0
+        try:
+            while not stop.is_set():
+                chat_id = offset + count % 50
+                store[chat_id] = State(count)
+                store.get(offset + (count * 7) % 50)
+                count += 1
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(offset,)) for offset in (0, 1000, 2000)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + 0.5
+    while time.monotonic() < deadline:
+        store.flush()
+        store.expire()
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    store.flush(wait=True)
+    drain_writes()
+    assert errors == []
+    assert len(store) <= 20
+    assert store.stats()['dirty'] == 0
+    assert store._spilling == {}
@@ -0,0 +1,114 @@
+"""Тесты схемы хранения per_bot: файлы ботов создаются только записями существующих ботов."""
+
+import os
+import sqlite3
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def shard_db(db, monkeypatch):
+    monkeypatch.setattr(db, 'DB_LAYOUT', 'per_bot')
+    return db
+
+
+def shard_files(db, bot_id):
+    path = db._shard_path(bot_id)
+    return [path + suffix for suffix in ('', '-wal', '-shm') if os.path.exists(path + suffix)]
+
+
+def test_reads_do_not_create_shard(shard_db):
+    bot_id = shard_db.add_bot('bot', 'token')
+    assert shard_db.get_bot_logs(bot_id) == []
+    assert shard_db.get_chat_session(bot_id, 1) is None
+    assert shard_db.search_bot_logs(bot_id, 'текст')['results'] == []
+    assert shard_files(shard_db, bot_id) == []
+
+    shard_db.add_bot_log(bot_id, 'INFO', 'первый лог').result()
+    assert shard_files(shard_db, bot_id)
+    assert [log['message'] for log in shard_db.get_bot_logs(bot_id)] == ['первый лог']
+
+
+def test_unknown_bot_gets_no_shard(shard_db):
+    assert shard_db.add_bot_log(12345, 'INFO', 'лог') is None
+    with pytest.raises(LookupError):
+        shard_db.save_chat_sessions(12345, [(1, '{}')])
+    assert shard_files(shard_db, 12345) == []
+
+
+def test_deleted_bot_shard_is_not_recreated_by_polling_thread(shard_db):
+    bot_id = shard_db.add_bot('bot', 'token')
+    shard_db.add_bot_log(bot_id, 'INFO', 'запущен').result()
+    long_poll = threading.Event()
+    results = []
+
+    def polling_thread():
+        # Поток опроса висит в long polling дольше, чем stop() ждёт его завершения,
+        # и пишет последний лог уже после удаления бота
+        long_poll.wait()
+        results.append(shard_db.add_bot_log(bot_id, 'INFO', f'Бот [ID:{bot_id}] остановлен'))
+
+    thread = threading.Thread(target=polling_thread)
+    thread.start()
+    shard_db.delete_bot(bot_id)
+    long_poll.set()
+    thread.join()
+
+    assert results == [None]
+    assert shard_files(shard_db, bot_id) == []
+    assert bot_id not in shard_db._shard_bot_ids()
+
+
+def test_deleted_bot_shard_stays_deleted_under_concurrent_writes(shard_db):
+    bot_id = shard_db.add_bot('bot', 'token')
+    stop = threading.Event()
+    errors = []
+
+    def polling_thread():
+        try:
+            while not stop.is_set():
+                shard_db.add_bot_log(bot_id, 'DEBUG', 'опрос обновлений')
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=polling_thread)
+    thread.start()
+    try:
+        shard_db.add_bot_log(bot_id, 'INFO', 'запущен').result()
+        shard_db.delete_bot(bot_id)
+    finally:
+        stop.set()
+        thread.join()
+
+    for writer in list(shard_db._writers.values()):
+        writer.flush()
+    assert errors == []
+    assert shard_files(shard_db, bot_id) == []
+    assert shard_db._shard_path(bot_id) not in shard_db._initialized_shards
+
+
+def test_shard_deleted_by_another_process(shard_db):
+    bot_id = shard_db.add_bot('bot', 'token')
+    shard_db.add_bot_log(bot_id, 'INFO', 'лог').result()
+
+    # Другой процесс удалил бота: строку каталога и файл бота
+    with sqlite3.connect(shard_db.DB_FILE) as conn:
+        conn.execute('DELETE FROM bots WHERE id = ?', (bot_id,))
+    for path in shard_files(shard_db, bot_id):
+        os.remove(path)
+
+    assert shard_db.add_bot_log(bot_id, 'INFO', 'последний лог') is None
+    assert shard_files(shard_db, bot_id) == []
+
+
+def test_existing_shard_of_unknown_bot_stays_readable(shard_db):
+    bot_id = shard_db.add_bot('bot', 'token')
+    shard_db.add_bot_log(bot_id, 'INFO', 'лог').result()
+    with sqlite3.connect(shard_db.DB_FILE) as conn:
+        conn.execute('DELETE FROM bots WHERE id = ?', (bot_id,))
+    shard_db._forget_shard(shard_db._shard_path(bot_id))
+
+    # Файл, оставшийся от прежних версий, читается и очищается, но не пересоздаётся
+    assert [log['message'] for log in shard_db.get_bot_logs(bot_id)] == ['лог']
+    assert shard_db.prune_bot_logs('9999') == 1
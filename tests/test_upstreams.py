@@ -0,0 +1,148 @@
+"""Тесты bulkhead и circuit breaker внешних API (UpstreamGuard)."""
+
+import types
+
+import pytest
+
+import upstreams
+from upstreams import CLOSED, HALF_OPEN, OPEN, UpstreamGuard, UpstreamUnavailable
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(upstreams, 'time', types.SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def make_guard(**kwargs):
+    options = dict(max_concurrency=4, queue_timeout=0.01, failure_threshold=3, reset_timeout=30)
+    options.update(kwargs)
+    return UpstreamGuard('api.example.com', **options)
+
+
+def fail(guard):
+    with guard.call() as outcome:
+        outcome.failed()
+
+
+def succeed(guard):
+    with guard.call():
+        pass
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    guard = make_guard()
+    fail(guard)
+    fail(guard)
+    succeed(guard)
+    fail(guard)
+    fail(guard)
+    assert guard.state == CLOSED
+
+    fail(guard)
+    assert guard.state == OPEN
+    assert guard.stats()['breaker_trips'] == 1
+
+    with pytest.raises(UpstreamUnavailable):
+        succeed(guard)
+    stats = guard.stats()
+    assert stats['short_circuited'] == 1
+    assert stats['requests'] == 6
+    assert stats['failures'] == 5
+
+
+def test_exception_inside_call_counts_as_failure(clock):
+    guard = make_guard(failure_threshold=1)
+    with pytest.raises(ConnectionError):
+        with guard.call():
+            raise ConnectionError('reset by peer')
+    assert guard.state == OPEN
+
+
+def test_half_open_trial_success_closes(clock):
+    guard = make_guard(failure_threshold=1)
+    fail(guard)
+    clock.now += 29
+    with pytest.raises(UpstreamUnavailable):
+        succeed(guard)
+
+    clock.now += 1
+    assert guard.stats()['state'] == HALF_OPEN
+    with guard.call():
+        assert guard.state == HALF_OPEN
+        # Пока идёт пробный запрос, остальные не пропускаются
+        with pytest.raises(UpstreamUnavailable):
+            succeed(guard)
+    assert guard.state == CLOSED
+    succeed(guard)
+    succeed(guard)
+
+
+def test_half_open_trial_failure_reopens(clock):
+    guard = make_guard(failure_threshold=2)
+    fail(guard)
+    fail(guard)
+    clock.now += 30
+
+    fail(guard)
+    assert guard.state == OPEN
+    assert guard.stats()['breaker_trips'] == 2
+    with pytest.raises(UpstreamUnavailable):
+        succeed(guard)
+
+    # Новый отсчёт reset_timeout идёт от неудачной пробы
+    clock.now += 30
+    succeed(guard)
+    assert guard.state == CLOSED
+
+
+def test_bulkhead_rejects_when_slots_are_busy():
+    guard = make_guard(max_concurrency=2)
+    with guard.call(), guard.call():
+        assert guard.stats()['in_flight'] == 2
+        with pytest.raises(UpstreamUnavailable):
+            succeed(guard)
+    stats = guard.stats()
+    assert stats['rejected'] == 1
+    assert stats['in_flight'] == 0
+    # Отказ bulkhead не считается ошибкой хоста
+    assert stats['requests'] == 2
+    assert guard.state == CLOSED
+
+
+def test_rejected_trial_does_not_block_next_trial(clock):
+    guard = make_guard(max_concurrency=1, failure_threshold=1)
+    fail(guard)
+    clock.now += 30
+
+    # Все слоты заняты: пробный запрос не получает слот и не должен занять пробу навсегда
+    guard._slots.acquire()
+    with pytest.raises(UpstreamUnavailable):
+        succeed(guard)
+    guard._slots.release()
+    assert guard.stats()['rejected'] == 1
+
+    succeed(guard)
+    assert guard.state == CLOSED
+
+
+def test_metrics():
+    guard = make_guard(failure_threshold=10)
+    for _ in range(3):
+        succeed(guard)
+    fail(guard)
+    stats = guard.stats()
+    assert stats['error_rate'] == 0.25
+    assert stats['latency_ms']['p50'] is not None
+    assert upstreams.is_failure_status(503)
+    assert upstreams.is_failure_status(429)
+    assert not upstreams.is_failure_status(404)
@@ -0,0 +1,68 @@
+"""Тесты очереди записи SQLite: пачки операций и изоляция ошибок точками сохранения."""
+
+import sqlite3
+import threading
+
+import pytest
+
+from database import _WriteQueue
+
+
+@pytest.fixture
+def writer(tmp_path):
+    path = str(tmp_path / 'queue.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE items (name TEXT PRIMARY KEY)')
+    conn.commit()
+    conn.close()
+    writer = _WriteQueue(path)
+    yield writer
+    writer.close()
+
+
+def rows(writer):
+    with sqlite3.connect(writer.path) as conn:
+        return sorted(row[0] for row in conn.execute('SELECT name FROM items'))
+
+
+def insert(name):
+    return lambda cursor: cursor.execute('INSERT INTO items (name) VALUES (?)', (name,)).lastrowid
+
+
+def test_failed_operation_does_not_roll_back_batch(writer):
+    release = threading.Event()
+    blocker = writer.submit(lambda cursor: release.wait())
+
+    def partial_failure(cursor):
+        cursor.execute('INSERT INTO items (name) VALUES (?)', ('partial',))
+        raise ValueError('ошибка операции')
+
+    # Пока писатель занят, операции копятся в очереди и попадают в одну пачку
+    first = writer.submit(insert('first'))
+    failed = writer.submit(partial_failure)
+    duplicate = writer.submit(insert('first'))
+    last = writer.submit(insert('last'))
+    release.set()
+
+    blocker.result()
+    assert first.result() is not None
+    with pytest.raises(ValueError):
+        failed.result()
+    with pytest.raises(sqlite3.IntegrityError):
+        duplicate.result()
+    assert last.result() is not None
+    assert rows(writer) == ['first', 'last']
+
+
+def test_flush_waits_for_queued_operations(writer):
+    futures = [writer.submit(insert(f'item{i}')) for i in range(500)]
+    writer.flush()
+    assert all(future.done() for future in futures)
+    assert len(rows(writer)) == 500
+
+
+def test_close_writes_remaining_operations(writer):
+    future = writer.submit(insert('queued'))
+    writer.close()
+    assert future.done()
+    assert rows(writer) == ['queued']